@@ -1,11 +1,38 @@
-#You will need to pip install flask and the sqlalchemy extension for flask.
-from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
+import os
 
-# Initialize the application.
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+from database import AccountingDatabase, environ_config, read_settings
 
-# Import the views file for routing.
-import views
+# The accounting engine needs only SQLAlchemy: the settings of config.py and the environment, and
+# the database the models are declared on. The Flask app (accounting.web) and its views are only
+# loaded by create_app, so batch jobs and the CLI don't load the web side.
+_root_path = os.path.dirname(os.path.abspath(__file__))
+settings = read_settings(os.path.join(_root_path, 'config.py'))
+settings.update(environ_config(os.environ, settings.keys()))
+db = AccountingDatabase(settings, _root_path)
+
+
+"""
+ Sets the settings from config.py, then the ACCOUNTING_<SETTING> variables of environ (os.environ
+ if None), then config, and returns them. There is one set of settings, shared with the web app,
+ so this reconfigures both and drops the database connections opened with the old settings.
+"""
+def configure(config=None, environ=None):
+    previous = dict(settings)
+    settings.update(read_settings(os.path.join(_root_path, 'config.py')))
+    settings.update(environ_config(os.environ if environ is None else environ, settings.keys()))
+    settings.update(config or {})
+    if any(previous.get(key) != value for key, value in settings.items()):
+        db.reset_engines()
+    return settings
+
+
+"""
+ The app factory for serving: configures the settings as configure does and returns the Flask
+ app with its views registered.
+"""
+def create_app(config=None, environ=None):
+    configure(config, environ)
+    from web import app
+    # Import the views file for routing.
+    import views
+    return app
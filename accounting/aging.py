@@ -0,0 +1,146 @@
+#!/user/bin/env python2.7
+
+import argparse
+import csv
+import sys
+from datetime import datetime
+
+from sqlalchemy import func, literal, literal_column, select, union_all
+
+from accounting import db
+from models import Invoice, Payment, Policy
+
+
+"""
+#######################################################
+The receivables aging report.
+
+Every Active policy's payments are applied to its
+non-deleted invoices oldest due date first, and whatever
+is left unpaid on each invoice is put in a bucket by how
+many days past due it is.
+
+The report is worked out from one sorted stream of rows
+(one payment total per policy, then its invoices by due
+date) that is read as it arrives, so only one policy is
+held in memory at a time however big the book is.
+#######################################################
+"""
+
+# (column, first day past due, last day past due), invoices not due yet are 'current'
+AGING_BUCKETS = (('0-30', 0, 30),
+                 ('31-60', 31, 60),
+                 ('61-90', 61, 90),
+                 ('90+', 91, None))
+
+COLUMNS = ['policy_id', 'policy_number', 'current'] + \
+          [name for name, _, _ in AGING_BUCKETS] + ['balance']
+
+# payment totals sort ahead of a policy's invoices so they can be applied as invoices arrive
+_PAYMENTS = 0
+_INVOICE = 1
+
+
+def _bucket(days_past_due):
+    if days_past_due < 0:
+        return 0
+    for index, (_, first, last) in enumerate(AGING_BUCKETS):
+        if last is None or days_past_due <= last:
+            return index + 1
+
+
+def _aging_stream(date_cursor):
+    # the invoices come first so the union takes its column types from them
+    invoices = select([Invoice.policy_id.label('policy_id'),
+                       Policy.policy_number.label('policy_number'),
+                       literal(_INVOICE).label('kind'),
+                       Invoice.due_date.label('due_date'),
+                       Invoice.amount_due.label('amount')])\
+        .where(Invoice.policy_id == Policy.id)\
+        .where(Policy.status == u'Active')\
+        .where(Invoice.deleted == False)\
+        .where(Invoice.bill_date <= date_cursor)
+    payments = select([Payment.policy_id.label('policy_id'),
+                       Policy.policy_number.label('policy_number'),
+                       literal(_PAYMENTS).label('kind'),
+                       literal_column('NULL').label('due_date'),
+                       func.sum(Payment.amount_paid).label('amount')])\
+        .where(Payment.policy_id == Policy.id)\
+        .where(Policy.status == u'Active')\
+        .where(Payment.transaction_date <= date_cursor)\
+        .group_by(Payment.policy_id, Policy.policy_number)
+
+    rows = union_all(invoices, payments).order_by(literal_column('policy_id'),
+                                                  literal_column('kind'),
+                                                  literal_column('due_date'))
+    # stream_results asks drivers that buffer by default (psycopg2) for a server-side cursor
+    return db.session.execute(rows.execution_options(stream_results=True))
+
+
+"""
+ Yields one [policy_id, policy_number, current, 0-30, 31-60, 61-90, 90+, balance] row for
+ every Active policy with a balance as of date_cursor, in policy_id order. The buckets hold
+ what is unpaid of the invoices billed by date_cursor, by days past their due date; balance
+ is the same as PolicyAccounting.return_account_balance and is less than the buckets' total
+ when the policy has paid more than it has been billed.
+"""
+def aging_rows(date_cursor=None):
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    as_of = date_cursor.toordinal()
+
+    current_policy = None
+    for row in _aging_stream(date_cursor):
+        if row['policy_id'] != current_policy:
+            if current_policy is not None and (any(buckets) or credit):
+                yield [current_policy, policy_number] + buckets + [sum(buckets) - credit]
+            current_policy = row['policy_id']
+            policy_number = row['policy_number']
+            buckets = [0] * (len(AGING_BUCKETS) + 1)
+            credit = 0
+
+        if row['kind'] == _PAYMENTS:
+            credit = row['amount']
+            continue
+
+        applied = min(credit, row['amount'])
+        credit -= applied
+        unpaid = row['amount'] - applied
+        if unpaid:
+            buckets[_bucket(as_of - row['due_date'].toordinal())] += unpaid
+
+    if current_policy is not None and (any(buckets) or credit):
+        yield [current_policy, policy_number] + buckets + [sum(buckets) - credit]
+
+
+class Echo(object):
+    # lets csv.writer hand back each formatted line instead of writing it somewhere
+    def write(self, value):
+        return value
+
+
+"""
+ Yields the aging report as of date_cursor as CSV text, one line at a time, header first.
+"""
+def aging_csv(date_cursor=None):
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for row in aging_rows(date_cursor):
+        yield writer.writerow(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write the receivables aging report as CSV.')
+    parser.add_argument('--date', help='YYYY-MM-DD (default: today)')
+    parser.add_argument('--output', help='write the report to this file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    date_cursor = datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else None
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for line in aging_csv(date_cursor):
+            output.write(line)
+    finally:
+        if args.output:
+            output.close()
+    return 0
@@ -0,0 +1,157 @@
+#!/user/bin/env python2.7
+
+import argparse
+import time
+from itertools import groupby
+
+from sqlalchemy import bindparam, or_, select
+
+from accounting import db
+from models import Invoice, Payment, Policy
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+
+
+"""
+#######################################################
+Payment allocation.
+
+A policy's payments, in transaction_date order, pay off
+its non-deleted invoices oldest due_date first. Each
+invoice stores how much of it has been paid (amount_paid),
+whether it is paid in full (paid) and the date of the
+payment that finished paying it (paid_date). Deleted
+invoices are left unpaid and money paid beyond what has
+been invoiced stays with the policy as credit.
+
+An invoice was still open on a date when it isn't paid, or
+was only paid off after that date. That makes "is anything
+past due and unpaid" an indexed lookup (see open_on)
+instead of a replay of the policy's payments.
+
+PolicyAccounting reallocates a policy whenever it takes a
+payment or re-invoices, in the same transaction.
+#######################################################
+"""
+
+invoices = Invoice.__table__
+
+# policies reallocated per transaction by reallocate_all
+REALLOCATE_CHUNK_SIZE = 1000
+
+
+"""
+ Returns a clause that is true for invoices that were still open on date_value, a date or a
+ date column such as Invoice.cancel_date.
+"""
+def open_on(date_value):
+    return or_(Invoice.paid == False, Invoice.paid_date > date_value)
+
+
+"""
+ Works out the allocation of payment_rows (transaction_date, amount_paid) over invoice_rows
+ (id, due_date, amount_due, deleted). Returns {invoice_id: (amount_paid, paid, paid_date)}.
+"""
+def allocate(invoice_rows, payment_rows):
+    payment_rows = sorted(payment_rows, key=lambda row: row[0])
+    total_paid = sum(amount for _, amount in payment_rows)
+
+    allocations = {}
+    owed_before = 0  # owed on the invoices due before this one
+    covered = 0      # total of the payments read so far
+    next_payment = 0
+    for invoice_id, due_date, amount_due, deleted in sorted(invoice_rows, key=lambda row: (row[1], row[0])):
+        if deleted:
+            allocations[invoice_id] = (0, False, None)
+            continue
+
+        owed_through = owed_before + amount_due
+        amount_paid = min(max(total_paid - owed_before, 0), amount_due)
+        # nothing is owed on an invoice for nothing, whatever happens to the ones before it
+        paid = amount_due <= 0 or total_paid >= owed_through
+        paid_date = None
+        if paid and amount_due > 0:
+            while covered < owed_through:
+                covered += payment_rows[next_payment][1]
+                next_payment += 1
+            paid_date = payment_rows[next_payment - 1][0] if next_payment else None
+        allocations[invoice_id] = (amount_paid, paid, paid_date)
+        owed_before = owed_through
+    return allocations
+
+
+"""
+ Allocates the payments of every policy in policy_ids again and writes the invoices whose
+ allocation changed. Does not commit, so writers can reallocate inside their own transaction.
+"""
+def reallocate(policy_ids):
+    # make sure anything the caller added through the ORM is visible to the queries below
+    db.session.flush()
+
+    updated = 0
+    for chunk in chunks(set(policy_ids), IN_CLAUSE_CHUNK_SIZE):
+        invoice_rows = db.session.execute(
+            select([invoices.c.policy_id, invoices.c.id, invoices.c.due_date, invoices.c.amount_due,
+                    invoices.c.deleted, invoices.c.amount_paid, invoices.c.paid, invoices.c.paid_date])
+            .where(invoices.c.policy_id.in_(chunk))
+            .order_by(invoices.c.policy_id)).fetchall()
+        payments = dict((policy_id, [(row.transaction_date, row.amount_paid) for row in rows])
+                        for policy_id, rows in groupby(db.session.execute(
+                            select([Payment.policy_id, Payment.transaction_date, Payment.amount_paid])
+                            .where(Payment.policy_id.in_(chunk))
+                            .order_by(Payment.policy_id, Payment.transaction_date, Payment.id)),
+                            lambda row: row.policy_id))
+
+        changes = []
+        for policy_id, rows in groupby(invoice_rows, lambda row: row.policy_id):
+            rows = list(rows)
+            allocations = allocate([(row.id, row.due_date, row.amount_due, row.deleted) for row in rows],
+                                   payments.get(policy_id, []))
+            for row in rows:
+                if allocations[row.id] != (row.amount_paid, row.paid, row.paid_date):
+                    amount_paid, paid, paid_date = allocations[row.id]
+                    changes.append({'invoice_id': row.id,
+                                    'new_amount_paid': amount_paid,
+                                    'new_paid': paid,
+                                    'new_paid_date': paid_date})
+
+        if changes:
+            db.session.execute(invoices.update()
+                                       .where(invoices.c.id == bindparam('invoice_id'))
+                                       .values(amount_paid=bindparam('new_amount_paid'),
+                                               paid=bindparam('new_paid'),
+                                               paid_date=bindparam('new_paid_date')),
+                               changes)
+            updated += len(changes)
+    return updated
+
+
+"""
+ The full re-allocation: allocates the payments of every policy (or only those in policy_ids)
+ again, chunk_size policies per transaction. Returns the number of invoices that changed.
+"""
+def reallocate_all(policy_ids=None, chunk_size=REALLOCATE_CHUNK_SIZE):
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+
+    updated = 0
+    for chunk in chunks(policy_ids, chunk_size):
+        try:
+            updated += reallocate(chunk)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+    print "Payments reallocated!"
+    return updated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Allocate every payment to its invoices again.')
+    parser.add_argument('policy_ids', nargs='*', type=int, help='only these policies (default: all)')
+    parser.add_argument('--chunk-size', type=int, default=REALLOCATE_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    updated = reallocate_all(args.policy_ids or None, args.chunk_size)
+    print "%d invoices updated in %.1fs" % (updated, time.time() - started)
+    return 0
@@ -0,0 +1,212 @@
+#!/user/bin/env python2.7
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from columnar import COLUMNS, column_path, numpy, require_numpy
+from tools import PolicyAccounting
+
+
+"""
+#######################################################
+Portfolio analytics over a columnar export of the book
+(see accounting.columnar).
+
+Balances, premium billed and collected, and delinquency
+are worked out for every policy and every date of a grid
+at once: the amounts are sorted by (policy, day), summed
+cumulatively, and the running total of any policy on any
+day is found with searchsorted, so nothing is done a
+policy or a date at a time in Python.
+
+The rules are PolicyAccounting's: a balance counts the
+invoices billed and the payments made up to and including
+the day, and a policy is delinquent on a day when its
+payments by then don't cover the invoices due by then
+(evaluate_cancellation_pending_due_to_non_pay).
+#######################################################
+"""
+
+# policy positions are combined with day numbers into one sort key, days stay below this
+_DAY_SPAN = 1 << 22
+
+# policies worked on at a time by portfolio, which keeps a few (policies, dates) arrays
+PORTFOLIO_BLOCK_SIZE = 100000
+
+PORTFOLIO_COLUMNS = ['date', 'in_force', 'billed', 'collected', 'outstanding', 'delinquent', 'delinquency_rate']
+
+
+class Book(object):
+    """
+     The column arrays of an export, memory-mapped read only. Each table is a dict of
+     column name to array, e.g. book.invoices['amount_due'].
+    """
+    def __init__(self, directory):
+        require_numpy()
+        with open(os.path.join(directory, 'meta.json'), 'rb') as meta:
+            self.meta = json.load(meta)
+        for table in COLUMNS:
+            setattr(self, table, dict((name, numpy.load(column_path(directory, table, name), mmap_mode='r'))
+                                      for name, _ in COLUMNS[table]))
+
+    @property
+    def policy_ids(self):
+        return self.policies['id']
+
+
+class _RunningTotals(object):
+    """
+     Running totals of amounts per policy by day, for looking up many (policy, day) pairs at
+     once. policy holds policy positions, day day numbers and amount the amounts.
+    """
+    def __init__(self, policy, day, amount):
+        keys = policy.astype('int64') * _DAY_SPAN + day
+        order = numpy.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.sums = numpy.concatenate(([0], numpy.cumsum(amount[order], dtype='int64')))
+
+    """
+     Returns a (len(policies), len(days)) array of the total per policy up to and including
+     each day.
+    """
+    def through(self, policies, days):
+        policies = numpy.asarray(policies, dtype='int64')
+        first = self.sums[numpy.searchsorted(self.keys, policies * _DAY_SPAN, side='left')]
+        keys = policies[:, None] * _DAY_SPAN + numpy.asarray(days, dtype='int64')[None, :]
+        return self.sums[numpy.searchsorted(self.keys, keys, side='right')] - first[:, None]
+
+
+def _days(dates):
+    return numpy.array([date_value.toordinal() for date_value in dates], dtype='int64')
+
+
+def _positions(book, policy_ids):
+    if policy_ids is None:
+        return numpy.arange(len(book.policy_ids))
+    return numpy.searchsorted(book.policy_ids, policy_ids)
+
+
+"""
+ Returns the last day of every month from the month of start to the month of end.
+"""
+def month_ends(start, end):
+    dates = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        dates.append(date(year, month, 1) - timedelta(days=1))
+    return dates
+
+
+"""
+ Returns a (policies, dates) array of the balance of every policy (or only those in
+ policy_ids, in that order) at the end of each date, the same as return_account_balance.
+"""
+def balances(book, dates, policy_ids=None):
+    positions = _positions(book, policy_ids)
+    days = _days(dates)
+    billed = _RunningTotals(book.invoices['policy'], book.invoices['bill_day'], book.invoices['amount_due'])
+    paid = _RunningTotals(book.payments['policy'], book.payments['day'], book.payments['amount'])
+    return billed.through(positions, days) - paid.through(positions, days)
+
+
+"""
+ Returns one row of portfolio figures for each date:
+     date        - the date
+     in_force    - policies in effect and not canceled by then
+     billed      - premium billed up to the date, all policies
+     collected   - payments received up to the date, all policies
+     outstanding - the total balance of the policies in force
+     delinquent  - policies in force whose payments don't cover what was due by then
+     delinquency_rate - delinquent / in_force
+"""
+def portfolio(book, dates, block_size=PORTFOLIO_BLOCK_SIZE):
+    days = _days(dates)
+    invoices, payments, policies = book.invoices, book.payments, book.policies
+    billed = _RunningTotals(invoices['policy'], invoices['bill_day'], invoices['amount_due'])
+    due = _RunningTotals(invoices['policy'], invoices['due_day'], invoices['amount_due'])
+    paid = _RunningTotals(payments['policy'], payments['day'], payments['amount'])
+
+    totals = dict((name, numpy.zeros(len(dates), dtype='int64'))
+                  for name in ('in_force', 'billed', 'collected', 'outstanding', 'delinquent'))
+    for start in range(0, len(book.policy_ids), block_size):
+        positions = numpy.arange(start, min(start + block_size, len(book.policy_ids)))
+        block_billed = billed.through(positions, days)
+        block_paid = paid.through(positions, days)
+
+        cancel_day = policies['cancel_day'][positions].astype('int64')[:, None]
+        in_force = (policies['effective_day'][positions].astype('int64')[:, None] <= days[None, :]) & \
+                   ((cancel_day == 0) | (cancel_day > days[None, :]))
+        totals['in_force'] += in_force.sum(axis=0)
+        totals['billed'] += block_billed.sum(axis=0)
+        totals['collected'] += block_paid.sum(axis=0)
+        totals['outstanding'] += numpy.where(in_force, block_billed - block_paid, 0).sum(axis=0)
+        totals['delinquent'] += (in_force & (block_paid < due.through(positions, days))).sum(axis=0)
+
+    rows = []
+    for index, date_value in enumerate(dates):
+        row = dict((name, int(values[index])) for name, values in totals.items())
+        row['date'] = date_value
+        row['delinquency_rate'] = float(row['delinquent']) / row['in_force'] if row['in_force'] else 0.0
+        rows.append(row)
+    return rows
+
+"""
+ Checks balances against PolicyAccounting.return_account_balance for sample_size policies
+ picked at random (with seed) on every date. Reads the database the export was made from.
+ Returns (policy_id, date, expected, computed) for every disagreement.
+"""
+def check_sample(book, dates, sample_size=20, seed=0):
+    policy_ids = sorted(random.Random(seed).sample(list(book.policy_ids),
+                                                   min(sample_size, len(book.policy_ids))))
+    computed = balances(book, dates, policy_ids)
+    mismatches = []
+    for row, policy_id in enumerate(policy_ids):
+        pa = PolicyAccounting(int(policy_id))
+        for column, date_value in enumerate(dates):
+            expected = pa.return_account_balance(date_value)
+            if expected != computed[row, column]:
+                mismatches.append((int(policy_id), date_value, expected, int(computed[row, column])))
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Month-end portfolio figures from a columnar export.')
+    parser.add_argument('directory', help='written by export_columns.py')
+    parser.add_argument('--start', required=True, help='YYYY-MM-DD, first month')
+    parser.add_argument('--end', required=True, help='YYYY-MM-DD, last month')
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='check the balances of N random policies against the database')
+    parser.add_argument('--output', help='write the figures to this CSV file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    dates = month_ends(datetime.strptime(args.start, '%Y-%m-%d').date(),
+                       datetime.strptime(args.end, '%Y-%m-%d').date())
+    book = Book(args.directory)
+
+    started = time.time()
+    rows = portfolio(book, dates)
+    elapsed = time.time() - started
+
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(output, PORTFOLIO_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, date=row['date'].isoformat()))
+    finally:
+        if args.output:
+            output.close()
+    print >> sys.stderr, "%d policies over %d month ends in %.2fs" % (len(book.policy_ids), len(dates), elapsed)
+
+    if args.check:
+        mismatches = check_sample(book, dates, args.check)
+        print >> sys.stderr, "%d mismatches against return_account_balance" % len(mismatches)
+        return 1 if mismatches else 0
+    return 0
@@ -0,0 +1,213 @@
+#!/user/bin/env python2.7
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+
+from sqlalchemy import func, literal_column, select, union_all
+
+from accounting import db, settings
+from models import ArchivedInvoice, ArchivedPayment, CanceledPolicy, Invoice, Payment, Policy, PolicyEvent
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+from ledger import bump_versions
+
+
+"""
+#######################################################
+Hot/cold archival.
+
+Deleted invoices, and every invoice and payment of a
+policy that was closed (Canceled, or Expired at the end of
+its one year term) more than ARCHIVE_RETENTION_DAYS ago,
+are moved out of the invoices and payments tables into
+invoices_archive and payments_archive, keeping their ids.
+Each chunk of rows is moved in its own transaction.
+
+A policy whose history was moved is marked with
+archived_on. Reads of its account (PolicyAccounting, the
+snapshots, the views) go to the archive tables for that
+policy only, the rest never look at them, except for the
+policy page and the statements, which also list the
+deleted invoices of live policies that were moved. The
+ledger is left in place, so ledger balances don't change.
+#######################################################
+"""
+
+# rows (deleted invoices) or policies moved per transaction
+ARCHIVE_CHUNK_SIZE = 1000
+
+# how long a policy's term runs, it is Expired from then on
+POLICY_TERM = relativedelta(years=1)
+
+
+"""
+ The model holding the invoices of policy: ArchivedInvoice once its history was archived,
+ Invoice otherwise.
+"""
+def invoice_model(policy):
+    return ArchivedInvoice if policy.archived_on else Invoice
+
+
+"""
+ The model holding the payments of policy, like invoice_model.
+"""
+def payment_model(policy):
+    return ArchivedPayment if policy.archived_on else Payment
+
+
+def _billed(model, policy_id, end):
+    return select([model.id, model.bill_date, model.due_date, model.cancel_date, model.amount_due,
+                   model.deleted])\
+        .where(model.policy_id == policy_id)\
+        .where(model.bill_date <= end)
+
+
+"""
+ Returns the invoices of policy billed on or before end, by bill date, as rows with the
+ columns of Invoice. Those of an archived policy are all in invoices_archive. A live policy's
+ are in the invoices table, except for the deleted ones archive_deleted_invoices has moved out,
+ so both tables are read in one query.
+"""
+def billed_invoices(policy, end):
+    rows = _billed(ArchivedInvoice, policy.id, end)
+    if not policy.archived_on:
+        rows = union_all(_billed(Invoice, policy.id, end), rows)
+    return db.session.execute(rows.order_by(literal_column('bill_date'), literal_column('id'))).fetchall()
+
+
+"""
+ Returns the ids of the policies in policy_ids whose history is in the archive tables.
+"""
+def archived_ids(policy_ids):
+    archived = set()
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        archived.update(row.id for row in db.session.query(Policy.id)
+                                                    .filter(Policy.id.in_(chunk))
+                                                    .filter(Policy.archived_on != None))
+    return archived
+
+
+def _move(model, archive_model, where):
+    # copies the rows matching where into the archive table and deletes them from the hot one
+    table = model.__table__
+    rows = [dict(row) for row in db.session.execute(table.select().where(where))]
+    if rows:
+        db.session.execute(archive_model.__table__.insert(), rows)
+        db.session.execute(table.delete().where(where))
+    return len(rows)
+
+
+"""
+ Returns the ids of the policies closed on or before cutoff whose history hasn't been archived
+ yet: Canceled policies by their last cancellation_date, Expired ones by the end of their term.
+"""
+def closed_policy_ids(cutoff):
+    canceled = db.session.query(Policy.id)\
+                         .join(CanceledPolicy, CanceledPolicy.policy_id == Policy.id)\
+                         .filter(Policy.status == u'Canceled')\
+                         .filter(Policy.archived_on == None)\
+                         .group_by(Policy.id)\
+                         .having(func.max(CanceledPolicy.cancellation_date) <= cutoff)
+    expired = db.session.query(Policy.id)\
+                        .filter(Policy.status == u'Expired')\
+                        .filter(Policy.archived_on == None)\
+                        .filter(Policy.effective_date <= cutoff - POLICY_TERM)
+    return sorted(set(row.id for row in canceled) | set(row.id for row in expired))
+
+
+"""
+ Moves every deleted invoice (of the policies in policy_ids, or of the whole book) to
+ invoices_archive, chunk_size invoices per transaction. Returns the number moved.
+"""
+def archive_deleted_invoices(chunk_size=ARCHIVE_CHUNK_SIZE, policy_ids=None):
+    invoices = Invoice.__table__
+    if policy_ids is None:
+        policy_chunks = [None]
+    else:
+        policy_chunks = chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE)
+
+    moved = 0
+    for policy_chunk in policy_chunks:
+        deleted = select([invoices.c.id, invoices.c.policy_id])\
+            .where(invoices.c.deleted == True)\
+            .order_by(invoices.c.id)\
+            .limit(chunk_size)
+        if policy_chunk is not None:
+            deleted = deleted.where(invoices.c.policy_id.in_(policy_chunk))
+
+        while True:
+            chunk = db.session.execute(deleted).fetchall()
+            if not chunk:
+                break
+            try:
+                moved += _move(Invoice, ArchivedInvoice, invoices.c.id.in_([row.id for row in chunk]))
+                # the policy pages list deleted invoices
+                bump_versions(set(row.policy_id for row in chunk))
+                db.session.commit()
+            except:
+                db.session.rollback()
+                raise
+    return moved
+
+
+"""
+ Moves the invoices and payments of every policy in policy_ids to the archive tables and marks
+ the policies archived on date_cursor, chunk_size policies per transaction. Returns the number
+ of (invoices, payments) moved.
+"""
+def archive_policies(policy_ids, date_cursor, chunk_size=ARCHIVE_CHUNK_SIZE):
+    invoices = payments = 0
+    for chunk in chunks(policy_ids, min(chunk_size, IN_CLAUSE_CHUNK_SIZE)):
+        try:
+            invoices += _move(Invoice, ArchivedInvoice, Invoice.policy_id.in_(chunk))
+            payments += _move(Payment, ArchivedPayment, Payment.policy_id.in_(chunk))
+            db.session.execute(PolicyEvent.__table__.delete().where(PolicyEvent.policy_id.in_(chunk)))
+            db.session.execute(Policy.__table__.update()
+                                               .where(Policy.id.in_(chunk))
+                                               .values(archived_on=date_cursor,
+                                                       version=Policy.version + 1))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+    return invoices, payments
+
+
+"""
+ The archival job: moves the deleted invoices, then the history of every policy closed more
+ than retention_days (ARCHIVE_RETENTION_DAYS if None) before date_cursor. Returns a report of
+ what was moved.
+"""
+def archive(date_cursor=None, retention_days=None, chunk_size=ARCHIVE_CHUNK_SIZE):
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if retention_days is None:
+        retention_days = settings['ARCHIVE_RETENTION_DAYS']
+    started = time.time()
+
+    deleted = archive_deleted_invoices(chunk_size)
+    policy_ids = closed_policy_ids(date_cursor - timedelta(days=retention_days))
+    invoices, payments = archive_policies(policy_ids, date_cursor, chunk_size)
+
+    return {'date': date_cursor,
+            'deleted_invoices': deleted,
+            'policies': len(policy_ids),
+            'invoices': invoices,
+            'payments': payments,
+            'elapsed': time.time() - started}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move deleted invoices and closed policies to the archive tables.')
+    parser.add_argument('--date', help='YYYY-MM-DD (default: today)')
+    parser.add_argument('--retention-days', type=int,
+                        help='archive policies closed longer ago than this (default: ARCHIVE_RETENTION_DAYS)')
+    parser.add_argument('--chunk-size', type=int, default=ARCHIVE_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    date_cursor = datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else None
+    report = archive(date_cursor, args.retention_days, args.chunk_size)
+    print ("%(deleted_invoices)d deleted invoices archived, %(policies)d closed policies archived "
+           "(%(invoices)d invoices, %(payments)d payments) in %(elapsed).1fs" % report)
+    return 0
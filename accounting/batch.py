@@ -0,0 +1,154 @@
+#!/user/bin/env python2.7
+
+from contextlib import contextmanager
+from threading import local
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from accounting import db
+
+
+"""
+#######################################################
+Unit-of-work batching for PolicyAccounting.
+
+On its own every PolicyAccounting write commits, one
+fsync for each payment, cancellation or re-invoicing.
+Inside accounting_batch the writes are only flushed and
+the batch commits them every commit_every operations (or
+once at the end), so a script working through many
+policies pays for a handful of commits, and whatever
+hasn't been committed yet is rolled back if it fails.
+
+Each policy's writes can be wrapped in batch.savepoint,
+which rolls back just that policy when it raises and lets
+the rest of the batch go on:
+
+    with accounting_batch(commit_every=500) as batch:
+        for policy_id in policy_ids:
+            with batch.savepoint(policy_id):
+                PolicyAccounting(policy_id).make_payment(...)
+
+    batch.failed  # [(policy_id, exception), ...]
+#######################################################
+"""
+
+_local = local()
+
+
+# pysqlite opens its own transactions and commits them before any SAVEPOINT, so while a batch
+# is open it is told to keep out of it and the transaction begins with an explicit BEGIN
+def _sqlite_begin(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    dbapi_connection = conn.connection.connection
+    if current_batch() is not None:
+        dbapi_connection.isolation_level = None
+        conn.execute('BEGIN')
+    elif dbapi_connection.isolation_level is None:
+        dbapi_connection.isolation_level = ''
+
+event.listen(Engine, 'begin', _sqlite_begin)
+
+
+class AccountingBatch(object):
+    """
+     The writes made inside one accounting_batch. commit_every is the number of operations
+     between commits, None to commit only once the batch is over.
+    """
+    def __init__(self, commit_every=None):
+        self.commit_every = commit_every
+        self.operations = 0
+        self.commits = 0
+        self.failed = []
+        self._uncommitted = 0
+        self._savepoints = 0
+
+    """
+     Takes the place of the commit that ends a PolicyAccounting write: flushes it and commits
+     if commit_every operations are waiting and no savepoint is open.
+    """
+    def commit(self):
+        db.session.flush()
+        self.operations += 1
+        self._uncommitted += 1
+        if not self._savepoints and self.commit_every and self._uncommitted >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        db.session.commit()
+        self.commits += 1
+        self._uncommitted = 0
+
+    """
+     Runs the block in a savepoint. If it raises, only its writes are rolled back and the
+     exception is recorded in failed along with key instead of being raised.
+    """
+    @contextmanager
+    def savepoint(self, key=None):
+        db.session.begin_nested()
+        self._savepoints += 1
+        try:
+            yield
+        except Exception as e:
+            self._savepoints -= 1
+            db.session.rollback()
+            self.failed.append((key, e))
+        else:
+            self._savepoints -= 1
+            db.session.commit()
+            if not self._savepoints and self.commit_every and self._uncommitted >= self.commit_every:
+                self._commit()
+
+
+"""
+ Returns the batch open on this thread, or None.
+"""
+def current_batch():
+    return getattr(_local, 'batch', None)
+
+
+"""
+ Defers the commits of PolicyAccounting writes made on this thread to the batch it yields (see
+ AccountingBatch), committing whatever is left when the block ends or rolling it back if the
+ block raises. Anything the session holds when the batch opens is committed first, so the
+ batch starts a transaction of its own. A batch opened inside another one is the same batch.
+"""
+@contextmanager
+def accounting_batch(commit_every=None):
+    batch = current_batch()
+    if batch is not None:
+        yield batch
+        return
+
+    db.session.commit()
+    batch = _local.batch = AccountingBatch(commit_every)
+    try:
+        yield batch
+        batch._commit()
+    except:
+        db.session.rollback()
+        raise
+    finally:
+        _local.batch = None
+
+
+"""
+ Commits the session, or leaves it to the batch when there is one.
+"""
+def commit():
+    batch = current_batch()
+    if batch is None:
+        db.session.commit()
+    else:
+        batch.commit()
+
+
+"""
+ Rolls the session back after a failed write. Inside a batch the exception is left to the
+ savepoint or the batch around it, which know how much to roll back.
+"""
+def rollback():
+    if current_batch() is None:
+        db.session.rollback()
@@ -0,0 +1,229 @@
+#!/user/bin/env python2.7
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date
+
+from sqlalchemy import event, func
+
+from accounting import db
+from web import app
+from models import Contact, Policy
+from synthetic import BOOK_SIZES, generate_book
+from tools import PolicyAccounting
+# registers the routes the test client asks for
+import views
+
+
+"""
+#######################################################
+Performance benchmarks for PolicyAccounting and the
+policy view.
+
+For each book size a synthetic database is generated once
+(and kept in the data directory for later runs), copied
+to a scratch file, and every operation is timed against a
+seeded sample of its policies. The number of SQL
+statements each call runs is counted as well. Results are
+written as JSON and can be checked against a saved
+baseline to catch regressions.
+#######################################################
+"""
+
+# the date the generated books are built up to and questions are asked about
+AS_OF = date(2016, 1, 1)
+
+# a result counts as a regression when it is this much slower than the baseline
+DEFAULT_TOLERANCE = 0.25
+
+
+class StatementCounter(object):
+    """
+     Counts the statements sent to every engine it is attached to.
+    """
+    def __init__(self):
+        self.count = 0
+        self._engines = set()
+
+    def attach(self, engine):
+        if engine not in self._engines:
+            event.listen(engine, 'before_cursor_execute', self._count)
+            self._engines.add(engine)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+statements = StatementCounter()
+
+
+@contextmanager
+def _quiet():
+    # PolicyAccounting and the views print as they go, keep that out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def use_database(path):
+    db.session.remove()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(path)
+    statements.attach(db.engine)
+
+
+"""
+ Returns the path of the generated book of num_policies, generating it first if the data
+ directory does not have it yet.
+"""
+def book_path(num_policies, seed, data_dir):
+    path = os.path.join(data_dir, 'book_%d_seed%d.sqlite' % (num_policies, seed))
+    if not os.path.exists(path):
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        print "Generating %d policies into %s..." % (num_policies, path)
+        started = time.time()
+        use_database(path + '.partial')
+        db.create_all()
+        generate_book(num_policies, seed=seed, as_of=AS_OF)
+        db.session.remove()
+        os.rename(path + '.partial', path)
+        print "Generated in %.1fs" % (time.time() - started)
+    return path
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _time_calls(operation, policy_ids):
+    timings = []
+    statements_before = statements.count
+    for policy_id in policy_ids:
+        started = time.time()
+        with _quiet():
+            operation(policy_id)
+        timings.append((time.time() - started) * 1000)
+        db.session.remove()
+
+    timings.sort()
+    return {'calls': len(timings),
+            'total_ms': sum(timings),
+            'mean_ms': sum(timings) / len(timings),
+            'p50_ms': _percentile(timings, 0.50),
+            'p95_ms': _percentile(timings, 0.95),
+            'statements_per_call': float(statements.count - statements_before) / len(timings)}
+
+
+def _operations(client):
+    agent_id = Contact.query.filter_by(role=u'Agent').first().id
+    date_text = AS_OF.strftime('%Y-%m-%d')
+
+    return [
+        ('PolicyAccounting', lambda policy_id: PolicyAccounting(policy_id)),
+        ('return_account_balance',
+         lambda policy_id: PolicyAccounting(policy_id).return_account_balance(AS_OF)),
+        ('evaluate_cancellation_pending_due_to_non_pay',
+         lambda policy_id: PolicyAccounting(policy_id).evaluate_cancellation_pending_due_to_non_pay(AS_OF)),
+        ('make_payment',
+         lambda policy_id: PolicyAccounting(policy_id).make_payment(agent_id, AS_OF, 10)),
+        ('evaluate_cancel',
+         lambda policy_id: PolicyAccounting(policy_id).evaluate_cancel(AS_OF)),
+        ('policy_info_view',
+         lambda policy_id: client.post('/policyInfo', data={'policy_number': policy_id,
+                                                            'invoice_date': date_text})),
+    ]
+
+
+"""
+ Benchmarks every operation against a scratch copy of the generated book of num_policies,
+ using samples policies picked with seed. Returns {operation: timings}.
+"""
+def run_size(num_policies, seed, samples, data_dir):
+    scratch = os.path.join(data_dir, 'scratch.sqlite')
+    shutil.copyfile(book_path(num_policies, seed, data_dir), scratch)
+    use_database(scratch)
+
+    max_id = db.session.query(func.max(Policy.id)).scalar()
+    rng = random.Random(seed)
+    policy_ids = [rng.randint(1, max_id) for _ in range(samples)]
+
+    results = {}
+    client = app.test_client()
+    for name, operation in _operations(client):
+        results[name] = _time_calls(operation, policy_ids)
+        print "  %-46s %9.2fms mean %9.2fms p95 %7.1f statements" % (
+            name, results[name]['mean_ms'], results[name]['p95_ms'],
+            results[name]['statements_per_call'])
+
+    db.session.remove()
+    os.remove(scratch)
+    return results
+
+
+"""
+ Compares results against a baseline (both as written by run_benchmarks) and returns a
+ description of every operation that got slower by more than tolerance or runs more
+ statements than it used to.
+"""
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for size, operations in sorted(results['sizes'].items()):
+        for name, current in sorted(operations.items()):
+            previous = baseline.get('sizes', {}).get(size, {}).get(name)
+            if not previous:
+                continue
+            if current['mean_ms'] > previous['mean_ms'] * (1 + tolerance):
+                regressions.append('%s @ %s: %.2fms mean, baseline %.2fms' % (
+                    name, size, current['mean_ms'], previous['mean_ms']))
+            if current['statements_per_call'] > previous['statements_per_call']:
+                regressions.append('%s @ %s: %.1f statements per call, baseline %.1f' % (
+                    name, size, current['statements_per_call'], previous['statements_per_call']))
+    return regressions
+
+
+def run_benchmarks(sizes, seed=0, samples=200, data_dir='benchmarks'):
+    results = {'seed': seed, 'samples': samples, 'as_of': str(AS_OF), 'sizes': {}}
+    for num_policies in sizes:
+        print "Book of %d policies:" % num_policies
+        results['sizes'][str(num_policies)] = run_size(num_policies, seed, samples, data_dir)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark PolicyAccounting and the policy view.')
+    parser.add_argument('--sizes', nargs='+', default=['small'],
+                        help='book sizes, either %s or a number of policies' % '/'.join(sorted(BOOK_SIZES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--samples', type=int, default=200, help='policies timed per operation')
+    parser.add_argument('--data-dir', default='benchmarks', help='where generated books are kept')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    sizes = [BOOK_SIZES[size] if size in BOOK_SIZES else int(size) for size in args.sizes]
+    results = run_benchmarks(sizes, args.seed, args.samples, args.data_dir)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print "REGRESSION: " + regression
+        if regressions:
+            return 1
+    return 0
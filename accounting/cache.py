@@ -0,0 +1,73 @@
+#!/user/bin/env python2.7
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+"""
+#######################################################
+A small in-process LRU cache with a time-to-live, used by
+the views to keep rendered policy pages.
+
+Callers put the policy's version in the key, and every
+write to a policy bumps its version (see ledger), so
+entries for a policy stop being used as soon as it
+changes. Stale entries are never looked up again and
+fall out of the cache as newer ones push them out.
+#######################################################
+"""
+
+
+class LRUCache(object):
+    """
+     Holds up to max_size values for at most ttl seconds each, evicting the least recently
+     used value when full. Counts hits and misses so the size can be tuned.
+    """
+    def __init__(self, max_size=1024, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    """
+     Returns the value stored under key, or None if there isn't one or it has expired.
+    """
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._clock():
+                self.misses += 1
+                return None
+            # re-inserting moves it to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self._clock() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl}
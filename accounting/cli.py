@@ -0,0 +1,122 @@
+#!/user/bin/env python2.7
+
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+
+"""
+#######################################################
+The accounting command line, for cron jobs and scripts.
+
+    accounting_cli.py rebuild-db
+    accounting_cli.py upgrade-db
+    accounting_cli.py balance 12 13 --date 2016-01-01
+    accounting_cli.py evaluate-cancel --date 2016-01-01
+    accounting_cli.py import-payments payments.csv
+
+Only the settings and the database are set up, Flask and
+the views are never imported, and each command imports
+the modules it runs when it runs, so a command costs no
+more to start than what it uses. --database points a
+command at another SQLite file; without it the
+accounting.sqlite next to the package is used, wherever
+the command is run from. A
+database made before the current models (the
+accounting.sqlite in the repo is one) has to be brought
+up to date with upgrade-db before the other commands can
+read it.
+#######################################################
+"""
+
+
+def _parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def _rebuild_db(args):
+    from tools import build_or_refresh_db
+    build_or_refresh_db()
+    return 0
+
+
+def _upgrade_db(args):
+    from tools import upgrade_db
+    upgrade_db()
+    return 0
+
+
+def _balance(args):
+    from tools import balances_as_of
+    balances = balances_as_of(args.date, args.policy_ids)
+    for policy_id in args.policy_ids:
+        print "%d %d" % (policy_id, balances[policy_id])
+    return 0
+
+
+def _evaluate_cancel(args):
+    from tools import sweep_cancellations
+    report = sweep_cancellations(args.date, dry_run=args.dry_run, policy_ids=args.policy_ids or None)
+    print "%(canceled)d of %(evaluated)d Active policies %(verb)s as of %(date)s in %(elapsed).2fs" % dict(
+        report, verb='would cancel' if args.dry_run else 'canceled')
+    for policy_id in report['policy_ids']:
+        print policy_id
+    return 0
+
+
+def _import_payments(args):
+    from payment_import import IMPORT_CHUNK_SIZE, import_payments
+    report = import_payments(args.path, args.rejects or args.path + '.rejects.csv',
+                             args.chunk_size or IMPORT_CHUNK_SIZE)
+    print "%(accepted)d payments imported, %(rejected)d rejected in %(elapsed).1fs" % report
+    return 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Accounting jobs without the web app.')
+    parser.add_argument('--database', help='SQLite file to use (default: SQLALCHEMY_DATABASE_URI of the config)')
+    commands = parser.add_subparsers(title='commands')
+
+    command = commands.add_parser('rebuild-db', help='drop the tables and load the initial data again')
+    command.set_defaults(run=_rebuild_db)
+
+    command = commands.add_parser('upgrade-db', help='add the tables and columns missing from the database, '
+                                                     'keeping its data')
+    command.set_defaults(run=_upgrade_db)
+
+    command = commands.add_parser('balance', help='print the account balance of policies')
+    command.add_argument('policy_ids', nargs='+', type=int)
+    command.add_argument('--date', type=_parse_date, help='YYYY-MM-DD (default: today)')
+    command.set_defaults(run=_balance)
+
+    command = commands.add_parser('evaluate-cancel',
+                                  help='cancel the Active policies with an invoice unpaid on its cancel date')
+    command.add_argument('policy_ids', nargs='*', type=int, help='policies to check (default: every policy)')
+    command.add_argument('--date', type=_parse_date, help='YYYY-MM-DD (default: today)')
+    command.add_argument('--dry-run', action='store_true', help='only list the policies that would cancel')
+    command.set_defaults(run=_evaluate_cancel)
+
+    command = commands.add_parser('import-payments', help='import a CSV file of payments')
+    command.add_argument('path')
+    command.add_argument('--rejects', help='where to write rejected rows (default: <path>.rejects.csv)')
+    command.add_argument('--chunk-size', type=int, help='rows per transaction (default: IMPORT_CHUNK_SIZE)')
+    command.set_defaults(run=_import_payments)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    if args.database:
+        from accounting import configure
+        configure({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(args.database)})
+    try:
+        return args.run(args)
+    except OperationalError as error:
+        # SQLite's wording for a database made before the models it is read with
+        if 'no such column' not in str(error) and 'no such table' not in str(error):
+            raise
+        print >> sys.stderr, "The database is older than the models (%s), run upgrade-db first." % error.orig
+        return 1
@@ -0,0 +1,193 @@
+#!/user/bin/env python2.7
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:  # only the columnar export and accounting.analytics need it
+    numpy = None
+
+from accounting import db
+from models import ArchivedInvoice, ArchivedPayment, CanceledPolicy, Invoice, Payment, Policy
+
+
+"""
+#######################################################
+Columnar export of the book for portfolio analytics.
+
+Every column of the policies, invoices and payments is
+written to its own typed .npy array in a directory, so it
+can be memory-mapped and worked on whole with NumPy (see
+accounting.analytics) instead of a row at a time through
+PolicyAccounting.
+
+    policies.id, .effective_day, .status, .annual_premium,
+             .cancel_day
+    invoices.policy, .bill_day, .due_day, .cancel_day,
+             .amount_due
+    payments.policy, .day, .amount
+
+Dates are day numbers (date.toordinal), 0 for none.
+invoices.policy and payments.policy are the policy's
+position in the policies arrays, which are in id order.
+Deleted invoices are left out and archived rows are
+included. meta.json records the row counts and codes.
+
+NumPy is optional, only this export and the analytics
+need it.
+#######################################################
+"""
+
+POLICY_STATUSES = (u'Active', u'Canceled', u'Expired')
+
+COLUMNS = {'policies': (('id', 'int64'),
+                        ('effective_day', 'int32'),
+                        ('status', 'int8'),  # position in POLICY_STATUSES
+                        ('annual_premium', 'int64'),
+                        ('cancel_day', 'int32')),  # last cancellation_date
+           'invoices': (('policy', 'int32'),
+                        ('bill_day', 'int32'),
+                        ('due_day', 'int32'),
+                        ('cancel_day', 'int32'),
+                        ('amount_due', 'int64')),
+           'payments': (('policy', 'int32'),
+                        ('day', 'int32'),
+                        ('amount', 'int64'))}
+
+# rows read from the database and written to the arrays at a time
+EXPORT_CHUNK_SIZE = 50000
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError("The columnar export and analytics need NumPy (pip install numpy)")
+
+
+def column_path(directory, table, column):
+    return os.path.join(directory, '%s.%s.npy' % (table, column))
+
+
+def _day(value):
+    return value.toordinal() if value else 0
+
+
+class _ColumnWriter(object):
+    """
+     Fills the memory-mapped arrays of one table a chunk of rows at a time.
+    """
+    def __init__(self, directory, table, count):
+        self.columns = [(name, open_memmap(column_path(directory, table, name), mode='w+',
+                                           dtype=dtype, shape=(count,)))
+                        for name, dtype in COLUMNS[table]]
+        self.offset = 0
+
+    def write(self, values):
+        # values holds a list per column, all the same length
+        count = len(values[0])
+        for (_, array), column in zip(self.columns, values):
+            array[self.offset:self.offset + count] = column
+        self.offset += count
+
+    def close(self):
+        for _, array in self.columns:
+            array.flush()
+
+
+def _chunked_rows(query, chunk_size):
+    result = db.session.execute(query.execution_options(stream_results=True))
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _export_policies(directory, chunk_size):
+    canceled_on = select([CanceledPolicy.policy_id, func.max(CanceledPolicy.cancellation_date)
+                          .label('cancellation_date')])\
+        .group_by(CanceledPolicy.policy_id)\
+        .alias('canceled_on')
+    policies = select([Policy.id, Policy.effective_date, Policy.status, Policy.annual_premium,
+                       canceled_on.c.cancellation_date])\
+        .select_from(Policy.__table__.outerjoin(canceled_on, canceled_on.c.policy_id == Policy.id))\
+        .order_by(Policy.id)
+
+    count = db.session.query(func.count(Policy.id)).scalar()
+    writer = _ColumnWriter(directory, 'policies', count)
+    for rows in _chunked_rows(policies, chunk_size):
+        writer.write([[row[0] for row in rows],
+                      [_day(row[1]) for row in rows],
+                      [POLICY_STATUSES.index(row[2]) for row in rows],
+                      [row[3] for row in rows],
+                      [_day(row[4]) for row in rows]])
+    writer.close()
+    return numpy.load(column_path(directory, 'policies', 'id'), mmap_mode='r')
+
+
+def _export_rows(directory, table, sources, policy_ids, chunk_size):
+    # sources are (count query, rows query) pairs whose rows start with the policy id
+    writer = _ColumnWriter(directory, table, sum(count.scalar() for count, _ in sources))
+    for _, query in sources:
+        for rows in _chunked_rows(query, chunk_size):
+            values = [list(column) for column in zip(*rows)]
+            values[0] = numpy.searchsorted(policy_ids, values[0])
+            for index in range(1, len(values) - 1):
+                values[index] = [_day(value) for value in values[index]]
+            writer.write(values)
+    writer.close()
+    return writer.offset
+
+
+"""
+ Writes the policies, invoices and payments as .npy column arrays into directory (created if
+ need be), reading chunk_size rows at a time. Returns the row counts.
+"""
+def export_book(directory, chunk_size=EXPORT_CHUNK_SIZE):
+    require_numpy()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    policy_ids = _export_policies(directory, chunk_size)
+
+    invoice_sources = []
+    for model in (Invoice, ArchivedInvoice):
+        invoice_sources.append((
+            db.session.query(func.count(model.id)).filter(model.deleted == False),
+            select([model.policy_id, model.bill_date, model.due_date, model.cancel_date, model.amount_due])
+            .where(model.deleted == False)))
+    payment_sources = []
+    for model in (Payment, ArchivedPayment):
+        payment_sources.append((
+            db.session.query(func.count(model.id)),
+            select([model.policy_id, model.transaction_date, model.amount_paid])))
+
+    counts = {'policies': len(policy_ids),
+              'invoices': _export_rows(directory, 'invoices', invoice_sources, policy_ids, chunk_size),
+              'payments': _export_rows(directory, 'payments', payment_sources, policy_ids, chunk_size)}
+
+    with open(os.path.join(directory, 'meta.json'), 'wb') as meta:
+        json.dump({'exported_at': datetime.now().isoformat(),
+                   'counts': counts,
+                   'columns': dict((table, [name for name, _ in columns]) for table, columns in COLUMNS.items()),
+                   'statuses': POLICY_STATUSES}, meta, indent=2)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the book as .npy column arrays.')
+    parser.add_argument('directory')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    counts = export_book(args.directory, args.chunk_size)
+    print "%d policies, %d invoices and %d payments exported in %.1fs" % (
+        counts['policies'], counts['invoices'], counts['payments'], time.time() - started)
+    return 0
@@ -1,4 +1,39 @@
 import os
 
 SECRET_KEY = "ITS_A_SECRET_TO_EVERYBODY"
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+# the accounting.sqlite next to the accounting package, wherever the app is run from.
+# ACCOUNTING_DATABASE_URI (or ACCOUNTING_SQLALCHEMY_DATABASE_URI) points the app at another
+# database, e.g. a generated benchmark book.
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "accounting.sqlite")
+
+# page sizes of the /api/policy/<id> invoice and payment lists
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+# most (policy_id, date) pairs one POST /api/balances may ask about
+API_MAX_BATCH_SIZE = 1000
+
+# rendered policy pages kept in memory, see accounting.cache
+POLICY_CACHE_SIZE = 1024
+POLICY_CACHE_TTL = 300  # seconds
+
+# request, SQL and PolicyAccounting counters and timings, served at /metrics
+METRICS_ENABLED = True
+# statements slower than this many seconds are logged, None turns the log off
+SLOW_QUERY_THRESHOLD = None
+
+# closed policies are moved to the archive tables this many days after they closed, see accounting.archive
+ARCHIVE_RETENTION_DAYS = 730
+
+# Every setting here can be overridden with an ACCOUNTING_<SETTING> environment variable, see
+# accounting.database. Connections to a SQLite file are pooled
+# when SQLALCHEMY_POOL_SIZE is set (serve.py sets it), opened for each request otherwise.
+SQLALCHEMY_POOL_SIZE = None
+SQLALCHEMY_POOL_TIMEOUT = None
+SQLALCHEMY_POOL_RECYCLE = None
+# PRAGMAs run on every new SQLite connection, None leaves SQLite's default
+SQLITE_BUSY_TIMEOUT = 5000  # milliseconds a writer waits for the lock
+SQLITE_JOURNAL_MODE = 'WAL'  # readers don't wait on the writer
+SQLITE_SYNCHRONOUS = 'NORMAL'  # durable at checkpoints, which is safe with WAL
+SQLITE_MMAP_SIZE = 268435456  # bytes read through a memory map
+SQLITE_CACHE_SIZE = -65536  # page cache per connection, negative is in KiB
@@ -0,0 +1,201 @@
+#!/user/bin/env python2.7
+
+import imp
+import json
+import os
+from threading import Lock
+
+from sqlalchemy import (Boolean, Column, DATE, Enum, ForeignKey, INTEGER, Index, VARCHAR, create_engine,
+                        event)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, relation, scoped_session
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+"""
+#######################################################
+The database of the accounting engine, on plain SQLAlchemy
+so the models, PolicyAccounting and the CLI work without
+Flask. The web app (accounting.web) reads the same settings
+and uses the same session.
+
+Every new SQLite connection gets the PRAGMAs of the
+SQLITE_* settings (WAL, synchronous, mmap_size,
+cache_size, busy_timeout), and with SQLALCHEMY_POOL_SIZE
+set SQLite connections are pooled and reused instead of
+opened for every request, so the PRAGMAs and the schema
+are only read once per connection.
+
+The session is scoped to the thread (or greenlet) and
+removed when the web app's app context ends, so under a
+threaded or forking WSGI server each request works with
+a session of its own and hands its connection back to
+the pool when it is done.
+
+Settings can be overridden from the environment: every
+ACCOUNTING_<SETTING> variable replaces the setting of
+that name, parsed as JSON when it is (8, null, true) and
+taken as a string otherwise (WAL). A few settings can
+also be given by a shorter alias of ENVIRON_ALIASES, such
+as ACCOUNTING_DATABASE_URI for SQLALCHEMY_DATABASE_URI;
+the setting's own name wins when both are set.
+#######################################################
+"""
+
+ENVIRON_PREFIX = 'ACCOUNTING_'
+
+# {alias: setting} of the shorter names the environment may give a setting by
+ENVIRON_ALIASES = {'DATABASE_URI': 'SQLALCHEMY_DATABASE_URI'}
+
+# SQLite refuses statements with more than 999 bound parameters, so long lists of
+# policy ids are split up before being put into an IN clause.
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# (PRAGMA, setting) in the order they are applied, busy_timeout first so the others wait for locks
+SQLITE_PRAGMAS = (('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+                  ('journal_mode', 'SQLITE_JOURNAL_MODE'),
+                  ('synchronous', 'SQLITE_SYNCHRONOUS'),
+                  ('mmap_size', 'SQLITE_MMAP_SIZE'),
+                  ('cache_size', 'SQLITE_CACHE_SIZE'))
+
+
+"""
+ Yields items in lists of at most size, such as policy ids for one IN clause each.
+"""
+def chunks(items, size=IN_CLAUSE_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _is_sqlite_file(info):
+    return info.drivername == 'sqlite' and info.database not in (None, '', ':memory:')
+
+
+"""
+ Returns the settings in environ (os.environ or alike) for the names in settings, each
+ ACCOUNTING_<NAME> variable (or ACCOUNTING_<ALIAS>, see ENVIRON_ALIASES) parsed as JSON when
+ it is, a string otherwise.
+"""
+def environ_config(environ, settings):
+    config = {}
+    for name in settings:
+        variables = [ENVIRON_PREFIX + name] + [ENVIRON_PREFIX + alias for alias, setting
+                                               in sorted(ENVIRON_ALIASES.items()) if setting == name]
+        variables = [variable for variable in variables if variable in environ]
+        if not variables:
+            continue
+        value = environ[variables[0]]
+        try:
+            config[name] = json.loads(value)
+        except ValueError:
+            config[name] = value
+    return config
+
+
+"""
+ Runs the PRAGMAs of the SQLITE_* settings of config on a new SQLite connection, skipping
+ those that are None.
+"""
+def apply_sqlite_pragmas(dbapi_connection, config):
+    for pragma, setting in SQLITE_PRAGMAS:
+        value = config.get(setting)
+        if value is not None:
+            dbapi_connection.execute('PRAGMA %s = %s' % (pragma, value))
+
+
+"""
+ Returns the UPPERCASE names of the python file at path, the way config.py is read.
+"""
+def read_settings(path):
+    module = imp.new_module('config')
+    module.__file__ = path
+    execfile(path, module.__dict__)
+    return dict((name, value) for name, value in vars(module).items() if name.isupper())
+
+
+class AccountingDatabase(object):
+    """
+     The engine, the thread local session and the declarative Model of the accounting tables, made
+     from the SQLALCHEMY_* and SQLITE_* names of settings. The engine is opened on first use and
+     again whenever SQLALCHEMY_DATABASE_URI changes; SQLite files are opened without a pool unless
+     SQLALCHEMY_POOL_SIZE is set, and every new SQLite connection gets the SQLITE_* PRAGMAs.
+     A relative SQLite path is taken from root_path.
+    """
+    # the column types and helpers the models are declared with, as db.Column and so on
+    Column = Column
+    Boolean = Boolean
+    DATE = DATE
+    Enum = Enum
+    ForeignKey = ForeignKey
+    INTEGER = INTEGER
+    Index = Index
+    VARCHAR = VARCHAR
+    relation = staticmethod(relation)
+
+    def __init__(self, settings, root_path=None):
+        self.settings = settings
+        self.root_path = root_path or os.getcwd()
+        self._engine = None
+        self._connected_for = None
+        self._engine_lock = Lock()
+        self.session = scoped_session(self._make_session)
+        self.Model = declarative_base(name='Model')
+        self.Model.query = self.session.query_property()
+        self.metadata = self.Model.metadata
+
+    def _make_session(self):
+        return Session(bind=self.engine, autoflush=False)
+
+    @property
+    def engine(self):
+        with self._engine_lock:
+            uri = self.settings['SQLALCHEMY_DATABASE_URI']
+            if self._engine is None or self._connected_for != uri:
+                if self._engine is not None:
+                    self._engine.dispose()
+                self._engine = self._create_engine(uri)
+                self._connected_for = uri
+            return self._engine
+
+    def _create_engine(self, uri):
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        for option in ('pool_size', 'pool_timeout', 'pool_recycle'):
+            value = self.settings.get('SQLALCHEMY_' + option.upper())
+            if value is not None:
+                options[option] = value
+        if _is_sqlite_file(info):
+            info.database = os.path.join(self.root_path, info.database)
+            if options.get('pool_size'):
+                # SQLAlchemy opens SQLite files without a pool, and pysqlite won't let a connection
+                # move between threads unless told it may; the pool only ever lends it to one at a time
+                options['poolclass'] = QueuePool
+                options['connect_args'] = {'check_same_thread': False}
+            else:
+                options['poolclass'] = NullPool
+        engine = create_engine(info, **options)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect',
+                         lambda dbapi_connection, connection_record: apply_sqlite_pragmas(dbapi_connection,
+                                                                                          self.settings))
+        return engine
+
+    def create_all(self):
+        self.metadata.create_all(bind=self.engine)
+
+    def drop_all(self):
+        self.metadata.drop_all(bind=self.engine)
+
+    """
+     Drops the engine made so far, along with its connections, so the next use opens one with
+     the current settings.
+    """
+    def reset_engines(self):
+        self.session.remove()
+        with self._engine_lock:
+            if self._engine is not None:
+                self._engine.dispose()
+            self._engine = None
+            self._connected_for = None
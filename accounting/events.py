@@ -0,0 +1,134 @@
+#!/user/bin/env python2.7
+
+from accounting import db
+from models import Policy, PolicyEvent
+from snapshot import load_account_rows
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+
+
+"""
+#######################################################
+The policy event calendar: the next date each Active
+policy needs attention and what for, one row per policy.
+
+    Bill                 - an invoice's bill_date
+    Due                  - an invoice's due_date
+    Cancellation Pending - an invoice's due_date, with the
+                           invoice still unpaid on it (see
+                           PolicyAccounting.
+                           evaluate_cancellation_pending_due_to_non_pay)
+    Cancel               - an invoice's cancel_date, with
+                           the invoice still unpaid on it
+
+Only events after the row's processed_through date count,
+the daily run moves that forward as it handles policies.
+Every write to a policy's invoices, payments or status
+refreshes its row, so the daily run can find the policies
+with work to do through the event_date index alone.
+#######################################################
+"""
+
+events = PolicyEvent.__table__
+
+# when several events fall on the same day the row keeps the last of these
+EVENT_TYPES = (u'Bill', u'Due', u'Cancellation Pending', u'Cancel')
+
+
+def _open_on(invoice, date_value):
+    return not invoice.paid or invoice.paid_date > date_value
+
+
+"""
+ Returns the (event_date, event_type) of the first event after the date after (or the first
+ event at all if after is None) for a policy with the given invoice rows, as returned by
+ load_account_rows, or (None, None) if there isn't one.
+"""
+def next_event(invoices, after=None):
+    candidates = []
+    for invoice in invoices:
+        if invoice.deleted:
+            continue
+        candidates.append((invoice.bill_date, u'Bill'))
+        if invoice.amount_due > 0:
+            candidates.append((invoice.due_date, u'Due'))
+            if _open_on(invoice, invoice.due_date):
+                candidates.append((invoice.due_date, u'Cancellation Pending'))
+            if _open_on(invoice, invoice.cancel_date):
+                candidates.append((invoice.cancel_date, u'Cancel'))
+
+    if after is not None:
+        candidates = [candidate for candidate in candidates if candidate[0] > after]
+    if not candidates:
+        return None, None
+    return min(candidates, key=lambda (event_date, event_type): (event_date,
+                                                                 -EVENT_TYPES.index(event_type)))
+
+
+"""
+ Works the event rows of the policies in policy_ids out again from their invoices and the
+ payments allocated to them, keeping how far each has been processed. Policies that aren't
+ Active lose their row. Does not commit, so writers can refresh the calendar inside their own transaction.
+"""
+def refresh(policy_ids):
+    # make sure anything the caller added through the ORM is visible to the queries below
+    db.session.flush()
+
+    for chunk in chunks(set(policy_ids), IN_CLAUSE_CHUNK_SIZE):
+        active = set(row.id for row in db.session.query(Policy.id)
+                                                 .filter(Policy.id.in_(chunk))
+                                                 .filter(Policy.status == u'Active'))
+        processed = dict(db.session.execute(
+            events.select().with_only_columns([events.c.policy_id, events.c.processed_through])
+                           .where(events.c.policy_id.in_(chunk))).fetchall())
+        invoices, _ = load_account_rows(active)
+
+        rows = []
+        for policy_id in active:
+            event_date, event_type = next_event(invoices[policy_id], processed.get(policy_id))
+            rows.append({'policy_id': policy_id,
+                         'event_date': event_date,
+                         'event_type': event_type,
+                         'processed_through': processed.get(policy_id)})
+
+        db.session.execute(events.delete().where(events.c.policy_id.in_(chunk)))
+        if rows:
+            db.session.execute(events.insert(), rows)
+
+
+"""
+ Returns (policy_id, event_type) for every policy with an event on or before date_cursor, in
+ policy_id order. Found through the event_date index, so it costs the number of policies with
+ work to do rather than the size of the book.
+"""
+def due_events(date_cursor):
+    due = events.select().with_only_columns([events.c.policy_id, events.c.event_type])\
+                         .where(events.c.event_date <= date_cursor)\
+                         .order_by(events.c.policy_id)
+    return [(row.policy_id, row.event_type) for row in db.session.execute(due)]
+
+
+"""
+ Marks the policies in policy_ids as handled up to and including date_cursor and moves their
+ rows on to the next event after it. Does not commit.
+"""
+def mark_processed(policy_ids, date_cursor):
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        db.session.execute(events.update()
+                                 .where(events.c.policy_id.in_(chunk))
+                                 .values(processed_through=date_cursor))
+    refresh(policy_ids)
+
+
+"""
+ Works out the event rows of every policy (or only those in policy_ids) again.
+"""
+def rebuild_events(policy_ids=None):
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+    try:
+        refresh(policy_ids)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+    print "Events rebuilt!"
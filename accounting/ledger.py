@@ -0,0 +1,278 @@
+#!/user/bin/env python2.7
+
+from itertools import groupby
+
+from sqlalchemy import func, literal, literal_column, select, text, union_all
+
+from accounting import db
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+from models import ArchivedInvoice, ArchivedPayment, CanceledPolicy, Invoice, Payment, Policy, PolicyLedger
+
+
+"""
+#######################################################
+The policy ledger keeps a dated running balance for every
+policy so that "balance as of date X" is a single indexed
+lookup instead of a sum over the policy's whole history.
+
+PolicyAccounting posts an entry for every invoice, voided
+invoice, payment and cancellation in the same transaction
+as the write itself. rebuild_ledger and verify_ledger
+recompute it from the invoices and payments tables.
+#######################################################
+"""
+
+ledger = PolicyLedger.__table__
+
+# rows are written in batches of this size when rebuilding
+REBUILD_CHUNK_SIZE = 1000
+
+
+"""
+ Returns the ledger balance of the policy at the end of date_cursor, or None if the policy
+ has no ledger entries at all (it was written before the ledger existed and has not been
+ rebuilt since).
+"""
+def balance_as_of(policy_id, date_cursor):
+    last_entry = select([ledger.c.balance])\
+        .where(ledger.c.policy_id == policy_id)\
+        .where(ledger.c.entry_date <= date_cursor)\
+        .order_by(ledger.c.entry_date.desc(), ledger.c.id.desc())\
+        .limit(1)
+    balance = db.session.execute(last_entry).scalar()
+    if balance is not None:
+        return balance
+
+    any_entry = select([ledger.c.id]).where(ledger.c.policy_id == policy_id).limit(1)
+    if db.session.execute(any_entry).scalar() is not None:
+        return 0
+    return None
+
+
+"""
+ Records a change of amount to the policy's balance on entry_date. Entries dated after
+ entry_date have their running balance shifted by the same amount, so back-dated entries
+ keep the ledger consistent. Does not commit, the caller's transaction covers the entry.
+"""
+def post_entry(policy_id, entry_date, entry_type, amount):
+    post_entries([(policy_id, entry_date, entry_type, amount)])
+
+
+# balance of a new entry: the last existing entry on or before its date, plus every new entry
+# in the same batch up to and including it
+_insert_entry = text("""
+    INSERT INTO policy_ledger (policy_id, entry_date, entry_type, amount, balance)
+    SELECT :policy_id, :entry_date, :entry_type, :amount,
+           COALESCE((SELECT balance FROM policy_ledger
+                     WHERE policy_id = :policy_id AND entry_date <= :entry_date AND id <= :last_id
+                     ORDER BY entry_date DESC, id DESC LIMIT 1), 0) + :batch_balance
+""")
+
+_shift_later_entries = text("""
+    UPDATE policy_ledger SET balance = balance + :amount
+    WHERE policy_id = :policy_id AND entry_date > :entry_date AND id <= :last_id
+""")
+
+
+"""
+ Posts many (policy_id, entry_date, entry_type, amount) entries with two executemany
+ statements, for bulk writers. Gives the same result as calling post_entry for each of them
+ in date order. Does not commit.
+"""
+def post_entries(entries):
+    # make sure anything the caller added through the ORM is visible to the statements below
+    db.session.flush()
+    if not entries:
+        return
+
+    # only entries that existed before this batch are read or shifted, the new ones
+    # account for each other through batch_balance
+    last_id = db.session.execute(select([func.max(ledger.c.id)])).scalar() or 0
+    rows = []
+    batch_balances = {}
+    for policy_id, entry_date, entry_type, amount in sorted(entries, key=lambda entry: entry[:2]):
+        batch_balances[policy_id] = batch_balances.get(policy_id, 0) + amount
+        rows.append({'policy_id': policy_id,
+                     'entry_date': entry_date,
+                     'entry_type': entry_type,
+                     'amount': amount,
+                     'batch_balance': batch_balances[policy_id],
+                     'last_id': last_id})
+
+    db.session.execute(_insert_entry, rows)
+    shifts = [row for row in rows if row['amount']]
+    if shifts:
+        db.session.execute(_shift_later_entries, shifts)
+    bump_versions(batch_balances.keys())
+
+
+"""
+ Streams (policy_id, entry_date, entry_type, amount) for the policies in policy_ids (every
+ policy if None) as the ledger would record them, computed from the invoices, payments (and
+ their archive tables) and canceled_policy tables and sorted by policy and date. Deleted
+ invoices are left out.
+"""
+def _source_entries(policy_ids=None):
+    sources = []
+    # archived policies keep their history in the archive tables
+    for invoice_model, payment_model in ((Invoice, Payment), (ArchivedInvoice, ArchivedPayment)):
+        sources.append((select([invoice_model.policy_id.label('policy_id'),
+                                invoice_model.bill_date.label('entry_date'),
+                                literal(0).label('sort_order'),
+                                literal(u'Invoice').label('entry_type'),
+                                invoice_model.amount_due.label('amount')])
+                        .where(invoice_model.deleted == False), invoice_model.policy_id))
+        sources.append((select([payment_model.policy_id.label('policy_id'),
+                                payment_model.transaction_date.label('entry_date'),
+                                literal(1).label('sort_order'),
+                                literal(u'Payment').label('entry_type'),
+                                (-payment_model.amount_paid).label('amount')]), payment_model.policy_id))
+    sources.append((select([CanceledPolicy.policy_id.label('policy_id'),
+                            CanceledPolicy.cancellation_date.label('entry_date'),
+                            literal(2).label('sort_order'),
+                            literal(u'Cancel').label('entry_type'),
+                            literal(0).label('amount')]), CanceledPolicy.policy_id))
+
+    selects = []
+    for query, policy_column in sources:
+        if policy_ids is not None:
+            query = query.where(policy_column.in_(policy_ids))
+        selects.append(query)
+
+    entries = union_all(*selects)\
+        .order_by(literal_column('policy_id'),
+                  literal_column('entry_date'),
+                  literal_column('sort_order'))
+    for row in db.session.execute(entries):
+        yield row.policy_id, row.entry_date, row.entry_type, row.amount
+
+
+"""
+ Replaces the ledger entries of the policies in policy_ids (every policy if None) with ones
+ recomputed from the invoices, payments and canceled_policy tables. Does not commit, so bulk
+ writers can refresh the ledger inside their own transaction.
+"""
+def recompute_entries(policy_ids=None):
+    if policy_ids is None:
+        db.session.execute(ledger.delete())
+        policy_chunks = [None]
+    else:
+        policy_chunks = list(chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE))
+        for chunk in policy_chunks:
+            db.session.execute(ledger.delete().where(ledger.c.policy_id.in_(chunk)))
+
+    rows = []
+    current_policy = None
+    balance = 0
+    for chunk in policy_chunks:
+        for policy_id, entry_date, entry_type, amount in _source_entries(chunk):
+            if policy_id != current_policy:
+                current_policy = policy_id
+                balance = 0
+            balance += amount
+            rows.append({'policy_id': policy_id,
+                         'entry_date': entry_date,
+                         'entry_type': entry_type,
+                         'amount': amount,
+                         'balance': balance})
+            if len(rows) >= REBUILD_CHUNK_SIZE:
+                db.session.execute(ledger.insert(), rows)
+                rows = []
+    if rows:
+        db.session.execute(ledger.insert(), rows)
+
+    if policy_ids is None:
+        db.session.execute(Policy.__table__.update().values(version=Policy.version + 1))
+    else:
+        bump_versions(policy_ids)
+
+
+"""
+ Increments the version of the policies in policy_ids. Anything cached for an older version of
+ a policy, like its page in the views, is no longer used. Every change to the ledger does this,
+ writers that don't touch the ledger should call it themselves. Does not commit.
+"""
+def bump_versions(policy_ids):
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        db.session.execute(Policy.__table__.update()
+                                           .where(Policy.id.in_(chunk))
+                                           .values(version=Policy.version + 1))
+
+
+"""
+ Rebuild command: recomputes the ledger of the policies in policy_ids (every policy if None)
+ from scratch and commits.
+"""
+def rebuild_ledger(policy_ids=None):
+    try:
+        recompute_entries(policy_ids)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+    print "Ledger rebuilt!"
+
+
+def _end_of_day_balances(entries):
+    balances = []
+    balance = 0
+    for entry_date, amount in entries:
+        balance += amount
+        _set_end_of_day(balances, entry_date, balance)
+    return balances
+
+
+def _set_end_of_day(balances, entry_date, balance):
+    if balances and balances[-1][0] == entry_date:
+        balances[-1] = (entry_date, balance)
+    else:
+        balances.append((entry_date, balance))
+
+
+def _compare(policy_id, expected, recorded, mismatches):
+    # walks both lists of end-of-day balances in date order, a missing day means the
+    # balance carried over from the previous one
+    dates = sorted(set(entry[0] for entry in expected) | set(entry[0] for entry in recorded))
+    should_be = actual = 0
+    expected = iter(expected)
+    recorded = iter(recorded)
+    next_expected = next(expected, None)
+    next_recorded = next(recorded, None)
+    for date_cursor in dates:
+        if next_expected and next_expected[0] == date_cursor:
+            should_be = next_expected[1]
+            next_expected = next(expected, None)
+        if next_recorded and next_recorded[0] == date_cursor:
+            actual = next_recorded[1]
+            next_recorded = next(recorded, None)
+        if should_be != actual:
+            mismatches.append((policy_id, date_cursor, actual, should_be))
+
+
+"""
+ Compares the ledger against the invoices and payments tables for the policies in policy_ids
+ (every policy if None) without changing anything. Returns a list of
+ (policy_id, date, ledger_balance, expected_balance) for every date on which the two disagree.
+"""
+def verify_ledger(policy_ids=None):
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+
+    mismatches = []
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        expected = {}
+        for policy_id, entries in groupby(_source_entries(chunk), lambda entry: entry[0]):
+            expected[policy_id] = _end_of_day_balances((entry[1], entry[3]) for entry in entries)
+
+        recorded = {}
+        ledger_entries = select([ledger.c.policy_id, ledger.c.entry_date, ledger.c.balance])\
+            .where(ledger.c.policy_id.in_(chunk))\
+            .order_by(ledger.c.policy_id, ledger.c.entry_date, ledger.c.id)
+        for row in db.session.execute(ledger_entries):
+            _set_end_of_day(recorded.setdefault(row.policy_id, []), row.entry_date, row.balance)
+
+        for policy_id in chunk:
+            _compare(policy_id, expected.get(policy_id, []), recorded.get(policy_id, []), mismatches)
+
+    print "%d ledger mismatches found." % len(mismatches)
+    return mismatches
@@ -0,0 +1,321 @@
+#!/user/bin/env python2.7
+
+import argparse
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import urllib
+import urllib2
+from datetime import timedelta
+
+from sqlalchemy import func
+from werkzeug.serving import make_server
+
+from accounting import db
+from web import app
+from benchmark import AS_OF, _percentile, book_path, use_database
+from models import Policy
+from serve import _QuietRequestHandler
+from synthetic import BOOK_SIZES
+import metrics
+# registers the routes the test client asks for
+import views
+
+
+"""
+#######################################################
+Load generator for the web tier that needs no network.
+
+A seeded list of requests is made up front from a mix of
+the index page and /policyInfo lookups (random policies
+of a generated book, asked about random dates), and sent
+either through Flask's test client or to a threaded WSGI
+server on loopback, from a number of threads at once. With
+a rate the requests go out on a fixed schedule instead of
+as fast as the threads can send them, and latency is
+counted from when each one was due, so a server falling
+behind shows up in the latency rather than slowing the
+load down.
+
+Throughput, p50/p95/p99 latency, the error rate and the
+SQL statements each request ran (from accounting.metrics)
+are reported for the whole run and for each kind of
+request, and can be saved as JSON and compared with an
+earlier run.
+#######################################################
+"""
+
+# (method, path, endpoint) of each kind of request
+REQUEST_KINDS = {'index': ('GET', '/', 'index'),
+                 'policy_info': ('POST', '/policyInfo', 'gather_policy_info')}
+
+# relative weights of each kind of request
+DEFAULT_MIX = {'index': 1, 'policy_info': 4}
+
+# /policyInfo is asked about dates up to this many days before AS_OF
+DATE_RANGE_DAYS = 365
+
+# a run counts as a regression when its p95 latency or throughput is this much worse
+DEFAULT_TOLERANCE = 0.25
+
+
+"""
+ Parses a mix such as index=1,policy_info=4 into {kind: weight}.
+"""
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in REQUEST_KINDS:
+            raise ValueError("Unknown request kind %r, expected one of %s" % (kind, ', '.join(sorted(REQUEST_KINDS))))
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+"""
+ Returns count requests as (kind, form) tuples, picked with seed from mix for policies with ids
+ up to max_policy_id.
+"""
+def make_requests(count, mix, max_policy_id, seed=0):
+    rng = random.Random(seed)
+    kinds = sorted(mix)
+    total = sum(mix[kind] for kind in kinds)
+    requests = []
+    for _ in range(count):
+        pick = rng.uniform(0, total)
+        for kind in kinds:
+            pick -= mix[kind]
+            if pick <= 0:
+                break
+        form = None
+        if kind == 'policy_info':
+            asked_on = AS_OF - timedelta(days=rng.randint(0, DATE_RANGE_DAYS))
+            form = {'policy_number': rng.randint(1, max_policy_id),
+                    'invoice_date': asked_on.strftime('%Y-%m-%d')}
+        requests.append((kind, form))
+    return requests
+
+
+class TestClientTransport(object):
+    """
+     Sends requests through a Flask test client, one for each thread.
+    """
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, kind, form):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        method, path, _ = REQUEST_KINDS[kind]
+        if method == 'POST':
+            return client.post(path, data=form).status_code
+        return client.get(path).status_code
+
+    def close(self):
+        pass
+
+
+class LoopbackTransport(object):
+    """
+     Sends requests over HTTP to a threaded WSGI server for app on a free loopback port.
+    """
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_QuietRequestHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, kind, form):
+        method, path, _ = REQUEST_KINDS[kind]
+        data = urllib.urlencode(form) if method == 'POST' else None
+        try:
+            response = urllib2.urlopen(self.url + path, data, timeout=30)
+        except urllib2.HTTPError as error:
+            return error.code
+        response.read()
+        return response.getcode()
+
+    def close(self):
+        self.server.shutdown()
+        self._thread.join()
+        self.server.server_close()
+
+
+def _summary(timings, errors, seconds):
+    timings = sorted(timings)
+    count = len(timings)
+    return {'requests': count,
+            'errors': errors,
+            'error_rate': float(errors) / count if count else 0.0,
+            'requests_per_second': count / seconds if seconds else 0.0,
+            'mean_ms': sum(timings) / count if count else None,
+            'p50_ms': _percentile(timings, 0.50) if count else None,
+            'p95_ms': _percentile(timings, 0.95) if count else None,
+            'p99_ms': _percentile(timings, 0.99) if count else None}
+
+
+def _statements():
+    return dict((kind, (metrics.request_statements.count(endpoint), metrics.request_statements.total(endpoint)))
+                for kind, (_, _, endpoint) in REQUEST_KINDS.items())
+
+
+"""
+ Sends requests through transport from concurrency threads, back to back, or at rate requests
+ per second when rate is given. Returns the summary of the whole run under 'overall' and of
+ each kind of request under 'kinds'.
+"""
+def run_load(requests, transport, concurrency=8, rate=None):
+    timings = dict((kind, []) for kind in REQUEST_KINDS)
+    errors = dict((kind, 0) for kind in REQUEST_KINDS)
+    lock = threading.Lock()
+    position = [0]
+    statements_before = _statements()
+
+    def sender():
+        while True:
+            with lock:
+                index = position[0]
+                position[0] += 1
+            if index >= len(requests):
+                return
+            kind, form = requests[index]
+            due = started + index / float(rate) if rate else time.time()
+            if due > time.time():
+                time.sleep(due - time.time())
+            try:
+                failed = transport.send(kind, form) >= 400
+            except Exception:
+                failed = True
+            elapsed = (time.time() - due) * 1000
+            with lock:
+                timings[kind].append(elapsed)
+                errors[kind] += failed
+
+    started = time.time()
+    threads = [threading.Thread(target=sender) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+
+    statements_after = _statements()
+    results = {'seconds': seconds, 'kinds': {}}
+    for kind in REQUEST_KINDS:
+        if not timings[kind]:
+            continue
+        results['kinds'][kind] = _summary(timings[kind], errors[kind], seconds)
+        handled = statements_after[kind][0] - statements_before[kind][0]
+        results['kinds'][kind]['statements_per_request'] = \
+            float(statements_after[kind][1] - statements_before[kind][1]) / handled if handled else None
+    results['overall'] = _summary(sum(timings.values(), []), sum(errors.values()), seconds)
+    handled = sum(statements_after[kind][0] - statements_before[kind][0] for kind in REQUEST_KINDS)
+    results['overall']['statements_per_request'] = float(
+        sum(statements_after[kind][1] - statements_before[kind][1] for kind in REQUEST_KINDS)) / handled \
+        if handled else None
+    return results
+
+
+"""
+ Compares results against a baseline (both as written by run_load_test) and returns a description
+ of every kind of request whose p95 latency or throughput got worse by more than tolerance, or
+ that runs more statements or fails more often than it used to.
+"""
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    current_kinds = dict(results['kinds'], overall=results['overall'])
+    baseline_kinds = dict(baseline.get('kinds', {}), overall=baseline.get('overall'))
+    for kind, current in sorted(current_kinds.items()):
+        previous = baseline_kinds.get(kind)
+        if not previous:
+            continue
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: %.2fms p95, baseline %.2fms' % (kind, current['p95_ms'], previous['p95_ms']))
+        if current['requests_per_second'] * (1 + tolerance) < previous['requests_per_second']:
+            regressions.append('%s: %.1f requests/s, baseline %.1f' % (
+                kind, current['requests_per_second'], previous['requests_per_second']))
+        if (current['statements_per_request'] or 0) > (previous['statements_per_request'] or 0):
+            regressions.append('%s: %.1f statements per request, baseline %.1f' % (
+                kind, current['statements_per_request'], previous['statements_per_request'] or 0))
+        if current['error_rate'] > previous['error_rate']:
+            regressions.append('%s: %.2f%% errors, baseline %.2f%%' % (
+                kind, current['error_rate'] * 100, previous['error_rate'] * 100))
+    return regressions
+
+
+"""
+ Load-tests the app against a scratch copy of the generated book of num_policies, sending
+ count requests picked with seed from mix. Returns the results of run_load along with the
+ settings of the run.
+"""
+def run_load_test(num_policies, count=2000, mix=None, concurrency=8, rate=None, transport='client',
+                  seed=0, data_dir='benchmarks'):
+    mix = mix or DEFAULT_MIX
+    scratch = os.path.join(data_dir, 'loadtest.sqlite')
+    shutil.copyfile(book_path(num_policies, seed, data_dir), scratch)
+    use_database(scratch)
+    max_id = db.session.query(func.max(Policy.id)).scalar()
+    db.session.remove()
+
+    sender = LoopbackTransport(app) if transport == 'http' else TestClientTransport(app)
+    try:
+        results = run_load(make_requests(count, mix, max_id, seed), sender, concurrency, rate)
+    finally:
+        sender.close()
+        db.session.remove()
+        os.remove(scratch)
+
+    results.update({'policies': num_policies, 'mix': mix, 'concurrency': concurrency, 'rate': rate,
+                    'transport': transport, 'seed': seed, 'as_of': str(AS_OF)})
+    return results
+
+
+def _print(results):
+    for kind, summary in sorted(results['kinds'].items()) + [('overall', results['overall'])]:
+        print "%-12s %6d requests %8.1f/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %5.2f%% errors  %s statements" % (
+            kind, summary['requests'], summary['requests_per_second'], summary['p50_ms'], summary['p95_ms'],
+            summary['p99_ms'], summary['error_rate'] * 100,
+            '-' if summary['statements_per_request'] is None else '%.1f' % summary['statements_per_request'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load-test the views without a network.')
+    parser.add_argument('--size', default='small',
+                        help='book size, either %s or a number of policies' % '/'.join(sorted(BOOK_SIZES)))
+    parser.add_argument('--requests', type=int, default=2000, help='requests sent')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='relative weights of each kind of request (default: index=1,policy_info=4)')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads sending requests')
+    parser.add_argument('--rate', type=float, help='requests per second (default: as fast as possible)')
+    parser.add_argument('--transport', choices=('client', 'http'), default='client',
+                        help="Flask's test client, or HTTP to a server on loopback")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default='benchmarks', help='where generated books are kept')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    num_policies = BOOK_SIZES[args.size] if args.size in BOOK_SIZES else int(args.size)
+    results = run_load_test(num_policies, args.requests, args.mix, args.concurrency, args.rate,
+                            args.transport, args.seed, args.data_dir)
+    _print(results)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print "REGRESSION: " + regression
+        if regressions:
+            return 1
+    return 0
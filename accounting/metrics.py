@@ -0,0 +1,293 @@
+#!/user/bin/env python2.7
+
+import time
+from functools import wraps
+from threading import Lock, local
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+
+"""
+#######################################################
+Counters and latency histograms for the SQL statements,
+commits, requests and PolicyAccounting calls of the app,
+served in the Prometheus text format at /metrics.
+
+Statements are counted and timed with engine events and
+charged to every request or PolicyAccounting method that
+is running on the thread when they execute, so a method's
+figures include the statements of the methods it calls.
+
+With METRICS_ENABLED off and no SLOW_QUERY_THRESHOLD set
+install does nothing: no events are listened for and no
+method is wrapped, so nothing is left to cost anything.
+#######################################################
+"""
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+# the PolicyAccounting methods that get timed
+POLICY_ACCOUNTING_METHODS = ('__init__', 'return_account_balance', 'return_ledger_balance',
+                             'make_payment', 'evaluate_cancellation_pending_due_to_non_pay',
+                             'evaluate_cancel', 'cancel', 'make_invoices', 'change_billing_schedule')
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+     A count that only goes up, one for each combination of label values.
+    """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labels, label_values),
+                                          _format_number(value)))
+        return lines
+
+
+class Histogram(object):
+    """
+     Observed values counted into cumulative buckets, with their sum and count, one set for
+     each combination of label values.
+    """
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # one count per bucket, then the sum and the count
+                counts = self._values[label_values] = [0] * len(self.buckets) + [0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def count(self, *label_values):
+        counts = self._values.get(label_values)
+        return counts[-1] if counts else 0
+
+    def total(self, *label_values):
+        counts = self._values.get(label_values)
+        return counts[-2] if counts else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for label_values, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        self.name,
+                        _format_labels(self.labels, label_values, [('le', _format_number(bound))]),
+                        cumulative))
+                labels = _format_labels(self.labels, label_values)
+                lines.append('%s_sum%s %s' % (self.name, labels, _format_number(counts[-2])))
+                lines.append('%s_count%s %d' % (self.name, labels, counts[-1]))
+        return lines
+
+
+sql_statements = Counter('accounting_sql_statements_total', 'SQL statements executed.')
+sql_seconds = Histogram('accounting_sql_statement_seconds', 'Time spent executing each SQL statement.',
+                        SECONDS_BUCKETS)
+slow_queries = Counter('accounting_sql_slow_statements_total',
+                       'SQL statements slower than SLOW_QUERY_THRESHOLD.')
+commit_seconds = Histogram('accounting_commit_seconds', 'Time spent in each session commit, flush included.',
+                           SECONDS_BUCKETS)
+http_requests = Counter('accounting_requests_total', 'Requests handled.', ('endpoint', 'status'))
+request_seconds = Histogram('accounting_request_seconds', 'Time spent handling each request.',
+                            SECONDS_BUCKETS, ('endpoint',))
+request_statements = Histogram('accounting_request_sql_statements', 'SQL statements run by each request.',
+                               STATEMENT_BUCKETS, ('endpoint',))
+method_seconds = Histogram('accounting_method_seconds', 'Time spent in each PolicyAccounting call.',
+                           SECONDS_BUCKETS, ('method',))
+method_statements = Histogram('accounting_method_sql_statements',
+                              'SQL statements run by each PolicyAccounting call.',
+                              STATEMENT_BUCKETS, ('method',))
+
+METRICS = (sql_statements, sql_seconds, slow_queries, commit_seconds, http_requests, request_seconds,
+           request_statements, method_seconds, method_statements)
+
+_local = local()
+# set by install
+_app = None
+_enabled = False
+
+
+class _Scope(object):
+    # a request or method call that statements run on this thread are charged to
+    def __init__(self):
+        self.started = time.time()
+        self.statements = 0
+
+
+def _push_scope():
+    scope = _Scope()
+    if not hasattr(_local, 'scopes'):
+        _local.scopes = []
+    _local.scopes.append(scope)
+    return scope
+
+
+def _pop_scope(scope):
+    scopes = getattr(_local, 'scopes', [])
+    if scope in scopes:
+        scopes.remove(scope)
+    return time.time() - scope.started
+
+
+def _timed(name, method):
+    @wraps(method)
+    def timed(*args, **kwargs):
+        scope = _push_scope()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            method_seconds.observe(_pop_scope(scope), name)
+            method_statements.observe(scope.statements, name)
+    timed._metrics_name = name
+    return timed
+
+
+def instrument(cls, methods):
+    for method in methods:
+        original = getattr(cls, method).im_func
+        if not hasattr(original, '_metrics_name'):
+            setattr(cls, method, _timed('%s.%s' % (cls.__name__, method), original))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if not started:
+        # the statement began before install
+        return
+    elapsed = time.time() - started.pop()
+    if _enabled:
+        sql_statements.inc()
+        sql_seconds.observe(elapsed)
+        for scope in getattr(_local, 'scopes', ()):
+            scope.statements += 1
+
+    threshold = _app.config.get('SLOW_QUERY_THRESHOLD')
+    if threshold is not None and elapsed >= threshold:
+        slow_queries.inc()
+        _app.logger.warning("Slow query (%.3fs): %s %r", elapsed, statement, parameters)
+
+
+def _before_commit(session):
+    _local.commit_started = time.time()
+
+
+def _after_commit(session):
+    started = getattr(_local, 'commit_started', None)
+    if started is not None:
+        commit_seconds.observe(time.time() - started)
+        _local.commit_started = None
+
+
+def _start_request():
+    g.metrics_scope = _push_scope()
+
+
+def _record_request(status):
+    scope = getattr(g, 'metrics_scope', None)
+    if scope is None:
+        return
+    g.metrics_scope = None
+    elapsed = _pop_scope(scope)
+    endpoint = request.endpoint or 'unknown'
+    http_requests.inc(endpoint, str(status))
+    request_seconds.observe(elapsed, endpoint)
+    request_statements.observe(scope.statements, endpoint)
+
+
+def _finish_request(response):
+    _record_request(response.status_code)
+    return response
+
+
+def _teardown_request(exception):
+    # only still open when the view raised
+    if exception is not None:
+        _record_request(500)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+"""
+ Starts collecting metrics for app as its METRICS_ENABLED and SLOW_QUERY_THRESHOLD settings
+ ask, timing the given PolicyAccounting class. Safe to call more than once.
+"""
+def install(app, policy_accounting):
+    global _app, _enabled
+    slow_query_log = app.config.get('SLOW_QUERY_THRESHOLD') is not None
+    if _app is not None or not (app.config.get('METRICS_ENABLED') or slow_query_log):
+        return
+    _app = app
+    _enabled = bool(app.config.get('METRICS_ENABLED'))
+
+    # every engine, including ones made later for another database URI
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    if _enabled:
+        event.listen(Session, 'before_commit', _before_commit)
+        event.listen(Session, 'after_commit', _after_commit)
+        app.before_request(_start_request)
+        app.after_request(_finish_request)
+        app.teardown_request(_teardown_request)
+        instrument(policy_accounting, POLICY_ACCOUNTING_METHODS)
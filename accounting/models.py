@@ -19,6 +19,10 @@ class Policy(db.Model):
     annual_premium = db.Column(u'annual_premium', db.INTEGER(), nullable=False)
     named_insured = db.Column(u'named_insured', db.INTEGER(), db.ForeignKey('contacts.id'))
     agent = db.Column(u'agent', db.INTEGER(), db.ForeignKey('contacts.id'))
+    # bumped whenever the policy's ledger changes, cached pages of older versions are stale
+    version = db.Column(u'version', db.INTEGER(), default=0, server_default='0', nullable=False)
+    # set once the policy's invoices and payments have been moved to the archive tables
+    archived_on = db.Column(u'archived_on', db.DATE())
 
     def __init__(self, policy_number, effective_date, annual_premium):
         self.policy_number = policy_number
@@ -33,7 +37,9 @@ class Policy(db.Model):
 class Contact(db.Model):
     __tablename__ = 'contacts'
 
-    __table_args__ = {}
+    # make_payment looks agents up by name and role
+    __table_args__ = (db.Index('ix_contacts_role_name', 'role', 'name'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -48,7 +54,12 @@ class Contact(db.Model):
 class Invoice(db.Model):
     __tablename__ = 'invoices'
 
-    __table_args__ = {}
+    # every per-policy lookup in tools filters on one of these dates
+    __table_args__ = (db.Index('ix_invoices_policy_bill_date', 'policy_id', 'bill_date'),
+                      db.Index('ix_invoices_policy_due_date', 'policy_id', 'due_date'),
+                      db.Index('ix_invoices_policy_cancel_date', 'policy_id', 'cancel_date'),
+                      db.Index('ix_invoices_policy_paid_due_date', 'policy_id', 'paid', 'due_date'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -58,6 +69,10 @@ class Invoice(db.Model):
     cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
     amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
     deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
+    # how much of the invoice the policy's payments cover, see accounting.allocation
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), default=0, server_default='0', nullable=False)
+    paid = db.Column(u'paid', db.Boolean, default=False, server_default='0', nullable=False)
+    paid_date = db.Column(u'paid_date', db.DATE())  # the payment that finished paying it off
 
     def __init__(self, policy_id, bill_date, due_date, cancel_date, amount_due):
         self.policy_id = policy_id
@@ -91,7 +106,8 @@ class CanceledPolicy(db.Model):
 class Payment(db.Model):
     __tablename__ = 'payments'
 
-    __table_args__ = {}
+    __table_args__ = (db.Index('ix_payments_policy_transaction_date', 'policy_id', 'transaction_date'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -105,3 +121,94 @@ class Payment(db.Model):
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+
+
+'''
+ Cold storage for invoices and payments that are no longer looked at day to day: deleted
+ invoices, and the whole history of policies that were closed longer ago than the archive
+ retention period. Same columns as invoices and payments, rows keep their ids.
+ See accounting.archive.
+'''
+class ArchivedInvoice(db.Model):
+    __tablename__ = 'invoices_archive'
+
+    __table_args__ = (db.Index('ix_invoices_archive_policy_bill_date', 'policy_id', 'bill_date'),
+                      {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
+    due_date = db.Column(u'due_date', db.DATE(), nullable=False)
+    cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+    amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
+    deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), default=0, server_default='0', nullable=False)
+    paid = db.Column(u'paid', db.Boolean, default=False, server_default='0', nullable=False)
+    paid_date = db.Column(u'paid_date', db.DATE())
+
+
+class ArchivedPayment(db.Model):
+    __tablename__ = 'payments_archive'
+
+    __table_args__ = (db.Index('ix_payments_archive_policy_transaction_date', 'policy_id', 'transaction_date'),
+                      {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), nullable=False)
+    transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
+
+
+'''
+ Running account history for each policy, kept up to date by PolicyAccounting as invoices,
+ payments and cancellations are written. Each entry stores the change to the balance and the
+ balance after it, so the balance as of any date is the last entry on or before that date.
+ See accounting.ledger.
+'''
+class PolicyLedger(db.Model):
+    __tablename__ = 'policy_ledger'
+
+    __table_args__ = (db.Index('ix_policy_ledger_policy_entry_date', 'policy_id', 'entry_date'),
+                      {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    entry_date = db.Column(u'entry_date', db.DATE(), nullable=False)
+    entry_type = db.Column(u'entry_type', db.Enum(u'Invoice', u'Void', u'Payment', u'Cancel'), nullable=False)
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+    balance = db.Column(u'balance', db.INTEGER(), nullable=False)
+
+    def __init__(self, policy_id, entry_date, entry_type, amount, balance):
+        self.policy_id = policy_id
+        self.entry_date = entry_date
+        self.entry_type = entry_type
+        self.amount = amount
+        self.balance = balance
+
+
+'''
+ The next date each Active policy needs attention, and why, so the daily run only has to
+ look at the policies with something to do. Kept up to date by PolicyAccounting as invoices,
+ payments and cancellations are written. See accounting.events.
+'''
+class PolicyEvent(db.Model):
+    __tablename__ = 'policy_events'
+
+    __table_args__ = (db.Index('ix_policy_events_event_date', 'event_date'),
+                      {})
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, nullable=False)
+    event_date = db.Column(u'event_date', db.DATE())  # None when nothing is left to do
+    event_type = db.Column(u'event_type', db.Enum(u'Bill', u'Due', u'Cancellation Pending', u'Cancel'))
+    processed_through = db.Column(u'processed_through', db.DATE())
+
+    def __init__(self, policy_id, event_date, event_type, processed_through=None):
+        self.policy_id = policy_id
+        self.event_date = event_date
+        self.event_type = event_type
+        self.processed_through = processed_through
@@ -0,0 +1,173 @@
+#!/user/bin/env python2.7
+
+import argparse
+import csv
+import multiprocessing
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+
+from accounting import db
+from models import Policy
+from tools import balances_as_of, cancel_policies, make_invoices_bulk, sweep_cancellations
+
+
+"""
+#######################################################
+Runs book-wide jobs across several processes.
+
+The policies are split into ranges of ids and every range
+is handed to a process pool. Each worker drops the
+engine it inherited and opens connections of its own, so
+workers never share a SQLite connection. Every connection
+gets the SQLITE_* PRAGMAs of accounting.database, WAL
+among them, so the workers can read while something else
+writes.
+
+Writes are kept to one writer where possible: cancellation
+is worked out by the workers and applied by the parent in
+a single transaction. Re-invoicing writes from the workers
+in batched transactions (see make_invoices_bulk), which
+SQLite takes one at a time, each worker waiting up to
+SQLITE_BUSY_TIMEOUT for the lock.
+#######################################################
+"""
+
+JOBS = ('balances', 'cancel', 'reinvoice')
+
+# ranges handed out per worker, more than one so a slow range doesn't hold up the pass
+RANGES_PER_WORKER = 4
+
+
+def _init_worker():
+    # the engine was made by the parent, start over with one of this process's own
+    db.reset_engines()
+
+
+"""
+ Splits the ids of every policy into at most num_ranges (first_id, last_id) ranges of about
+ the same width.
+"""
+def policy_id_ranges(num_ranges):
+    first_id, last_id = db.session.query(func.min(Policy.id), func.max(Policy.id)).one()
+    if first_id is None:
+        return []
+    width = max(1, (last_id - first_id + num_ranges) / num_ranges)
+    return [(start, min(start + width - 1, last_id))
+            for start in range(first_id, last_id + 1, width)]
+
+
+def _run_range(task):
+    job, date_cursor, (first_id, last_id) = task
+    policy_ids = [row.id for row in db.session.query(Policy.id)
+                                              .filter(Policy.id.between(first_id, last_id))]
+    try:
+        if job == 'balances':
+            return balances_as_of(date_cursor, policy_ids)
+        if job == 'cancel':
+            report = sweep_cancellations(date_cursor, dry_run=True, policy_ids=policy_ids)
+            return {'evaluated': report['evaluated'], 'policy_ids': report['policy_ids']}
+        if job == 'reinvoice':
+            return make_invoices_bulk(policy_ids)
+        raise ValueError("Unknown job %r" % job)
+    finally:
+        db.session.remove()
+
+
+def _merge(job, results):
+    if job == 'balances':
+        balances = {}
+        for result in results:
+            balances.update(result)
+        return balances
+    if job == 'cancel':
+        evaluated = 0
+        policy_ids = []
+        for result in results:
+            evaluated += result['evaluated']
+            policy_ids.extend(result['policy_ids'])
+        return {'evaluated': evaluated, 'policy_ids': sorted(policy_ids)}
+    skipped = []
+    for result in results:
+        skipped.extend(result)
+    return sorted(skipped)
+
+
+"""
+ Runs job ('balances', 'cancel' or 'reinvoice') over the whole book with workers processes and
+ returns the merged result:
+     balances  - {policy_id: balance} as of date_cursor, like balances_as_of
+     cancel    - the sweep_cancellations report; the parent cancels the policies unless dry_run
+     reinvoice - the ids skipped for a bad billing schedule, like make_invoices_bulk
+ With a single worker everything runs in this process.
+"""
+def run_job(job, date_cursor=None, workers=None, dry_run=False,
+            ranges_per_worker=RANGES_PER_WORKER, details="Past due"):
+    if job not in JOBS:
+        raise ValueError("Unknown job %r" % job)
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    workers = workers or multiprocessing.cpu_count()
+    started = time.time()
+
+    tasks = [(job, date_cursor, id_range)
+             for id_range in policy_id_ranges(workers * ranges_per_worker)]
+    if workers == 1:
+        results = [_run_range(task) for task in tasks]
+    else:
+        # nothing open may be carried into the workers
+        db.reset_engines()
+        pool = multiprocessing.Pool(workers, initializer=_init_worker)
+        try:
+            results = list(pool.imap_unordered(_run_range, tasks))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    result = _merge(job, results)
+    if job == 'cancel':
+        if not dry_run:
+            # the one writer, every cancellation goes in one transaction
+            cancel_policies(result['policy_ids'], date_cursor, details)
+        result.update({'date': date_cursor,
+                       'dry_run': dry_run,
+                       'canceled': len(result['policy_ids']),
+                       'elapsed': time.time() - started})
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a book-wide job across several processes.')
+    parser.add_argument('job', choices=JOBS)
+    parser.add_argument('--date', help='YYYY-MM-DD (default: today)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what the cancel job would cancel without cancelling')
+    parser.add_argument('--output', help='write balances to this CSV file')
+    args = parser.parse_args(argv)
+
+    date_cursor = datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else None
+    started = time.time()
+    result = run_job(args.job, date_cursor, args.workers, args.dry_run)
+    elapsed = time.time() - started
+
+    if args.job == 'balances':
+        if args.output:
+            with open(args.output, 'wb') as output:
+                writer = csv.writer(output)
+                writer.writerow(['policy_id', 'balance'])
+                writer.writerows(sorted(result.items()))
+        print "%d balances in %.1fs with %d workers" % (len(result), elapsed, args.workers)
+    elif args.job == 'cancel':
+        print "%d policies evaluated, %d %s in %.1fs with %d workers" % (
+            result['evaluated'], result['canceled'],
+            'to cancel' if args.dry_run else 'canceled', elapsed, args.workers)
+    else:
+        print "Re-invoiced the book in %.1fs with %d workers, %d skipped" % (
+            elapsed, args.workers, len(result))
+    return 0
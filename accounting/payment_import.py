@@ -0,0 +1,195 @@
+#!/user/bin/env python2.7
+
+import argparse
+import csv
+import time
+from datetime import date
+from itertools import islice
+
+from sqlalchemy import func, select
+
+from accounting import db
+from models import Contact, Invoice, Payment, Policy
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+from tools import make_invoices_bulk
+import allocation
+import events
+import ledger
+
+
+"""
+#######################################################
+Imports payment files from the lockbox and ACH processor.
+
+A payment file is a CSV with a header row and the columns
+policy_id, contact_id, amount and transaction_date
+(YYYY-MM-DD). contact_id may be left empty to pay as the
+policy's named insured, like PolicyAccounting.make_payment.
+
+Rows are streamed and handled a chunk at a time: the
+checks for a chunk take a few grouped queries and its
+accepted payments are inserted, with their ledger entries,
+in one transaction. Rows that can't be accepted are
+written to a rejects file along with the reason.
+#######################################################
+"""
+
+# rows handled per transaction
+IMPORT_CHUNK_SIZE = 1000
+
+
+def _parse(row):
+    contact_id = row['contact_id'].strip()
+    # strptime is the slowest part of reading a row, split the YYYY-MM-DD date by hand
+    year, month, day = row['transaction_date'].strip().split('-')
+    return (int(row['policy_id']),
+            int(contact_id) if contact_id else None,
+            int(row['amount']),
+            date(int(year), int(month), int(day)))
+
+
+def _policy_details(policy_ids):
+    invoices = Invoice.__table__
+    invoice_count = select([func.count(invoices.c.id)])\
+        .where(invoices.c.policy_id == Policy.id)\
+        .as_scalar()
+
+    named_insureds = {}
+    archived = set()
+    uninvoiced = []
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        details = select([Policy.id, Policy.named_insured, Policy.archived_on, invoice_count])\
+            .where(Policy.id.in_(chunk))
+        for policy_id, named_insured, archived_on, count in db.session.execute(details):
+            named_insureds[policy_id] = named_insured
+            # an archived policy's invoices are in the archive tables, it is not invoiced again
+            if archived_on:
+                archived.add(policy_id)
+            elif not count:
+                uninvoiced.append(policy_id)
+
+    # PolicyAccounting invoices a policy that has none before taking a payment
+    if uninvoiced:
+        make_invoices_bulk(uninvoiced)
+
+    # the due dates of the invoices that aren't paid off yet, with the date they were paid off
+    # if that happened later on
+    open_invoices = {}
+    for chunk in chunks(named_insureds.keys(), IN_CLAUSE_CHUNK_SIZE):
+        unpaid = select([invoices.c.policy_id, invoices.c.due_date, invoices.c.paid,
+                         invoices.c.paid_date])\
+            .where(invoices.c.policy_id.in_(chunk))\
+            .where(invoices.c.deleted == False)\
+            .where(invoices.c.amount_due > 0)
+        for policy_id, due_date, paid, paid_date in db.session.execute(unpaid):
+            open_invoices.setdefault(policy_id, []).append((due_date, paid_date if paid else None))
+
+    return named_insureds, archived, open_invoices
+
+
+# the same rule as PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay
+def _cancellation_pending(open_invoices, date_cursor):
+    return any(due_date <= date_cursor and (paid_date is None or paid_date > date_cursor)
+               for due_date, paid_date in open_invoices)
+
+
+def _import_chunk(rows, agent_ids, rejects):
+    parsed = []
+    for row in rows:
+        try:
+            parsed.append((row, _parse(row)))
+        except (KeyError, TypeError, ValueError) as e:
+            rejects.writerow(row, 'Invalid row: %s' % e)
+
+    named_insureds, archived, open_invoices = _policy_details(set(values[0] for _, values in parsed))
+
+    payments = []
+    for row, (policy_id, contact_id, amount, transaction_date) in parsed:
+        if policy_id not in named_insureds:
+            rejects.writerow(row, 'Unknown policy')
+            continue
+
+        if policy_id in archived:
+            rejects.writerow(row, 'Policy history is archived')
+            continue
+
+        if contact_id not in agent_ids and \
+                _cancellation_pending(open_invoices.get(policy_id, ()), transaction_date):
+            rejects.writerow(row, 'Only agents may make payments on cancellation pending policies')
+            continue
+
+        contact_id = contact_id or named_insureds[policy_id]
+        if not contact_id:
+            rejects.writerow(row, 'Cannot verify contact')
+            continue
+
+        payments.append({'policy_id': policy_id,
+                         'contact_id': contact_id,
+                         'amount_paid': amount,
+                         'transaction_date': transaction_date})
+
+    if payments:
+        try:
+            db.session.execute(Payment.__table__.insert(), payments)
+            ledger.post_entries([(payment['policy_id'], payment['transaction_date'], u'Payment',
+                                  -payment['amount_paid']) for payment in payments])
+            paying = set(payment['policy_id'] for payment in payments)
+            allocation.reallocate(paying)
+            events.refresh(paying)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+    return len(payments)
+
+
+class _RejectsWriter(object):
+    """
+     Writes rejected rows to a CSV with the same columns as the payment file plus the reason.
+    """
+    def __init__(self, rejects_file, fieldnames):
+        self.count = 0
+        self._writer = csv.DictWriter(rejects_file, list(fieldnames) + ['reason'],
+                                      extrasaction='ignore')
+        self._writer.writeheader()
+
+    def writerow(self, row, reason):
+        row = dict(row)
+        row['reason'] = reason
+        self._writer.writerow(row)
+        self.count += 1
+
+
+"""
+ Imports the payment file at path, chunk_size rows per transaction, writing rejected rows to
+ rejects_path. Returns a report of how many rows were accepted and rejected.
+"""
+def import_payments(path, rejects_path, chunk_size=IMPORT_CHUNK_SIZE):
+    started = time.time()
+    agent_ids = set(contact_id for contact_id, in db.session.query(Contact.id).filter_by(role=u'Agent'))
+
+    accepted = 0
+    with open(path, 'rb') as payment_file, open(rejects_path, 'wb') as rejects_file:
+        rows = csv.DictReader(payment_file)
+        rejects = _RejectsWriter(rejects_file, rows.fieldnames or [])
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            accepted += _import_chunk(chunk, agent_ids, rejects)
+
+    return {'accepted': accepted,
+            'rejected': rejects.count,
+            'elapsed': time.time() - started}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import a CSV file of payments.')
+    parser.add_argument('path')
+    parser.add_argument('--rejects', help='where to write rejected rows (default: <path>.rejects.csv)')
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    report = import_payments(args.path, args.rejects or args.path + '.rejects.csv', args.chunk_size)
+    print "%(accepted)d payments imported, %(rejected)d rejected in %(elapsed).1fs" % report
+    return 0
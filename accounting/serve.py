@@ -0,0 +1,130 @@
+#!/user/bin/env python2.7
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from accounting import create_app, db
+
+
+"""
+#######################################################
+Multi-process serving mode.
+
+runserver.py runs Flask's debug server, which handles one
+request at a time and opens a new database connection for
+each. serve binds the port once and forks a number of
+worker processes that all accept on it, every one a
+threaded WSGI server with a pool of its own tuned SQLite
+connections (see accounting.database). The parent only
+watches the workers, starting a new one if one dies, and
+stops them all on SIGTERM or Ctrl-C.
+
+The pooled connections save some CPU on every request,
+but the workers only answer more requests than one
+process would when there are CPUs to spare for them: on
+a machine with one CPU, serve.py is about as fast with
+four workers as with one (see serve_benchmark.py).
+
+Settings come from config.py and the ACCOUNTING_* variables
+of the environment (see create_app), e.g.
+
+    ACCOUNTING_DATABASE_URI=sqlite:////data/book.sqlite \\
+    ACCOUNTING_SQLITE_SYNCHRONOUS=FULL ./serve.py --workers 4
+#######################################################
+"""
+
+# connections kept per worker when neither the settings nor --pool-size give a number
+DEFAULT_POOL_SIZE = 10
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    """
+     Leaves out the access log line the development server writes for every request.
+    """
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+def _worker(server):
+    # a fresh worker: no connection of the parent's is used, Ctrl-C ends serve_forever
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    db.reset_engines()
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+
+def _fork(server):
+    pid = os.fork()
+    if pid == 0:
+        _worker(server)
+    return pid
+
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+
+"""
+ Serves app on host:port with workers processes until stopped. The socket is bound before the
+ workers are forked, so they share it and the kernel hands each connection to one of them.
+"""
+def serve(app, host='127.0.0.1', port=5000, workers=1, access_log=False):
+    server = make_server(host, port, app, threaded=True,
+                         request_handler=WSGIRequestHandler if access_log else _QuietRequestHandler)
+    if workers <= 1:
+        server.serve_forever()
+        return
+
+    db.reset_engines()
+    signal.signal(signal.SIGTERM, _stop)
+    children = set()
+    try:
+        for _ in range(workers):
+            children.add(_fork(server))
+        while True:
+            pid, status = os.wait()
+            children.discard(pid)
+            print >> sys.stderr, "Worker %d exited (status %d), starting another" % (pid, status)
+            children.add(_fork(server))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the app with several worker processes.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--pool-size', type=int,
+                        help='database connections kept per worker (default: SQLALCHEMY_POOL_SIZE, '
+                             'or %d)' % DEFAULT_POOL_SIZE)
+    parser.add_argument('--access-log', action='store_true', help='log every request to stderr')
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    if args.pool_size or not app.config['SQLALCHEMY_POOL_SIZE']:
+        app = create_app({'SQLALCHEMY_POOL_SIZE': args.pool_size or DEFAULT_POOL_SIZE})
+
+    print >> sys.stderr, "Serving on http://%s:%d with %d workers" % (args.host, args.port, args.workers)
+    serve(app, args.host, args.port, args.workers, args.access_log)
+    return 0
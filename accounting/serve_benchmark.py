@@ -0,0 +1,235 @@
+#!/user/bin/env python2.7
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+from sqlalchemy import func
+
+from accounting import db
+from models import Policy
+
+
+"""
+#######################################################
+Throughput of serve.py against runserver.py.
+
+Each server is started on its own against the same
+database, warmed up, and then kept busy for a while by a
+number of client threads, spread over several processes,
+posting /policyInfo for policies picked at random with a
+seed, the way agents look them up. The requests answered
+per second and the errors are reported for both, with the
+CPU time the server and the clients used: extra workers
+only help while the server is short of CPUs, and the
+clients share the same machine.
+#######################################################
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runserver.py always listens here
+RUNSERVER_PORT = 5000
+SERVE_PORT = 5001
+
+# the date the policies are asked about
+AS_OF = '2016-01-01'
+
+# requests made before the clock starts
+WARMUP_REQUESTS = 20
+
+# a run whose server and clients keep the CPUs this busy is held back by the machine itself
+CPU_BOUND = 0.9
+
+
+def _start(arguments, database_uri):
+    environ = dict(os.environ, ACCOUNTING_DATABASE_URI=database_uri)
+    with open(os.devnull, 'w') as devnull:
+        # a group of its own, so the reloader runserver.py starts goes down with it
+        return subprocess.Popen([sys.executable] + arguments, cwd=ROOT, env=environ,
+                                stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+
+
+def _stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    process.wait()
+
+
+def _wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib2.urlopen(url, timeout=5).read()
+            return
+        except (urllib2.URLError, IOError):
+            if time.time() > deadline:
+                raise RuntimeError("%s didn't come up within %ds" % (url, timeout))
+            time.sleep(0.2)
+
+
+def _post_policy_info(url, policy_id):
+    data = urllib.urlencode({'policy_number': policy_id, 'invoice_date': AS_OF})
+    urllib2.urlopen(url + '/policyInfo', data, timeout=30).read()
+
+
+def _client(arguments):
+    # one client process: a thread for each offset, sending until the deadline
+    url, policy_ids, offsets, stride, deadline = arguments
+    counts = {'requests': 0, 'errors': 0}
+    lock = threading.Lock()
+    cpu_before = sum(os.times()[:2])
+
+    def client(offset):
+        position = offset
+        while time.time() < deadline:
+            try:
+                _post_policy_info(url, policy_ids[position % len(policy_ids)])
+                outcome = 'requests'
+            except (urllib2.URLError, IOError):
+                outcome = 'errors'
+            with lock:
+                counts[outcome] += 1
+            position += stride
+
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in offsets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts['requests'], counts['errors'], sum(os.times()[:2]) - cpu_before
+
+
+def _group_cpu_seconds(group):
+    # CPU time used so far by the live processes of a process group, None without /proc
+    if not os.path.isdir('/proc'):
+        return None
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as stat:
+                # the fields after the command name: state, ppid, pgrp, ..., utime, stime
+                fields = stat.read().rpartition(')')[2].split()
+        except IOError:
+            continue
+        if int(fields[2]) == group:
+            total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+"""
+ Posts /policyInfo to the server at url for the policies in policy_ids, from concurrency
+ threads at once spread over client_processes processes, for duration seconds. A single
+ process of urllib2 threads is held back by the GIL long before a server with several
+ workers is, so the clients get processes of their own. Returns the requests answered, the
+ errors, the requests answered per second and the CPU seconds the clients used.
+"""
+def drive(url, policy_ids, concurrency, duration, client_processes=1):
+    for policy_id in policy_ids[:WARMUP_REQUESTS]:
+        _post_policy_info(url, policy_id)
+
+    client_processes = max(1, min(client_processes, concurrency))
+    deadline = time.time() + duration
+    work = [(url, policy_ids, range(concurrency)[index::client_processes], concurrency, deadline)
+            for index in range(client_processes)]
+
+    started = time.time()
+    pool = multiprocessing.Pool(client_processes)
+    try:
+        outcomes = pool.map(_client, work)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+
+    requests = sum(outcome[0] for outcome in outcomes)
+    return {'requests': requests,
+            'errors': sum(outcome[1] for outcome in outcomes),
+            'seconds': elapsed,
+            'requests_per_second': requests / elapsed,
+            'client_cpu_seconds': sum(outcome[2] for outcome in outcomes)}
+
+
+def _measure(arguments, port, database_uri, policy_ids, concurrency, duration, client_processes):
+    process = _start(arguments, database_uri)
+    url = 'http://127.0.0.1:%d' % port
+    try:
+        _wait_until_up(url + '/')
+        cpu_before = _group_cpu_seconds(process.pid)
+        results = drive(url, policy_ids, concurrency, duration, client_processes)
+        cpu_after = _group_cpu_seconds(process.pid)
+    finally:
+        _stop(process)
+    results['server_cpu_seconds'] = None if cpu_before is None else cpu_after - cpu_before
+    return results
+
+
+"""
+ Times runserver.py and serve.py with workers processes against the database of the app, and
+ returns {server: results} along with the gain of serve.py.
+"""
+def run_benchmark(workers, concurrency=8, duration=10, samples=500, seed=0, client_processes=None):
+    client_processes = client_processes or multiprocessing.cpu_count()
+    database_uri = str(db.engine.url)
+    max_id = db.session.query(func.max(Policy.id)).scalar()
+    rng = random.Random(seed)
+    policy_ids = [rng.randint(1, max_id) for _ in range(samples)]
+    db.session.remove()
+
+    results = {'concurrency': concurrency, 'duration': duration, 'workers': workers,
+               'client_processes': client_processes, 'cpus': multiprocessing.cpu_count(), 'servers': {}}
+    for name, arguments, port in (
+            ('runserver.py', ['runserver.py'], RUNSERVER_PORT),
+            ('serve.py', ['serve.py', '--port', str(SERVE_PORT), '--workers', str(workers)], SERVE_PORT)):
+        results['servers'][name] = measured = _measure(arguments, port, database_uri, policy_ids, concurrency,
+                                                       duration, client_processes)
+        print "%-14s %8.1f requests/s %6d errors  CPU: server %s, clients %.1fs of %.1fs on %d CPUs" % (
+            name, measured['requests_per_second'], measured['errors'],
+            '-' if measured['server_cpu_seconds'] is None else '%.1fs' % measured['server_cpu_seconds'],
+            measured['client_cpu_seconds'], measured['seconds'], results['cpus'])
+        if measured['server_cpu_seconds'] is not None:
+            measured['cpu_busy'] = (measured['server_cpu_seconds'] + measured['client_cpu_seconds']) / (
+                measured['seconds'] * results['cpus'])
+            if measured['cpu_busy'] >= CPU_BOUND:
+                print "%-14s the CPUs were %.0f%% busy, more workers can't help on this machine" % (
+                    '', measured['cpu_busy'] * 100)
+
+    baseline = results['servers']['runserver.py']['requests_per_second']
+    results['gain'] = results['servers']['serve.py']['requests_per_second'] / baseline if baseline else None
+    if results['gain']:
+        print "serve.py answers %.1fx the requests of runserver.py" % results['gain']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the throughput of serve.py and runserver.py.')
+    parser.add_argument('--workers', type=int, default=2, help='serve.py worker processes')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--client-processes', type=int,
+                        help='processes the client threads are spread over (default: one per CPU)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds each server is driven')
+    parser.add_argument('--samples', type=int, default=500, help='policies asked about')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.workers, args.concurrency, args.duration, args.samples, args.seed,
+                            args.client_processes)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
@@ -0,0 +1,189 @@
+#!/user/bin/env python2.7
+
+from array import array
+from bisect import bisect_right
+from datetime import date
+from itertools import groupby
+
+from accounting import db
+from models import ArchivedInvoice, ArchivedPayment, Invoice, Payment
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+import archive
+
+
+"""
+#######################################################
+A read-only, in-memory copy of one policy's account.
+
+Loading takes two queries, after which balance,
+cancellation pending, should-cancel and timeline
+questions can be asked for any date without touching the
+database again. Dates are kept as sorted arrays of day
+numbers next to prefix sums of the amounts, so each
+question is a binary search.
+
+A snapshot does not notice later writes, PolicyAccounting
+drops its snapshot whenever it takes a payment or
+re-invoices.
+#######################################################
+"""
+
+
+def _prefix_sums(amounts):
+    sums = array('l', [0])
+    for amount in amounts:
+        sums.append(sums[-1] + amount)
+    return sums
+
+
+"""
+ Reads the invoice rows (policy_id, bill_date, due_date, cancel_date, amount_due, deleted,
+ paid, paid_date) and payment rows (policy_id, transaction_date, amount_paid) of every policy
+ in policy_ids, from the archive tables for archived policies, and returns them as two
+ {policy_id: [rows]} dicts with an entry, possibly empty, for every policy asked about.
+"""
+def load_account_rows(policy_ids):
+    policy_ids = set(policy_ids)
+    invoices = dict((policy_id, []) for policy_id in policy_ids)
+    payments = dict((policy_id, []) for policy_id in policy_ids)
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        _load_rows(invoices, payments, Invoice, Payment, chunk)
+        # the archive tables are only read for the policies that have been archived
+        archived = archive.archived_ids(chunk)
+        if archived:
+            _load_rows(invoices, payments, ArchivedInvoice, ArchivedPayment, archived)
+
+    return invoices, payments
+
+
+def _load_rows(invoices, payments, invoice_model, payment_model, policy_ids):
+    invoice_rows = db.session.query(invoice_model.policy_id, invoice_model.bill_date,
+                                    invoice_model.due_date, invoice_model.cancel_date,
+                                    invoice_model.amount_due, invoice_model.deleted,
+                                    invoice_model.paid, invoice_model.paid_date)\
+                             .filter(invoice_model.policy_id.in_(policy_ids))\
+                             .order_by(invoice_model.policy_id)
+    for policy_id, rows in groupby(invoice_rows, lambda row: row.policy_id):
+        invoices[policy_id].extend(rows)
+
+    payment_rows = db.session.query(payment_model.policy_id, payment_model.transaction_date,
+                                    payment_model.amount_paid)\
+                             .filter(payment_model.policy_id.in_(policy_ids))\
+                             .order_by(payment_model.policy_id)
+    for policy_id, rows in groupby(payment_rows, lambda row: row.policy_id):
+        payments[policy_id].extend(rows)
+
+
+class AccountSnapshot(object):
+    """
+     Built from invoice rows (bill_date, due_date, cancel_date, amount_due, deleted) and
+     payment rows (transaction_date, amount_paid), in any order. Use AccountSnapshot.load to
+     read them for a policy.
+    """
+    def __init__(self, invoices, payments):
+        invoices = list(invoices)
+        bills = sorted((invoice.bill_date.toordinal(), invoice.amount_due)
+                       for invoice in invoices if not invoice.deleted)
+        self._bill_days = array('l', [day for day, _ in bills])
+        self._billed = _prefix_sums(amount for _, amount in bills)
+
+        payments = sorted((payment.transaction_date.toordinal(), payment.amount_paid)
+                          for payment in payments)
+        self._payment_days = array('l', [day for day, _ in payments])
+        self._paid = _prefix_sums(amount for _, amount in payments)
+
+        # payments go to the invoices oldest due date first (see accounting.allocation), so an
+        # invoice is open on a day until the payments up to then cover it and every invoice
+        # due before it
+        dues = sorted((invoice.due_date.toordinal(), invoice.cancel_date.toordinal(),
+                       invoice.amount_due) for invoice in invoices if not invoice.deleted)
+        self._due_days = array('l', [day for day, _, _ in dues])
+        self._owed = _prefix_sums(amount for _, _, amount in dues)
+        self._cancel_checks = sorted(
+            (cancel_day, self._owed[bisect_right(self._due_days, due_day)])
+            for due_day, cancel_day, amount in dues if amount > 0)
+
+    """
+     Reads the invoices and payments of policy, from the archive tables if it is archived, and
+     returns a snapshot of them.
+    """
+    @classmethod
+    def load(cls, policy):
+        invoice_model = archive.invoice_model(policy)
+        payment_model = archive.payment_model(policy)
+        policy_id = policy.id
+        invoices = db.session.query(invoice_model.bill_date, invoice_model.due_date,
+                                    invoice_model.cancel_date, invoice_model.amount_due,
+                                    invoice_model.deleted)\
+                             .filter(invoice_model.policy_id == policy_id)\
+                             .all()
+        payments = db.session.query(payment_model.transaction_date, payment_model.amount_paid)\
+                             .filter(payment_model.policy_id == policy_id)\
+                             .all()
+        return cls(invoices, payments)
+
+    """
+     Reads the invoices and payments of every policy in policy_ids with load_account_rows and
+     returns {policy_id: snapshot}. Policies that don't exist get an empty snapshot.
+    """
+    @classmethod
+    def load_many(cls, policy_ids):
+        invoices, payments = load_account_rows(policy_ids)
+        return dict((policy_id, cls(invoices[policy_id], payments[policy_id]))
+                    for policy_id in invoices)
+
+    def _paid_on(self, day):
+        return self._paid[bisect_right(self._payment_days, day)]
+
+    def _balance_on(self, day):
+        return self._billed[bisect_right(self._bill_days, day)] - self._paid_on(day)
+
+    """
+     Same as PolicyAccounting.return_account_balance.
+    """
+    def balance(self, date_cursor):
+        return self._balance_on(date_cursor.toordinal())
+
+    """
+     Same as PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay.
+    """
+    def cancellation_pending(self, date_cursor):
+        day = date_cursor.toordinal()
+        return self._paid_on(day) < self._owed[bisect_right(self._due_days, day)]
+
+    """
+     True when PolicyAccounting.evaluate_cancel would cancel the policy on date_cursor: some
+     invoice's cancel_date has passed with the invoice still unpaid on that date.
+    """
+    def should_cancel(self, date_cursor):
+        day = date_cursor.toordinal()
+        for cancel_day, owed in self._cancel_checks:
+            if cancel_day > day:
+                break
+            if self._paid_on(cancel_day) < owed:
+                return True
+        return False
+
+    """
+     Returns (date, event, delta, balance) for every bill and payment dated from start to end
+     (inclusive, either may be None for no limit) in date order, where balance is the account
+     balance after the event. Bills come before payments made on the same day.
+    """
+    def timeline(self, start=None, end=None):
+        events = [(day, 0, 'Bill', self._billed[i + 1] - self._billed[i])
+                  for i, day in enumerate(self._bill_days)]
+        events.extend((day, 1, 'Payment', self._paid[i] - self._paid[i + 1])
+                      for i, day in enumerate(self._payment_days))
+        events.sort()
+
+        start = start.toordinal() if start else None
+        end = end.toordinal() if end else None
+        rows = []
+        balance = 0
+        for day, _, event, delta in events:
+            balance += delta
+            if end is not None and day > end:
+                break
+            if start is None or day >= start:
+                rows.append((date.fromordinal(day), event, delta, balance))
+        return rows
@@ -0,0 +1,84 @@
+#!/user/bin/env python2.7
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+"""
+#######################################################
+Import and startup time of the entry points.
+
+Each case is run in a fresh interpreter a number of
+times and the wall time of every run is taken, from
+starting the process to its exit, along with the modules
+it had loaded. The import cases cover what shell.py and
+runserver.py load (the whole web app) against the engine
+on its own; the command cases run accounting_cli.py the
+way a cron job would.
+#######################################################
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# prints the number of modules loaded and whether the views were among them
+_REPORT = "; import sys; print len(sys.modules), 'accounting.views' in sys.modules"
+
+# (name, python arguments, whether it ends with _REPORT's line)
+CASES = (
+    ('python', ['-c', 'pass' + _REPORT], True),
+    ('web app (shell.py, runserver.py)',
+     ['-c', 'from accounting import create_app; create_app()' + _REPORT], True),
+    ('engine (accounting.tools)', ['-c', 'import accounting.tools' + _REPORT], True),
+    ('accounting_cli.py --help', ['accounting_cli.py', '--help'], False),
+)
+
+
+def _run(arguments, reports):
+    started = time.time()
+    output = subprocess.check_output([sys.executable] + arguments, cwd=ROOT)
+    elapsed = (time.time() - started) * 1000
+    if not reports:
+        return elapsed, None, None
+    modules, views = output.split()[-2:]
+    return elapsed, int(modules), views == 'True'
+
+
+"""
+ Runs every case of cases repeats times, plus a command case for each of commands (lists of
+ accounting_cli.py arguments), and returns {case: {'min_ms', 'median_ms', 'modules', 'views'}}.
+"""
+def run_benchmark(repeats=10, commands=(), cases=CASES):
+    cases = list(cases) + [('accounting_cli.py ' + ' '.join(command), ['accounting_cli.py'] + list(command), False)
+                           for command in commands]
+    results = {}
+    for name, arguments, reports in cases:
+        runs = [_run(arguments, reports) for _ in range(repeats)]
+        timings = sorted(elapsed for elapsed, _, _ in runs)
+        results[name] = {'min_ms': timings[0],
+                         'median_ms': timings[len(timings) // 2],
+                         'modules': runs[-1][1],
+                         'views': runs[-1][2]}
+        print "%-40s %8.1fms median %8.1fms min %s" % (
+            name, results[name]['median_ms'], results[name]['min_ms'],
+            '' if results[name]['modules'] is None else '%5d modules%s' % (
+                results[name]['modules'], ', views loaded' if results[name]['views'] else ''))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the import and startup of the entry points.')
+    parser.add_argument('--repeats', type=int, default=10, help='runs of each case')
+    parser.add_argument('--command', action='append', default=[], metavar='ARGUMENTS',
+                        help='also time accounting_cli.py with these arguments, e.g. "balance 1 --date 2016-01-01"')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.repeats, [command.split() for command in args.command])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
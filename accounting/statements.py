@@ -0,0 +1,125 @@
+#!/user/bin/env python2.7
+
+import argparse
+import csv
+import sys
+from datetime import datetime
+
+from sqlalchemy import literal, literal_column, select, union_all
+
+from accounting import db
+from aging import Echo
+from models import ArchivedInvoice, ArchivedPayment, Invoice, Payment
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+
+
+"""
+#######################################################
+Account statements: the balance after every bill and
+every payment over a policy's life.
+
+The non-deleted invoices and the payments of a policy,
+from the archive tables as well, come back from the
+database as one stream sorted by date (bills before the
+payments of the same day) that the running balance is
+worked out from as it is read. Statements for many
+policies are one such stream sorted by policy first, so
+only the row being read is held in memory however many
+policies or events there are.
+#######################################################
+"""
+
+COLUMNS = ['policy_id', 'date', 'event', 'delta', 'balance']
+
+# bills sort ahead of the payments made on the same day, as in AccountSnapshot.timeline
+_BILL = 0
+_PAYMENT = 1
+EVENT_NAMES = {_BILL: 'Bill', _PAYMENT: 'Payment'}
+
+
+def _bills(invoice_model, policy_ids, end):
+    query = select([invoice_model.policy_id.label('policy_id'),
+                    invoice_model.bill_date.label('event_date'),
+                    literal(_BILL).label('kind'),
+                    invoice_model.id.label('row_id'),
+                    invoice_model.amount_due.label('delta')])\
+        .where(invoice_model.deleted == False)
+    if policy_ids is not None:
+        query = query.where(invoice_model.policy_id.in_(policy_ids))
+    if end is not None:
+        query = query.where(invoice_model.bill_date <= end)
+    return query
+
+
+def _payments(payment_model, policy_ids, end):
+    query = select([payment_model.policy_id.label('policy_id'),
+                    payment_model.transaction_date.label('event_date'),
+                    literal(_PAYMENT).label('kind'),
+                    payment_model.id.label('row_id'),
+                    (-payment_model.amount_paid).label('delta')])
+    if policy_ids is not None:
+        query = query.where(payment_model.policy_id.in_(policy_ids))
+    if end is not None:
+        query = query.where(payment_model.transaction_date <= end)
+    return query
+
+
+def _statement_stream(policy_ids, end):
+    # the events before start are read too, the running balance has to start from them
+    rows = union_all(_bills(Invoice, policy_ids, end), _bills(ArchivedInvoice, policy_ids, end),
+                     _payments(Payment, policy_ids, end), _payments(ArchivedPayment, policy_ids, end))\
+        .order_by(literal_column('policy_id'), literal_column('event_date'),
+                  literal_column('kind'), literal_column('row_id'))
+    # stream_results asks drivers that buffer by default (psycopg2) for a server-side cursor
+    return db.session.execute(rows.execution_options(stream_results=True))
+
+
+"""
+ Yields (policy_id, date, event, delta, balance) for every bill and payment of the policies in
+ policy_ids (every policy if None) dated from start to end (inclusive, either may be None for no
+ limit), by policy and then by date, where balance is the policy's account balance after the
+ event. Policies are read IN_CLAUSE_CHUNK_SIZE at a time, one streaming query each.
+"""
+def statement_rows(policy_ids=None, start=None, end=None):
+    policy_chunks = [None] if policy_ids is None else chunks(sorted(set(policy_ids)), IN_CLAUSE_CHUNK_SIZE)
+    for chunk in policy_chunks:
+        current_policy = None
+        for row in _statement_stream(chunk, end):
+            if row['policy_id'] != current_policy:
+                current_policy = row['policy_id']
+                balance = 0
+            balance += row['delta']
+            if start is None or row['event_date'] >= start:
+                yield (current_policy, row['event_date'], EVENT_NAMES[row['kind']], row['delta'], balance)
+
+
+"""
+ Yields the statements of statement_rows as CSV text, one line at a time, header first.
+"""
+def statement_csv(policy_ids=None, start=None, end=None):
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for policy_id, event_date, event, delta, balance in statement_rows(policy_ids, start, end):
+        yield writer.writerow([policy_id, event_date.isoformat(), event, delta, balance])
+
+
+def _parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write account statements as CSV.')
+    parser.add_argument('policy_ids', nargs='*', type=int, help='policies to write (default: every policy)')
+    parser.add_argument('--start', type=_parse_date, help='YYYY-MM-DD, first date listed (default: the first event)')
+    parser.add_argument('--end', type=_parse_date, help='YYYY-MM-DD, last date listed (default: the last event)')
+    parser.add_argument('--output', help='write the statements to this file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for line in statement_csv(args.policy_ids or None, args.start, args.end):
+            output.write(line)
+    finally:
+        if args.output:
+            output.close()
+    return 0
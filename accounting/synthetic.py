@@ -0,0 +1,153 @@
+#!/user/bin/env python2.7
+
+import random
+from datetime import date, timedelta
+
+from sqlalchemy import func
+
+from accounting import db
+from models import Contact, Payment, Policy
+from tools import BILLING_SCHEDULES, installment_dates, make_invoices_bulk
+
+
+"""
+#######################################################
+Generates synthetic books of policies for benchmarking.
+
+The same seed always produces the same book. Policies are
+spread across every billing schedule and each one gets a
+payer profile that decides how its invoices get paid:
+on time, late (during cancellation pending, by the agent),
+partially, or not at all after some point.
+#######################################################
+"""
+
+# preset book sizes used by the benchmark runner
+BOOK_SIZES = {'small': 1000, 'medium': 100000, 'large': 1000000}
+
+# relative weights of each payer profile
+PAYER_PROFILES = (('on_time', 60), ('late', 15), ('partial', 10), ('missing', 15))
+
+# one agent for every AGENT_RATIO policies
+AGENT_RATIO = 50
+
+# policies written per transaction
+GENERATE_CHUNK_SIZE = 5000
+
+
+def _weighted_choice(rng, choices):
+    total = sum(weight for _, weight in choices)
+    pick = rng.uniform(0, total)
+    for choice, weight in choices:
+        pick -= weight
+        if pick <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+"""
+ Returns the payments, as dicts ready for insertion, that a payer with the given profile makes
+ against installments (a list of (bill_date, due_date, cancel_date) tuples), skipping
+ anything that would happen after as_of.
+"""
+def _payments_for(rng, profile, policy_id, insured_id, agent_id, installments, amount_due, as_of):
+    payments = []
+    stop_after = rng.randint(0, len(installments) - 1) if profile == 'missing' else None
+
+    for number, (bill_date, due_date, cancel_date) in enumerate(installments):
+        if stop_after is not None and number >= stop_after:
+            break
+
+        contact_id = insured_id
+        amount = amount_due
+        if profile == 'late' and rng.random() < 0.5:
+            # paid while cancellation is pending, which only an agent may do
+            transaction_date = due_date + timedelta(days=rng.randint(1, (cancel_date - due_date).days))
+            contact_id = agent_id
+        else:
+            transaction_date = bill_date + timedelta(days=rng.randint(0, (due_date - bill_date).days - 1))
+            if profile == 'partial':
+                amount = amount_due * rng.randint(50, 90) / 100
+
+        if transaction_date > as_of:
+            break
+        payments.append({'policy_id': policy_id,
+                         'contact_id': contact_id,
+                         'amount_paid': amount,
+                         'transaction_date': transaction_date})
+    return payments
+
+
+"""
+ Adds a book of num_policies generated policies, with their contacts, invoices, payments and
+ ledger entries, to the current database. Effective dates are spread over the three years
+ before as_of and no payment is dated after as_of. Returns the number of rows written to each
+ table.
+"""
+def generate_book(num_policies, seed=0, as_of=date(2016, 1, 1), chunk_size=GENERATE_CHUNK_SIZE):
+    rng = random.Random(seed)
+    schedules = list(Policy.__table__.c.billing_schedule.type.enums)
+    first_effective_date = as_of - timedelta(days=3 * 365)
+
+    contact_id = _next_id(Contact)
+    policy_id = _next_id(Policy)
+
+    num_agents = max(1, num_policies / AGENT_RATIO)
+    agent_ids = range(contact_id, contact_id + num_agents)
+    db.session.execute(Contact.__table__.insert(),
+                       [{'id': agent_id, 'name': 'Agent %d' % agent_id, 'role': u'Agent'}
+                        for agent_id in agent_ids])
+    contact_id += num_agents
+
+    counts = {'contacts': num_agents, 'policies': 0, 'payments': 0}
+    dates_cache = {}
+    remaining = num_policies
+    while remaining > 0:
+        chunk = min(chunk_size, remaining)
+        remaining -= chunk
+
+        contacts, policies, payments = [], [], []
+        for _ in range(chunk):
+            insured_id = contact_id
+            contact_id += 1
+            contacts.append({'id': insured_id,
+                             'name': 'Insured %d' % insured_id,
+                             'role': u'Named Insured'})
+
+            schedule = rng.choice(schedules)
+            effective_date = first_effective_date + timedelta(days=rng.randint(0, 3 * 365 - 1))
+            annual_premium = rng.randint(300, 3000)
+            agent_id = rng.choice(agent_ids)
+            policies.append({'id': policy_id,
+                             'policy_number': 'Policy %d' % policy_id,
+                             'effective_date': effective_date,
+                             'status': u'Active',
+                             'billing_schedule': schedule,
+                             'annual_premium': annual_premium,
+                             'named_insured': insured_id,
+                             'agent': agent_id})
+
+            key = (effective_date, schedule)
+            if key not in dates_cache:
+                dates_cache[key] = installment_dates(effective_date, BILLING_SCHEDULES[schedule])
+            payments.extend(_payments_for(rng, _weighted_choice(rng, PAYER_PROFILES),
+                                          policy_id, insured_id, agent_id, dates_cache[key],
+                                          annual_premium / BILLING_SCHEDULES[schedule], as_of))
+            policy_id += 1
+
+        db.session.execute(Contact.__table__.insert(), contacts)
+        db.session.execute(Policy.__table__.insert(), policies)
+        if payments:
+            db.session.execute(Payment.__table__.insert(), payments)
+        # commits the chunk along with its invoices and ledger entries
+        make_invoices_bulk([policy['id'] for policy in policies])
+
+        counts['contacts'] += len(contacts)
+        counts['policies'] += len(policies)
+        counts['payments'] += len(payments)
+
+    return counts
@@ -1,40 +1,109 @@
 #!/user/bin/env python2.7
 
+import csv
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
+from StringIO import StringIO
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import func, select
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from tools import PolicyAccounting
+import json
+
+from accounting import create_app, db
+from web import app
+from database import apply_sqlite_pragmas, environ_config
+from models import ArchivedInvoice, ArchivedPayment, CanceledPolicy, Contact, Invoice, Payment, Policy, \
+    PolicyEvent, PolicyLedger
+from tools import PolicyAccounting, balances_as_of, change_billing_schedule_bulk, make_invoices_bulk, \
+    overdue_policy_ids, run_daily, sweep_cancellations, upgrade_db
+from ledger import rebuild_ledger, verify_ledger
+import ledger
+from events import mark_processed
+from batch import accounting_batch
+from archive import archive_deleted_invoices, archive_policies, closed_policy_ids
+import archive
+from columnar import export_book, numpy
+from analytics import Book, balances, check_sample, month_ends, portfolio
+from synthetic import generate_book
+from benchmark import StatementCounter, compare
+import loadtest
+from payment_import import import_payments
+from snapshot import AccountSnapshot
+from cache import LRUCache
+from views import policy_cache
+from parallel import policy_id_ranges, run_job
+import parallel
+from aging import aging_rows
+from statements import statement_rows
+import allocation
+import cli
+import metrics
 
 """
 #######################################################
 Test Suite for PolicyAccounting
 #######################################################
 """
+def setUpModule():
+    # the tests run against the existing database, make sure its schema is current
+    upgrade_db()
+
+
+# every table with a policy_id, deleted from before the policies themselves
+POLICY_TABLES = (PolicyEvent, PolicyLedger, Invoice, Payment, ArchivedInvoice, ArchivedPayment, CanceledPolicy)
+
+
+"""
+ Deletes the policies in policy_ids and every row that belongs to them.
+"""
+def delete_policies(policy_ids):
+    for model in POLICY_TABLES:
+        model.query.filter(model.policy_id.in_(policy_ids)).delete(synchronize_session=False)
+    Policy.query.filter(Policy.id.in_(policy_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+"""
+ Adds the 'Test Agent' and 'Test Insured' contacts a test class makes its policies with and
+ returns their ids, for delete_contacts to remove when the class is done.
+"""
+def add_contacts():
+    agent = Contact('Test Agent', 'Agent')
+    insured = Contact('Test Insured', 'Named Insured')
+    db.session.add(agent)
+    db.session.add(insured)
+    db.session.commit()
+    return agent.id, insured.id
+
+
+def delete_contacts(contact_ids):
+    Contact.query.filter(Contact.id.in_(contact_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+
 class TestBillingSchedules(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.test_agent = Contact('Test Agent', 'Agent')
-        cls.test_insured = Contact('Test Insured', 'Named Insured')
-        db.session.add(cls.test_agent)
-        db.session.add(cls.test_insured)
-        db.session.commit()
+        cls.agent_id, cls.insured_id = add_contacts()
 
         cls.policy = Policy('Test Policy', date(2015, 1, 1), 1300)
         db.session.add(cls.policy)
-        cls.policy.named_insured = cls.test_insured.id
-        cls.policy.agent = cls.test_agent.id
+        cls.policy.named_insured = cls.insured_id
+        cls.policy.agent = cls.agent_id
         db.session.commit()
 
     @classmethod
     def tearDownClass(cls):
-        db.session.delete(cls.test_insured)
-        db.session.delete(cls.test_agent)
-        db.session.delete(cls.policy)
-        db.session.commit()
+        delete_policies([cls.policy.id])
+        delete_contacts([cls.agent_id, cls.insured_id])
 
     def setUp(self):
         pass
@@ -70,24 +139,18 @@ class TestReturnAccountBalance(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.test_agent = Contact('Test Agent', 'Agent')
-        cls.test_insured = Contact('Test Insured', 'Named Insured')
-        db.session.add(cls.test_agent)
-        db.session.add(cls.test_insured)
-        db.session.commit()
+        cls.agent_id, cls.insured_id = add_contacts()
 
         cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
-        cls.policy.named_insured = cls.test_insured.id
-        cls.policy.agent = cls.test_agent.id
+        cls.policy.named_insured = cls.insured_id
+        cls.policy.agent = cls.agent_id
         db.session.add(cls.policy)
         db.session.commit()
 
     @classmethod
     def tearDownClass(cls):
-        db.session.delete(cls.test_insured)
-        db.session.delete(cls.test_agent)
-        db.session.delete(cls.policy)
-        db.session.commit()
+        delete_policies([cls.policy.id])
+        delete_contacts([cls.agent_id, cls.insured_id])
 
     def setUp(self):
         self.payments = []
@@ -148,3 +211,1416 @@ class TestReturnAccountBalance(unittest.TestCase):
                             date_cursor=invoice.due_date+relativedelta(days=21), amount=100)
         
         self.assertFalse(p)
+
+
+class TestBalancesAsOf(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+        cls.policies = []
+        for schedule in ('Annual', 'Two-Pay', 'Quarterly', 'Monthly'):
+            policy = Policy('Test Policy %s' % schedule, date(2015, 1, 1), 1200)
+            policy.billing_schedule = schedule
+            policy.named_insured = cls.insured_id
+            policy.agent = cls.agent_id
+            db.session.add(policy)
+            cls.policies.append(policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_policies([policy.id for policy in cls.policies])
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def test_matches_return_account_balance(self):
+        accounts = [PolicyAccounting(policy.id) for policy in self.policies]
+        self.assertTrue(accounts[2].make_payment(contact_id=self.insured_id,
+                                                 date_cursor=date(2015, 1, 15), amount=300))
+        # a deleted invoice should not count towards the balance
+        accounts[3].policy.invoices[0].deleted = True
+        db.session.commit()
+
+        policy_ids = [policy.id for policy in self.policies]
+        for date_cursor in (date(2014, 12, 31), date(2015, 1, 1), date(2015, 2, 1),
+                            date(2015, 7, 1), date(2016, 1, 1)):
+            balances = balances_as_of(date_cursor, policy_ids)
+            for pa in accounts:
+                self.assertEquals(balances[pa.policy.id],
+                                  pa.return_account_balance(date_cursor))
+
+    def test_partial_and_late_payments(self):
+        accounts = [PolicyAccounting(policy.id) for policy in self.policies]
+        # short of the first Quarterly installment, then paid up after its due date
+        accounts[2].make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=120)
+        accounts[2].make_payment(contact_id=self.insured_id, date_cursor=date(2015, 2, 10), amount=180)
+        # Monthly installments paid a month late, then more than is owed
+        accounts[3].make_payment(contact_id=self.insured_id, date_cursor=date(2015, 3, 5), amount=100)
+        accounts[3].make_payment(contact_id=self.insured_id, date_cursor=date(2015, 6, 1), amount=550)
+
+        policy_ids = [policy.id for policy in self.policies]
+        for date_cursor in (date(2015, 1, 20), date(2015, 2, 9), date(2015, 2, 10), date(2015, 3, 5),
+                            date(2015, 5, 31), date(2015, 6, 1), date(2015, 12, 31)):
+            balances = balances_as_of(date_cursor, policy_ids)
+            for pa in accounts:
+                self.assertEquals(balances[pa.policy.id], pa.return_account_balance(date_cursor))
+
+
+class TestSweepCancellations(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.unpaid = Policy('Test Unpaid', date(2015, 1, 1), 1200)
+        self.paid = Policy('Test Paid', date(2015, 1, 1), 1200)
+        for policy in (self.unpaid, self.paid):
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.insured_id
+            policy.agent = self.agent_id
+            db.session.add(policy)
+        db.session.commit()
+        self.policy_ids = [self.unpaid.id, self.paid.id]
+
+        for policy in (self.unpaid, self.paid):
+            PolicyAccounting(policy.id)
+        # the first installment is paid on time, so only the unpaid policy is behind
+        PolicyAccounting(self.paid.id).make_payment(contact_id=self.insured_id,
+                                                    date_cursor=date(2015, 1, 15), amount=300)
+
+    def tearDown(self):
+        delete_policies(self.policy_ids)
+
+    def test_cancels_only_policies_owing_on_a_cancel_date(self):
+        report = sweep_cancellations(date(2015, 3, 1), policy_ids=self.policy_ids)
+        self.assertEquals(report['evaluated'], 2)
+        self.assertEquals(report['policy_ids'], [self.unpaid.id])
+        self.assertEquals(self.unpaid.status, 'Canceled')
+        self.assertEquals(self.paid.status, 'Active')
+        cancellation = CanceledPolicy.query.filter_by(policy_id=self.unpaid.id).one()
+        self.assertEquals(cancellation.cancellation_date, date(2015, 3, 1))
+
+    def test_matches_balances_on_cancel_dates(self):
+        # on a Quarterly schedule nothing billed by an invoice's cancel date is due after it, so the
+        # invoice is still open then exactly when the balance on that date is above zero
+        payments = [[(date(2015, 1, 15), 200)],                             # partial
+                    [(date(2015, 2, 10), 300)],                             # after the due date
+                    [(date(2015, 2, 16), 300)],                             # after the cancel date
+                    [(date(2015, 1, 15), 300), (date(2015, 5, 20), 300)],   # second one late
+                    [(date(2015, 1, 15), 250), (date(2015, 2, 14), 50)],   # made up in two parts
+                    [(date(2015, 1, 1), 600)]]                              # in advance
+        accounts = []
+        for number, policy_payments in enumerate(payments):
+            policy = Policy('Test Payments %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.insured_id
+            policy.agent = self.agent_id
+            db.session.add(policy)
+            db.session.commit()
+            self.policy_ids.append(policy.id)
+            pa = PolicyAccounting(policy.id)
+            for transaction_date, amount in policy_payments:
+                pa.make_payment(contact_id=self.insured_id, date_cursor=transaction_date, amount=amount)
+            accounts.append(pa)
+
+        cancel_dates = [date(2015, 2, 15), date(2015, 5, 15), date(2015, 8, 15), date(2015, 11, 15)]
+        for date_cursor in (date(2015, 2, 14), date(2015, 2, 15), date(2015, 3, 1), date(2015, 5, 15),
+                            date(2015, 6, 1), date(2015, 12, 31)):
+            expected = sorted(pa.policy.id for pa in accounts
+                              if any(pa.return_account_balance(cancel_date) > 0
+                                     for cancel_date in cancel_dates if cancel_date <= date_cursor))
+            policy_ids = [pa.policy.id for pa in accounts]
+            self.assertEquals(overdue_policy_ids(date_cursor, policy_ids), expected)
+            self.assertEquals(sweep_cancellations(date_cursor, dry_run=True, policy_ids=policy_ids)['policy_ids'],
+                              expected)
+
+    def test_before_first_cancel_date(self):
+        report = sweep_cancellations(date(2015, 2, 14), policy_ids=self.policy_ids)
+        self.assertEquals(report['canceled'], 0)
+
+    def test_dry_run_does_not_write(self):
+        report = sweep_cancellations(date(2015, 3, 1), dry_run=True, policy_ids=self.policy_ids)
+        self.assertEquals(report['policy_ids'], [self.unpaid.id])
+        self.assertEquals(self.unpaid.status, 'Active')
+        self.assertFalse(CanceledPolicy.query.filter_by(policy_id=self.unpaid.id).all())
+
+    def test_skips_policies_that_are_not_active(self):
+        self.unpaid.status = 'Expired'
+        db.session.commit()
+        report = sweep_cancellations(date(2015, 3, 1), policy_ids=self.policy_ids)
+        self.assertEquals(report['evaluated'], 1)
+        self.assertEquals(report['canceled'], 0)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def query_plan(self, query):
+        statement = query.statement.compile(db.engine)
+        params = [statement.params[name] for name in statement.positiontup]
+        rows = db.engine.execute('EXPLAIN QUERY PLAN ' + unicode(statement), params)
+        return ' '.join(row['detail'] for row in rows)
+
+    def test_invoice_lookups_use_indexes(self):
+        plan = self.query_plan(Invoice.query.filter_by(policy_id=1)
+                                            .filter(Invoice.bill_date <= date(2015, 6, 1)))
+        self.assertIn('ix_invoices_policy_bill_date', plan)
+        plan = self.query_plan(Invoice.query.filter_by(policy_id=1)
+                                            .filter(date(2015, 6, 1) >= Invoice.due_date))
+        self.assertIn('ix_invoices_policy_due_date', plan)
+        plan = self.query_plan(Invoice.query.filter_by(policy_id=1)
+                                            .filter(Invoice.cancel_date <= date(2015, 6, 1)))
+        self.assertIn('ix_invoices_policy_cancel_date', plan)
+
+    def test_payment_lookup_uses_index(self):
+        plan = self.query_plan(Payment.query.filter_by(policy_id=1)
+                                            .filter(Payment.transaction_date <= date(2015, 6, 1)))
+        self.assertIn('ix_payments_policy_transaction_date', plan)
+
+    def test_agent_lookup_uses_index(self):
+        plan = self.query_plan(Contact.query.filter_by(name='John Doe').filter_by(role='Agent'))
+        self.assertIn('ix_contacts_role_name', plan)
+
+
+class TestPolicyLedger(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Quarterly'
+        self.policy.named_insured = self.insured_id
+        self.policy.agent = self.agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.dates = [date(2014, 12, 31), date(2015, 1, 1), date(2015, 1, 15), date(2015, 2, 1),
+                      date(2015, 4, 1), date(2015, 8, 20), date(2016, 1, 1)]
+
+    def tearDown(self):
+        delete_policies([self.policy.id])
+
+    def assertLedgerMatches(self, pa):
+        for date_cursor in self.dates:
+            self.assertEquals(pa.return_ledger_balance(date_cursor),
+                              pa.return_account_balance(date_cursor))
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+
+    def test_ledger_follows_invoices_and_payments(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.assertLedgerMatches(pa)
+        pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 8, 20), amount=200)
+        # back-dated payment, entries after it have to be shifted
+        pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 15), amount=300)
+        self.assertLedgerMatches(pa)
+
+    def test_ledger_follows_reinvoicing_and_cancel(self):
+        pa = PolicyAccounting(self.policy.id)
+        pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 15), amount=300)
+        self.policy.billing_schedule = 'Monthly'
+        pa.make_invoices()
+        self.assertLedgerMatches(pa)
+        pa.cancel("Underwriting")
+        self.assertLedgerMatches(pa)
+
+    def test_verify_reports_and_rebuild_fixes_mismatch(self):
+        pa = PolicyAccounting(self.policy.id)
+        entry = PolicyLedger.query.filter_by(policy_id=self.policy.id)\
+                                  .order_by(PolicyLedger.entry_date).first()
+        entry.balance += 50
+        db.session.commit()
+        self.assertEquals(verify_ledger([self.policy.id]),
+                          [(self.policy.id, date(2015, 1, 1), 350, 300)])
+
+        rebuild_ledger([self.policy.id])
+        self.assertLedgerMatches(pa)
+
+    def test_falls_back_without_ledger_entries(self):
+        pa = PolicyAccounting(self.policy.id)
+        for entry in PolicyLedger.query.filter_by(policy_id=self.policy.id):
+            db.session.delete(entry)
+        db.session.commit()
+        self.assertEquals(pa.return_ledger_balance(date(2015, 4, 1)), 600)
+
+
+class TestMakeInvoicesBulk(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        # pairs of identical policies, one invoiced per policy and one in bulk
+        self.pairs = []
+        for schedule in ('Annual', 'Two-Pay', 'Quarterly', 'Monthly'):
+            for effective_date in (date(2015, 1, 1), date(2015, 1, 31)):
+                pair = []
+                for _ in range(2):
+                    policy = Policy('Test Policy', effective_date, 1300)
+                    policy.billing_schedule = schedule
+                    policy.named_insured = self.insured_id
+                    policy.agent = self.agent_id
+                    db.session.add(policy)
+                    pair.append(policy)
+                self.pairs.append(pair)
+        db.session.commit()
+
+    def tearDown(self):
+        delete_policies([policy.id for pair in self.pairs for policy in pair])
+
+    def invoice_rows(self, policy):
+        return sorted((invoice.bill_date, invoice.due_date, invoice.cancel_date,
+                       invoice.amount_due, invoice.deleted) for invoice in policy.invoices)
+
+    def test_same_invoices_as_make_invoices(self):
+        for single, _ in self.pairs:
+            PolicyAccounting(single.id)
+        make_invoices_bulk([bulk.id for _, bulk in self.pairs], chunk_size=3)
+
+        for single, bulk in self.pairs:
+            self.assertEquals(self.invoice_rows(bulk), self.invoice_rows(single))
+        self.assertEquals(verify_ledger([bulk.id for _, bulk in self.pairs]), [])
+
+    def test_replaces_existing_invoices(self):
+        for single, bulk in self.pairs:
+            PolicyAccounting(single.id)
+            PolicyAccounting(bulk.id)
+            single.billing_schedule = 'Monthly'
+            bulk.billing_schedule = 'Monthly'
+            PolicyAccounting(single.id).make_invoices()
+        make_invoices_bulk([bulk.id for _, bulk in self.pairs])
+
+        for single, bulk in self.pairs:
+            self.assertEquals(self.invoice_rows(bulk), self.invoice_rows(single))
+
+
+class TestSyntheticBook(unittest.TestCase):
+
+    def setUp(self):
+        self.first_policy_id = (db.session.query(func.max(Policy.id)).scalar() or 0) + 1
+        self.first_contact_id = (db.session.query(func.max(Contact.id)).scalar() or 0) + 1
+
+    def tearDown(self):
+        for model, column in ((PolicyEvent, PolicyEvent.policy_id), (PolicyLedger, PolicyLedger.policy_id),
+                              (Invoice, Invoice.policy_id),
+                              (Payment, Payment.policy_id), (Policy, Policy.id)):
+            model.query.filter(column >= self.first_policy_id).delete(synchronize_session=False)
+        Contact.query.filter(Contact.id >= self.first_contact_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def generated_rows(self):
+        policies = Policy.query.filter(Policy.id >= self.first_policy_id).order_by(Policy.id).all()
+        payments = Payment.query.filter(Payment.policy_id >= self.first_policy_id)\
+                                .order_by(Payment.id).all()
+        return ([(p.effective_date, p.billing_schedule, p.annual_premium) for p in policies],
+                [(p.policy_id - self.first_policy_id, p.amount_paid, p.transaction_date)
+                 for p in payments])
+
+    def test_generates_a_complete_book(self):
+        counts = generate_book(40, seed=3, chunk_size=15)
+        self.assertEquals(counts['policies'], 40)
+
+        policies, payments = self.generated_rows()
+        self.assertEquals(set(schedule for _, schedule, _ in policies),
+                          set(['Annual', 'Two-Pay', 'Quarterly', 'Monthly']))
+        self.assertEquals(len(payments), counts['payments'])
+        self.assertTrue(all(transaction_date <= date(2016, 1, 1)
+                            for _, _, transaction_date in payments))
+        self.assertEquals(Invoice.query.filter(Invoice.policy_id >= self.first_policy_id)
+                                       .filter(Invoice.deleted == False).count(),
+                          sum({'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}[schedule]
+                              for _, schedule, _ in policies))
+        self.assertEquals(verify_ledger(range(self.first_policy_id, self.first_policy_id + 40)), [])
+
+    def test_same_seed_same_book(self):
+        generate_book(10, seed=5)
+        first = self.generated_rows()
+        self.tearDown()
+        generate_book(10, seed=5)
+        self.assertEquals(self.generated_rows(), first)
+
+
+class TestBenchmarkCompare(unittest.TestCase):
+
+    def test_reports_slower_and_chattier_operations(self):
+        baseline = {'sizes': {'1000': {'return_account_balance': {'mean_ms': 2.0, 'statements_per_call': 3.0},
+                                       'make_payment': {'mean_ms': 2.0, 'statements_per_call': 3.0}}}}
+        results = {'sizes': {'1000': {'return_account_balance': {'mean_ms': 2.4, 'statements_per_call': 3.0},
+                                      'make_payment': {'mean_ms': 3.0, 'statements_per_call': 4.0}}}}
+        regressions = compare(results, baseline, tolerance=0.25)
+        self.assertEquals(len(regressions), 2)
+        self.assertTrue(all(regression.startswith('make_payment') for regression in regressions))
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEquals(loadtest.parse_mix('index=1,policy_info=3'), {'index': 1.0, 'policy_info': 3.0})
+        self.assertRaises(ValueError, loadtest.parse_mix, 'index=1,nothing=2')
+
+    def test_make_requests_is_seeded(self):
+        requests = loadtest.make_requests(50, {'index': 1, 'policy_info': 1}, 3, seed=7)
+        self.assertEquals(requests, loadtest.make_requests(50, {'index': 1, 'policy_info': 1}, 3, seed=7))
+        self.assertEquals(set(kind for kind, _ in requests), set(['index', 'policy_info']))
+        self.assertTrue(all(1 <= form['policy_number'] <= 3 for kind, form in requests if kind == 'policy_info'))
+
+    def test_run_load_through_test_client(self):
+        max_id = db.session.query(func.max(Policy.id)).scalar()
+        requests = [('index', None)] * 5 + loadtest.make_requests(15, {'policy_info': 1}, max_id, seed=1)
+        results = loadtest.run_load(requests, loadtest.TestClientTransport(app), concurrency=2)
+        self.assertEquals(results['overall']['requests'], 20)
+        self.assertEquals(results['overall']['errors'], 0)
+        self.assertEquals(results['kinds']['index']['requests'], 5)
+        self.assertEquals(results['kinds']['policy_info']['requests'], 15)
+        self.assertTrue(results['overall']['p50_ms'] <= results['overall']['p95_ms'] <= results['overall']['p99_ms'])
+        self.assertEquals(results['kinds']['index']['statements_per_request'], 0)
+
+    def test_compare(self):
+        summary = {'p95_ms': 10.0, 'requests_per_second': 100.0, 'statements_per_request': 4.0, 'error_rate': 0.0}
+        baseline = {'overall': summary, 'kinds': {'policy_info': summary}}
+        results = {'overall': summary, 'kinds': {'policy_info': dict(summary, p95_ms=20.0, error_rate=0.1)}}
+        self.assertEquals(len(loadtest.compare(results, baseline)), 2)
+        self.assertEquals(loadtest.compare(baseline, baseline), [])
+
+
+class TestImportPayments(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Quarterly'
+        self.policy.named_insured = self.insured_id
+        self.policy.agent = self.agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        self.rejects_path = self.path + '.rejects.csv'
+
+    def tearDown(self):
+        delete_policies([self.policy.id])
+        os.remove(self.path)
+        os.remove(self.rejects_path)
+
+    def write_rows(self, rows):
+        with open(self.path, 'wb') as payment_file:
+            writer = csv.writer(payment_file)
+            writer.writerow(['policy_id', 'contact_id', 'amount', 'transaction_date'])
+            writer.writerows(rows)
+
+    def test_imports_and_rejects_rows(self):
+        missing_policy = (db.session.query(func.max(Policy.id)).scalar() or 0) + 1
+        self.write_rows([
+            [self.policy.id, '', 300, '2015-01-15'],
+            [self.policy.id, self.insured_id, 100, '2015-02-03'],
+            [self.policy.id, self.agent_id, 100, '2015-02-03'],
+            [missing_policy, '', 100, '2015-01-15'],
+            [self.policy.id, '', 'ten', '2015-01-15'],
+        ])
+        report = import_payments(self.path, self.rejects_path, chunk_size=2)
+
+        self.assertEquals(report['accepted'], 2)
+        self.assertEquals(report['rejected'], 3)
+        # the uninvoiced policy got its invoices, like PolicyAccounting would have done
+        self.assertEquals(len(self.policy.invoices), 4)
+        self.assertEquals(sorted((p.contact_id, p.amount_paid) for p in self.policy.payments),
+                          sorted([(self.insured_id, 300), (self.agent_id, 100)]))
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+
+        with open(self.rejects_path, 'rb') as rejects_file:
+            reasons = [row['reason'] for row in csv.DictReader(rejects_file)]
+        self.assertEquals(reasons[0], 'Only agents may make payments on cancellation pending policies')
+        self.assertEquals(reasons[1], 'Unknown policy')
+        self.assertTrue(reasons[2].startswith('Invalid row'))
+
+
+class TestAccountSnapshot(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        self.policy.billing_schedule = 'Quarterly'
+        self.policy.named_insured = self.insured_id
+        self.policy.agent = self.agent_id
+        db.session.add(self.policy)
+        db.session.commit()
+        self.pa = PolicyAccounting(self.policy.id)
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 15), amount=200)
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=100)
+        self.dates = [date(2014, 12, 31) + relativedelta(days=days) for days in range(0, 400, 7)]
+
+    def tearDown(self):
+        delete_policies([self.policy.id])
+
+    def test_matches_policy_accounting(self):
+        snapshot = AccountSnapshot.load(self.policy)
+        for date_cursor in self.dates:
+            self.assertEquals(snapshot.balance(date_cursor),
+                              self.pa.return_account_balance(date_cursor))
+            self.assertEquals(snapshot.cancellation_pending(date_cursor),
+                              self.pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor))
+        self.assertFalse(snapshot.should_cancel(date(2015, 5, 14)))
+        self.assertTrue(snapshot.should_cancel(date(2015, 5, 15)))
+
+    def test_timeline(self):
+        timeline = AccountSnapshot.load(self.policy).timeline(date(2015, 1, 15), date(2015, 4, 1))
+        self.assertEquals(timeline, [(date(2015, 1, 15), 'Payment', -200, 100),
+                                     (date(2015, 1, 20), 'Payment', -100, 0),
+                                     (date(2015, 4, 1), 'Bill', 300, 300)])
+
+    def test_dropped_after_payment(self):
+        self.assertEquals(self.pa.snapshot().balance(date(2015, 1, 20)), 0)
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 10), amount=50)
+        self.assertEquals(self.pa.snapshot().balance(date(2015, 1, 20)), -50)
+
+    def test_evaluate_cancel(self):
+        self.pa.evaluate_cancel(date(2015, 5, 14))
+        self.assertEquals(self.policy.status, 'Active')
+        self.pa.evaluate_cancel(date(2015, 5, 15))
+        self.assertEquals(self.policy.status, 'Canceled')
+
+
+class TestStatements(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    # requests end by removing the session, so everything is looked up again by id
+
+    def setUp(self):
+        self.policy_ids = []
+        for billing_schedule in ('Quarterly', 'Monthly'):
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = self.insured_id
+            db.session.add(policy)
+            db.session.commit()
+            self.policy_ids.append(policy.id)
+        self.pa = PolicyAccounting(self.policy_ids[0])
+        PolicyAccounting(self.policy_ids[1])
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 1), amount=300)
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 4, 20), amount=400)
+
+    def tearDown(self):
+        delete_policies(self.policy_ids)
+
+    def test_balance_timeline(self):
+        timeline = list(self.pa.balance_timeline())
+        self.assertEquals([(event_date, event) for event_date, event, _, _ in timeline],
+                          [(date(2015, 1, 1), 'Bill'), (date(2015, 1, 1), 'Payment'), (date(2015, 4, 1), 'Bill'),
+                           (date(2015, 4, 20), 'Payment'), (date(2015, 7, 1), 'Bill'), (date(2015, 10, 1), 'Bill')])
+        # the balance after the last event of a day is the day's end-of-day balance
+        end_of_day = dict((event_date, balance) for event_date, _, _, balance in timeline)
+        for event_date, balance in end_of_day.items():
+            self.assertEquals(balance, self.pa.return_account_balance(event_date))
+        self.assertEquals(timeline, self.pa.snapshot().timeline())
+
+    def test_balance_timeline_between_dates(self):
+        timeline = list(self.pa.balance_timeline(date(2015, 4, 1), date(2015, 6, 30)))
+        self.assertEquals(timeline, [(date(2015, 4, 1), 'Bill', 300, 300),
+                                     (date(2015, 4, 20), 'Payment', -400, -100)])
+
+    def test_statement_rows_for_many_policies(self):
+        policy_ids = self.policy_ids
+        rows = list(statement_rows(policy_ids + [policy_ids[0]], end=date(2015, 12, 31)))
+        self.assertEquals([row[0] for row in rows], [policy_ids[0]] * 6 + [policy_ids[1]] * 12)
+        self.assertEquals(rows[-1][4], 1200)
+
+    def test_statement_csv_endpoint(self):
+        response = app.test_client().get('/reports/statement.csv?policy_id=%d&start=2015-04-01'
+                                         % self.policy_ids[0])
+        self.assertEquals(response.status_code, 200)
+        lines = response.data.splitlines()
+        self.assertEquals(lines[0], 'policy_id,date,event,delta,balance')
+        self.assertEquals(lines[1], '%d,2015-04-01,Bill,300,300' % self.policy_ids[0])
+        self.assertEquals(len(lines), 5)
+        self.assertEquals(app.test_client().get('/reports/statement.csv?end=never').status_code, 400)
+
+
+class TestPolicyViews(unittest.TestCase):
+
+    # requests end by removing the session, so everything is looked up again by id
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+        cls.statements = StatementCounter()
+        cls.statements.attach(db.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.client = app.test_client()
+        policy_cache.clear()
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = 'Monthly'
+        policy.named_insured = self.insured_id
+        policy.agent = self.agent_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+
+    def tearDown(self):
+        delete_policies([self.policy_id])
+
+    def add_payments(self, count):
+        pa = PolicyAccounting(self.policy_id)
+        for day in range(count):
+            pa.make_payment(contact_id=self.insured_id,
+                            date_cursor=date(2015, 1, 1) + relativedelta(days=day), amount=1)
+
+    def policy_info_statements(self):
+        before = self.statements.count
+        response = self.client.post('/policyInfo', data={'policy_number': self.policy_id,
+                                                          'invoice_date': '2015-12-31'})
+        self.assertEquals(response.status_code, 200)
+        return self.statements.count - before
+
+    def test_policy_info_query_count_does_not_grow(self):
+        self.add_payments(1)
+        with_one_payment = self.policy_info_statements()
+        self.add_payments(10)
+        self.assertEquals(self.policy_info_statements(), with_one_payment)
+        self.assertTrue(with_one_payment <= 5)
+
+    def test_policy_api_pages(self):
+        self.add_payments(3)
+        url = '/api/policy/%d?date=2015-06-01&limit=4' % self.policy_id
+        data = json.loads(self.client.get(url).data)
+        self.assertEquals(data['balance'], PolicyAccounting(self.policy_id).return_account_balance(date(2015, 6, 1)))
+        self.assertEquals(len(data['payments']['items']), 3)
+        self.assertEquals(data['payments']['next_cursor'], None)
+
+        bill_dates = []
+        cursor = 0
+        while cursor is not None:
+            page = json.loads(self.client.get(url + '&invoices_after=%d' % cursor).data)['invoices']
+            bill_dates.extend(invoice['bill_date'] for invoice in page['items'])
+            cursor = page['next_cursor']
+        self.assertEquals(bill_dates, ['2015-%02d-01' % month for month in range(1, 7)])
+
+    def test_policy_info_cached_until_policy_changes(self):
+        self.policy_info_statements()
+        self.assertEquals(policy_cache.stats()['misses'], 1)
+        # a hit only reads the policy version
+        self.assertEquals(self.policy_info_statements(), 1)
+        self.assertEquals(policy_cache.stats()['hits'], 1)
+
+        self.add_payments(1)
+        self.assertTrue(self.policy_info_statements() > 1)
+        self.assertEquals(policy_cache.stats()['misses'], 2)
+
+    def test_policy_api_errors(self):
+        self.assertEquals(self.client.get('/api/policy/%d?limit=none' % self.policy_id).status_code, 400)
+        missing = (db.session.query(func.max(Policy.id)).scalar() or 0) + 1
+        self.assertEquals(self.client.get('/api/policy/%d' % missing).status_code, 404)
+
+    def post_balances(self, pairs):
+        return self.client.post('/api/balances', data=json.dumps(pairs),
+                                content_type='application/json')
+
+    def test_balances_api(self):
+        self.add_payments(3)
+        missing = (db.session.query(func.max(Policy.id)).scalar() or 0) + 1
+        dates = [date(2014, 12, 1), date(2015, 1, 2), date(2015, 3, 15)]
+        pairs = [{'policy_id': self.policy_id, 'date': as_of.isoformat()} for as_of in dates]
+        pairs.append({'policy_id': missing, 'date': '2015-03-15'})
+
+        response = self.post_balances(pairs)
+        self.assertEquals(response.status_code, 200)
+        balances = json.loads(response.data)['balances']
+        self.assertEquals(len(balances), 4)
+        for as_of, item in zip(dates, balances):
+            pa = PolicyAccounting(self.policy_id)
+            self.assertEquals(item['date'], as_of.isoformat())
+            self.assertEquals(item['balance'], pa.return_account_balance(as_of))
+            self.assertEquals(item['cancellation_pending'],
+                              pa.evaluate_cancellation_pending_due_to_non_pay(as_of))
+            self.assertEquals(item['status'], 'Active')
+        self.assertTrue('error' in balances[3])
+
+    def test_balances_api_query_count_does_not_grow(self):
+        def statements(count):
+            pairs = [{'policy_id': self.policy_id, 'date': '2015-%02d-01' % (number % 12 + 1)}
+                     for number in range(count)]
+            before = self.statements.count
+            self.assertEquals(self.post_balances(pairs).status_code, 200)
+            return self.statements.count - before
+        self.assertEquals(statements(100), statements(1))
+
+    def test_balances_api_errors(self):
+        self.assertEquals(self.post_balances({'policy_id': self.policy_id}).status_code, 400)
+        self.assertEquals(self.post_balances([{'policy_id': self.policy_id}]).status_code, 400)
+        too_many = [{'policy_id': self.policy_id, 'date': '2015-01-01'}] * (app.config['API_MAX_BATCH_SIZE'] + 1)
+        self.assertEquals(self.post_balances(too_many).status_code, 413)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEquals(self.cache.get('b'), None)
+        self.assertEquals(self.cache.get('a'), 1)
+        self.assertEquals(self.cache.get('c'), 3)
+        self.assertEquals(self.cache.stats()['hits'], 3)
+        self.assertEquals(self.cache.stats()['misses'], 1)
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.now = 9
+        self.assertEquals(self.cache.get('a'), 1)
+        self.now = 10
+        self.assertEquals(self.cache.get('a'), None)
+        self.assertEquals(self.cache.stats()['size'], 0)
+
+
+def _connection_pragmas():
+    # run in a parallel.py worker
+    return [db.session.execute('PRAGMA %s' % pragma).scalar() for pragma in ('busy_timeout', 'journal_mode')]
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_ranges_cover_every_policy(self):
+        ranges = policy_id_ranges(3)
+        self.assertTrue(len(ranges) <= 3)
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+        for policy_id in policy_ids:
+            self.assertEquals(len([1 for first, last in ranges if first <= policy_id <= last]), 1)
+
+    def test_balances_match_single_process(self):
+        as_of = date(2015, 6, 1)
+        self.assertEquals(run_job('balances', as_of, workers=2), balances_as_of(as_of))
+        self.assertEquals(run_job('balances', as_of, workers=1), balances_as_of(as_of))
+
+    def test_cancel_dry_run_matches_sweep(self):
+        as_of = date(2015, 6, 1)
+        report = run_job('cancel', as_of, workers=2, dry_run=True)
+        sweep = sweep_cancellations(as_of, dry_run=True)
+        self.assertEquals(report['policy_ids'], sorted(sweep['policy_ids']))
+        self.assertEquals(report['evaluated'], sweep['evaluated'])
+        self.assertEquals(report['canceled'], len(sweep['policy_ids']))
+
+    def test_workers_connect_with_the_engine_pragmas(self):
+        pool = multiprocessing.Pool(1, initializer=parallel._init_worker)
+        try:
+            self.assertEquals(pool.apply(_connection_pragmas),
+                              [app.config['SQLITE_BUSY_TIMEOUT'], app.config['SQLITE_JOURNAL_MODE'].lower()])
+        finally:
+            pool.close()
+            pool.join()
+
+
+class TestAgingReport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        policy = Policy('Test Aging', date(2015, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        policy.agent = self.agent_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        # pays the first installment and a third of the second before anything is due
+        PolicyAccounting(self.policy_id).make_payment(contact_id=self.insured_id,
+                                                      date_cursor=date(2015, 1, 15), amount=400)
+
+    def tearDown(self):
+        delete_policies([self.policy_id])
+
+    def aging_row(self, as_of):
+        rows = [row for row in aging_rows(as_of) if row[0] == self.policy_id]
+        return rows[0] if rows else None
+
+    def test_unpaid_amount_is_bucketed_by_days_past_due(self):
+        # the April installment was due May 1st, 45 days before
+        self.assertEquals(self.aging_row(date(2015, 6, 15)),
+                          [self.policy_id, 'Test Aging', 0, 0, 200, 0, 0, 200])
+
+    def test_payments_go_to_the_oldest_invoices_first(self):
+        # the July installment is billed but not due, the April one is now 61 days past due
+        self.assertEquals(self.aging_row(date(2015, 7, 1)),
+                          [self.policy_id, 'Test Aging', 300, 0, 0, 200, 0, 500])
+
+    def test_balance_matches_return_account_balance(self):
+        for as_of in (date(2015, 1, 20), date(2015, 4, 15), date(2016, 1, 1)):
+            row = self.aging_row(as_of)
+            balance = row[-1] if row else 0
+            self.assertEquals(balance, PolicyAccounting(self.policy_id).return_account_balance(as_of))
+
+    def test_leaves_out_canceled_policies(self):
+        Policy.query.filter_by(id=self.policy_id).update({'status': u'Canceled'})
+        db.session.commit()
+        self.assertEquals(self.aging_row(date(2015, 6, 15)), None)
+
+    def test_csv_route(self):
+        response = app.test_client().get('/reports/aging.csv?date=2015-06-15')
+        self.assertEquals(response.status_code, 200)
+        lines = response.data.splitlines()
+        self.assertEquals(lines[0], 'policy_id,policy_number,current,0-30,31-60,61-90,90+,balance')
+        self.assertTrue('%d,Test Aging,0,0,200,0,0,200' % self.policy_id in lines)
+        self.assertEquals(app.test_client().get('/reports/aging.csv?date=June').status_code, 400)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', (0.1, 1), ('method',))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value, 'a')
+        self.assertEquals(histogram.render(),
+                          ['# HELP test_seconds Test.',
+                           '# TYPE test_seconds histogram',
+                           'test_seconds_bucket{method="a",le="0.1"} 1',
+                           'test_seconds_bucket{method="a",le="1"} 3',
+                           'test_seconds_bucket{method="a",le="+Inf"} 4',
+                           'test_seconds_sum{method="a"} 6.05',
+                           'test_seconds_count{method="a"} 4'])
+
+    def test_counter_escapes_labels(self):
+        counter = metrics.Counter('test_total', 'Test.', ('endpoint',))
+        counter.inc('a"b')
+        counter.inc('a"b')
+        self.assertEquals(counter.render()[-1], 'test_total{endpoint="a\\"b"} 2')
+
+    def test_policy_accounting_calls_are_timed(self):
+        name = 'PolicyAccounting.return_account_balance'
+        calls = metrics.method_statements.count(name)
+        policy_id = db.session.query(func.min(Policy.id)).scalar()
+        PolicyAccounting(policy_id).return_account_balance(date(2015, 6, 1))
+        self.assertEquals(metrics.method_statements.count(name), calls + 1)
+        self.assertEquals(metrics.method_seconds.count(name), calls + 1)
+
+    def test_metrics_endpoint(self):
+        client = app.test_client()
+        client.get('/')
+        response = client.get('/metrics')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('accounting_requests_total{endpoint="index",status="200"}' in response.data)
+        self.assertTrue('# TYPE accounting_sql_statement_seconds histogram' in response.data)
+
+    def test_slow_query_log(self):
+        slow = metrics.slow_queries.value()
+        app.config['SLOW_QUERY_THRESHOLD'] = 0
+        try:
+            db.session.query(Policy.id).first()
+        finally:
+            app.config['SLOW_QUERY_THRESHOLD'] = None
+        self.assertEquals(metrics.slow_queries.value(), slow + 1)
+        db.session.query(Policy.id).first()
+        self.assertEquals(metrics.slow_queries.value(), slow + 1)
+
+
+class TestServingConfig(unittest.TestCase):
+
+    def tearDown(self):
+        create_app(environ={})
+
+    def test_environ_config(self):
+        environ = {'ACCOUNTING_SQLALCHEMY_POOL_SIZE': '8', 'ACCOUNTING_SQLITE_JOURNAL_MODE': 'WAL',
+                   'ACCOUNTING_SQLITE_MMAP_SIZE': 'null', 'ACCOUNTING_UNKNOWN': '1'}
+        self.assertEquals(environ_config(environ, ['SQLALCHEMY_POOL_SIZE', 'SQLITE_JOURNAL_MODE',
+                                                   'SQLITE_MMAP_SIZE', 'SQLITE_CACHE_SIZE']),
+                          {'SQLALCHEMY_POOL_SIZE': 8, 'SQLITE_JOURNAL_MODE': 'WAL', 'SQLITE_MMAP_SIZE': None})
+
+    def test_environ_database_uri_alias(self):
+        settings = ['SQLALCHEMY_DATABASE_URI']
+        self.assertEquals(environ_config({'ACCOUNTING_DATABASE_URI': 'sqlite:///book.sqlite'}, settings),
+                          {'SQLALCHEMY_DATABASE_URI': 'sqlite:///book.sqlite'})
+        # the setting's own name wins over the alias
+        self.assertEquals(environ_config({'ACCOUNTING_DATABASE_URI': 'sqlite:///book.sqlite',
+                                          'ACCOUNTING_SQLALCHEMY_DATABASE_URI': 'sqlite:///other.sqlite'}, settings),
+                          {'SQLALCHEMY_DATABASE_URI': 'sqlite:///other.sqlite'})
+
+    def test_apply_sqlite_pragmas(self):
+        connection = sqlite3.connect(':memory:')
+        apply_sqlite_pragmas(connection, {'SQLITE_CACHE_SIZE': -1024, 'SQLITE_BUSY_TIMEOUT': 1234,
+                                          'SQLITE_SYNCHRONOUS': None})
+        self.assertEquals(connection.execute('PRAGMA cache_size').fetchone()[0], -1024)
+        self.assertEquals(connection.execute('PRAGMA busy_timeout').fetchone()[0], 1234)
+        connection.close()
+
+    def test_create_app_reads_environ(self):
+        create_app({'SQLALCHEMY_POOL_SIZE': 2}, environ={'ACCOUNTING_SQLITE_CACHE_SIZE': '-2048'})
+        self.assertEquals(app.config['SQLITE_CACHE_SIZE'], -2048)
+        self.assertEquals(db.session.execute('PRAGMA cache_size').scalar(), -2048)
+        self.assertEquals(db.engine.pool.size(), 2)
+        self.assertTrue(Policy.query.count() > 0)
+
+
+class TestCli(unittest.TestCase):
+
+    def run_cli(self, argv):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEquals(cli.main(argv), 0)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_balance(self):
+        policy_id = db.session.query(func.min(Policy.id)).scalar()
+        output = self.run_cli(['balance', str(policy_id), '--date', '2015-06-01'])
+        self.assertEquals(output, '%d %d\n' % (policy_id, PolicyAccounting(policy_id).return_account_balance(
+            date(2015, 6, 1))))
+
+    def test_evaluate_cancel_dry_run(self):
+        output = self.run_cli(['evaluate-cancel', '--date', '2016-01-01', '--dry-run'])
+        self.assertEquals(output.splitlines()[1:],
+                          [str(policy_id) for policy_id in overdue_policy_ids(date(2016, 1, 1))])
+
+    def test_engine_imports_without_views(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', 'import sys, accounting.tools; '
+                                          'print "accounting.views" in sys.modules, "flask" in sys.modules'],
+                                         cwd=root)
+        self.assertEquals(output.split(), ['False', 'False'])
+
+    def test_old_database_needs_upgrade_db(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'old.sqlite')
+            connection = sqlite3.connect(path)
+            connection.executescript("CREATE TABLE policies (id INTEGER PRIMARY KEY, policy_number VARCHAR(128), "
+                                     "effective_date DATE, status VARCHAR(128), billing_schedule VARCHAR(128), "
+                                     "annual_premium INTEGER, named_insured INTEGER, agent INTEGER);"
+                                     "INSERT INTO policies VALUES (1, 'Old', '2015-01-01', 'Active', 'Annual', "
+                                     "1200, NULL, NULL);")
+            connection.close()
+            command = [sys.executable, 'accounting_cli.py', '--database', path]
+
+            process = subprocess.Popen(command + ['balance', '1'], cwd=root,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, error = process.communicate()
+            self.assertEquals(process.returncode, 1)
+            self.assertTrue('run upgrade-db' in error)
+
+            subprocess.check_output(command + ['upgrade-db'], cwd=root)
+            self.assertEquals(subprocess.check_output(command + ['balance', '1', '--date', '2016-01-01'],
+                                                      cwd=root), '1 0\n')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestChangeBillingSchedule(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.policy_ids = []
+        for number in range(2):
+            policy = Policy('Test Schedule %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.insured_id
+            policy.agent = self.agent_id
+            db.session.add(policy)
+            db.session.commit()
+            self.policy_ids.append(policy.id)
+            PolicyAccounting(policy.id)
+
+    def tearDown(self):
+        delete_policies(self.policy_ids)
+
+    def invoices(self, policy_id, deleted=False):
+        return [(invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due)
+                for invoice in Invoice.query.filter_by(policy_id=policy_id, deleted=deleted)
+                                            .order_by(Invoice.bill_date)]
+
+    def test_only_future_invoices_are_replaced(self):
+        policy_id = self.policy_ids[0]
+        PolicyAccounting(policy_id).change_billing_schedule('Monthly', date(2015, 4, 1))
+
+        invoices = self.invoices(policy_id)
+        self.assertEquals(invoices[0], (date(2015, 1, 1), date(2015, 2, 1), date(2015, 2, 15), 300))
+        self.assertEquals([invoice[0] for invoice in invoices[1:]],
+                          [date(2015, month, 1) for month in range(4, 13)])
+        self.assertEquals(set(invoice[3] for invoice in invoices[1:]), set([100]))
+        self.assertEquals(len(self.invoices(policy_id, deleted=True)), 3)
+        self.assertEquals(Policy.query.get(policy_id).billing_schedule, 'Monthly')
+
+        pa = PolicyAccounting(policy_id)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 1200)
+        self.assertEquals(pa.return_ledger_balance(date(2015, 5, 15)), 500)
+
+    def test_no_installments_left_bills_the_rest_at_once(self):
+        policy_id = self.policy_ids[0]
+        PolicyAccounting(policy_id).change_billing_schedule('Annual', date(2015, 5, 10))
+        self.assertEquals(self.invoices(policy_id)[-1],
+                          (date(2015, 5, 10), date(2015, 6, 10), date(2015, 6, 24), 600))
+        self.assertEquals(len(self.invoices(policy_id)), 3)
+
+    def test_uneven_split_adds_up_to_the_premium(self):
+        policy_id = self.policy_ids[0]
+        PolicyAccounting(policy_id).change_billing_schedule('Monthly', date(2015, 5, 15))
+        invoices = self.invoices(policy_id)
+        self.assertEquals(sum(invoice[3] for invoice in invoices), 1200)
+        self.assertEquals([invoice[3] for invoice in invoices[2:]], [90, 85, 85, 85, 85, 85, 85])
+
+    def test_bulk_matches_single(self):
+        single, bulk = self.policy_ids
+        PolicyAccounting(single).change_billing_schedule('Two-Pay', date(2015, 2, 1))
+        self.assertEquals(change_billing_schedule_bulk([bulk], 'Two-Pay', date(2015, 2, 1)), 1)
+        self.assertEquals(self.invoices(bulk), self.invoices(single))
+        self.assertEquals(self.invoices(bulk, deleted=True), self.invoices(single, deleted=True))
+        self.assertEquals(verify_ledger(self.policy_ids), [])
+
+    def test_bad_schedule(self):
+        self.assertEquals(PolicyAccounting(self.policy_ids[0]).change_billing_schedule('Weekly', date(2015, 4, 1)), None)
+        self.assertEquals(change_billing_schedule_bulk(self.policy_ids, 'Weekly', date(2015, 4, 1)), 0)
+        self.assertEquals(len(self.invoices(self.policy_ids[0])), 4)
+
+
+class TestPolicyEvents(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        # a year before the other policies in the database, so the daily run only finds this one
+        policy = Policy('Test Events', date(2014, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        policy.agent = self.agent_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        PolicyAccounting(self.policy_id)
+
+    def tearDown(self):
+        delete_policies([self.policy_id])
+
+    def next_event(self):
+        event = PolicyEvent.query.get(self.policy_id)
+        return (event.event_date, event.event_type) if event else None
+
+    def test_invoicing_adds_the_first_bill(self):
+        self.assertEquals(self.next_event(), (date(2014, 1, 1), 'Bill'))
+
+    def test_events_move_forward_as_they_are_processed(self):
+        mark_processed([self.policy_id], date(2014, 1, 1))
+        self.assertEquals(self.next_event(), (date(2014, 2, 1), 'Cancellation Pending'))
+        mark_processed([self.policy_id], date(2014, 2, 1))
+        self.assertEquals(self.next_event(), (date(2014, 2, 15), 'Cancel'))
+
+    def test_payment_removes_the_cancel_event(self):
+        mark_processed([self.policy_id], date(2014, 2, 1))
+        PolicyAccounting(self.policy_id).make_payment(contact_id=self.insured_id,
+                                                      date_cursor=date(2014, 1, 20), amount=300)
+        self.assertEquals(self.next_event(), (date(2014, 4, 1), 'Bill'))
+
+    def test_run_daily(self):
+        report = run_daily(date(2013, 12, 31))
+        self.assertFalse(self.policy_id in report['policy_ids'])
+        self.assertEquals(report['policies'], 0)
+
+        report = run_daily(date(2014, 1, 1))
+        self.assertEquals(report['policies'], 1)
+        self.assertEquals(report['events']['Bill'], 1)
+        self.assertEquals(report['canceled'], 0)
+        self.assertEquals(self.next_event(), (date(2014, 2, 1), 'Cancellation Pending'))
+
+        report = run_daily(date(2014, 2, 15))
+        self.assertEquals(report['policy_ids'], [self.policy_id])
+        self.assertEquals(Policy.query.get(self.policy_id).status, 'Canceled')
+        self.assertEquals(self.next_event(), None)
+
+    def test_run_daily_keeps_events_of_failed_cancellations(self):
+        run_daily(date(2014, 2, 1))
+        recompute_entries = ledger.recompute_entries
+
+        def fail(policy_ids):
+            raise RuntimeError('cancel failed')
+        ledger.recompute_entries = fail
+        try:
+            self.assertRaises(RuntimeError, run_daily, date(2014, 2, 15))
+        finally:
+            ledger.recompute_entries = recompute_entries
+        self.assertEquals(Policy.query.get(self.policy_id).status, 'Active')
+        self.assertEquals(self.next_event(), (date(2014, 2, 15), 'Cancel'))
+
+        self.assertEquals(run_daily(date(2014, 2, 15))['policy_ids'], [self.policy_id])
+
+
+class TestPaymentAllocation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        policy = Policy('Test Allocation', date(2015, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        policy.agent = self.agent_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+
+    def tearDown(self):
+        delete_policies([self.policy_id])
+
+    def allocations(self):
+        return [(invoice.amount_paid, invoice.paid, invoice.paid_date)
+                for invoice in Invoice.query.filter_by(policy_id=self.policy_id, deleted=False)
+                                            .order_by(Invoice.due_date)]
+
+    def test_payments_pay_the_oldest_invoices_first(self):
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=400)
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 3, 1), amount=200)
+        self.assertEquals(self.allocations(), [(300, True, date(2015, 1, 20)),
+                                               (300, True, date(2015, 3, 1)),
+                                               (0, False, None),
+                                               (0, False, None)])
+
+    def test_cancellation_pending_looks_at_the_paid_date(self):
+        self.assertTrue(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 1)))
+        # paid after the due date, so still pending on the days in between
+        db.session.add(Payment(self.policy_id, self.agent_id, 300, date(2015, 2, 10)))
+        allocation.reallocate([self.policy_id])
+        db.session.commit()
+
+        self.assertTrue(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 9)))
+        self.assertFalse(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 10)))
+        self.assertTrue(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 5, 1)))
+        self.assertEquals(overdue_policy_ids(date(2015, 5, 14), [self.policy_id]), [])
+        self.assertEquals(overdue_policy_ids(date(2015, 5, 15), [self.policy_id]), [self.policy_id])
+
+    def test_reinvoicing_reallocates(self):
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=400)
+        self.pa.change_billing_schedule('Monthly', date(2015, 4, 1))
+        allocations = self.allocations()
+        self.assertEquals(allocations[:2], [(300, True, date(2015, 1, 20)),
+                                            (100, True, date(2015, 1, 20))])
+        self.assertEquals(allocations[2], (0, False, None))
+
+    def test_reallocate_all_restores_the_allocations(self):
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=400)
+        expected = self.allocations()
+        Invoice.query.filter_by(policy_id=self.policy_id)\
+                     .update({'amount_paid': 0, 'paid': False, 'paid_date': None}, synchronize_session=False)
+        db.session.commit()
+
+        self.assertEquals(allocation.reallocate_all([self.policy_id]), 2)
+        self.assertEquals(self.allocations(), expected)
+
+    def test_matches_account_snapshot(self):
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=400)
+        # part of the second invoice, after its due date
+        db.session.add(Payment(self.policy_id, self.agent_id, 100, date(2015, 5, 10)))
+        allocation.reallocate([self.policy_id])
+        db.session.commit()
+        snapshot = AccountSnapshot.load(Policy.query.get(self.policy_id))
+        date_cursor = date(2015, 1, 1)
+        while date_cursor < date(2016, 1, 1):
+            self.assertEquals(snapshot.cancellation_pending(date_cursor),
+                              self.pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor))
+            self.assertEquals(snapshot.should_cancel(date_cursor),
+                              bool(overdue_policy_ids(date_cursor, [self.policy_id])))
+            date_cursor += relativedelta(days=7)
+
+
+class TestAccountingBatch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        self.policy_ids = []
+        for number in range(3):
+            policy = Policy('Test Batch %d' % number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.insured_id
+            policy.agent = self.agent_id
+            db.session.add(policy)
+            db.session.commit()
+            self.policy_ids.append(policy.id)
+            PolicyAccounting(policy.id)
+
+    def tearDown(self):
+        delete_policies(self.policy_ids)
+
+    def committed_payments(self):
+        # read through a connection of its own, so only committed rows are seen
+        connection = db.engine.connect()
+        try:
+            return connection.execute(select([func.count(Payment.id)])
+                                      .where(Payment.policy_id.in_(self.policy_ids))).scalar()
+        finally:
+            connection.close()
+
+    def pay(self, policy_id):
+        PolicyAccounting(policy_id).make_payment(contact_id=self.insured_id,
+                                                 date_cursor=date(2015, 1, 20), amount=300)
+
+    def test_single_calls_commit_on_their_own(self):
+        self.pay(self.policy_ids[0])
+        self.assertEquals(self.committed_payments(), 1)
+
+    def test_commits_once_at_the_end(self):
+        with accounting_batch() as batch:
+            for policy_id in self.policy_ids:
+                self.pay(policy_id)
+            self.assertEquals(self.committed_payments(), 0)
+        self.assertEquals(self.committed_payments(), 3)
+        self.assertEquals((batch.operations, batch.commits), (3, 1))
+        self.assertEquals(PolicyAccounting(self.policy_ids[0]).return_account_balance(date(2015, 1, 20)), 0)
+
+    def test_commit_every(self):
+        with accounting_batch(commit_every=2) as batch:
+            for policy_id in self.policy_ids:
+                with batch.savepoint(policy_id):
+                    self.pay(policy_id)
+            self.assertEquals(self.committed_payments(), 2)
+        self.assertEquals(batch.commits, 2)
+
+    def test_failed_policy_is_rolled_back_alone(self):
+        with accounting_batch() as batch:
+            for policy_id in self.policy_ids:
+                with batch.savepoint(policy_id):
+                    self.pay(policy_id)
+                    if policy_id == self.policy_ids[1]:
+                        raise ValueError("failed")
+        self.assertEquals([policy_id for policy_id, _ in batch.failed], [self.policy_ids[1]])
+        self.assertEquals(self.committed_payments(), 2)
+        self.assertEquals(PolicyLedger.query.filter_by(policy_id=self.policy_ids[1], entry_type=u'Payment').count(), 0)
+        self.assertFalse(Invoice.query.filter_by(policy_id=self.policy_ids[1], paid=True).count())
+
+    def test_exception_rolls_back_the_batch(self):
+        with self.assertRaises(ValueError):
+            with accounting_batch():
+                self.pay(self.policy_ids[0])
+                raise ValueError("failed")
+        self.assertEquals(self.committed_payments(), 0)
+
+    def test_make_invoices_twice_in_one_batch(self):
+        policy_id = self.policy_ids[0]
+        with accounting_batch():
+            pa = PolicyAccounting(policy_id)
+            pa.make_invoices()
+            first_ids = [invoice.id for invoice in Invoice.query.filter_by(policy_id=policy_id, deleted=False)]
+            pa.make_invoices()
+        self.assertEquals(len(first_ids), 4)
+        self.assertTrue(all(Invoice.query.get(invoice_id).deleted for invoice_id in first_ids))
+        self.assertEquals(Invoice.query.filter_by(policy_id=policy_id, deleted=False).count(), 4)
+        self.assertEquals(PolicyAccounting(policy_id).return_account_balance(date(2015, 12, 31)), 1200)
+        self.assertEquals(verify_ledger([policy_id]), [])
+
+
+class TestArchive(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent_id, cls.insured_id = add_contacts()
+
+    @classmethod
+    def tearDownClass(cls):
+        delete_contacts([cls.agent_id, cls.insured_id])
+
+    def setUp(self):
+        policy_cache.clear()
+        policy = Policy('Test Archive', date(2015, 1, 1), 1200)
+        policy.billing_schedule = 'Quarterly'
+        policy.named_insured = self.insured_id
+        policy.agent = self.agent_id
+        db.session.add(policy)
+        db.session.commit()
+        self.policy_id = policy.id
+        self.pa = PolicyAccounting(self.policy_id)
+        self.pa.make_payment(contact_id=self.insured_id, date_cursor=date(2015, 1, 20), amount=400)
+        self.pa.change_billing_schedule('Monthly', date(2015, 4, 1))
+
+    def tearDown(self):
+        delete_policies([self.policy_id])
+
+    def close(self, cancellation_date):
+        self.pa.cancel("Past due")
+        CanceledPolicy.query.filter_by(policy_id=self.policy_id)\
+                            .update({'cancellation_date': cancellation_date}, synchronize_session=False)
+        db.session.commit()
+
+    def test_archive_tables_have_the_same_columns(self):
+        for model, archive_model in ((Invoice, ArchivedInvoice), (Payment, ArchivedPayment)):
+            self.assertEquals([(column.name, repr(column.type)) for column in model.__table__.columns],
+                              [(column.name, repr(column.type)) for column in archive_model.__table__.columns])
+
+    def test_deleted_invoices_are_moved(self):
+        deleted_ids = [invoice.id for invoice in Invoice.query.filter_by(policy_id=self.policy_id, deleted=True)]
+        self.assertEquals(archive_deleted_invoices(policy_ids=[self.policy_id]), 3)
+
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id, deleted=True).count(), 0)
+        self.assertEquals(sorted(invoice.id for invoice in ArchivedInvoice.query.filter_by(policy_id=self.policy_id)),
+                          sorted(deleted_ids))
+        self.assertEquals(self.pa.return_account_balance(date(2015, 12, 31)), 800)
+
+        api = json.loads(app.test_client().get('/api/policy/%d?date=2015-12-31&archived=1' % self.policy_id).data)
+        self.assertEquals(sorted(invoice['id'] for invoice in api['invoices']['items']), sorted(deleted_ids))
+
+        # the policy page still lists the deleted invoices, in bill date order with the live ones
+        response = app.test_client().post('/policyInfo', data={'policy_number': self.policy_id,
+                                                                 'invoice_date': '2015-12-31'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data.count('<tr class="deleted">'), 3)
+        self.assertEquals([row.bill_date for row in archive.billed_invoices(self.pa.policy, date(2015, 12, 31))],
+                          sorted([date(2015, 4, 1), date(2015, 7, 1), date(2015, 10, 1)] +
+                                 [date(2015, month, 1) for month in range(1, 13) if month not in (2, 3)]))
+
+    def test_closed_policies_wait_for_the_retention_period(self):
+        self.close(date(2015, 6, 1))
+        self.assertFalse(self.policy_id in closed_policy_ids(date(2015, 5, 31)))
+        self.assertTrue(self.policy_id in closed_policy_ids(date(2015, 6, 1)))
+
+    def test_archived_policy_reads_the_archive(self):
+        self.close(date(2015, 6, 1))
+        balances = [self.pa.return_account_balance(date(2015, month, 1)) for month in range(1, 13)]
+
+        self.assertEquals(archive_policies([self.policy_id], date(2017, 6, 1)), (13, 1))
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id).count(), 0)
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy_id).count(), 0)
+
+        pa = PolicyAccounting(self.policy_id)
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id).count(), 0)
+        self.assertEquals(pa.policy.archived_on, date(2017, 6, 1))
+        self.assertEquals([pa.return_account_balance(date(2015, month, 1)) for month in range(1, 13)], balances)
+        self.assertEquals([pa.snapshot().balance(date(2015, month, 1)) for month in range(1, 13)], balances)
+        self.assertEquals(balances_as_of(date(2015, 12, 1), [self.policy_id])[self.policy_id], balances[-1])
+        self.assertEquals(verify_ledger([self.policy_id]), [])
+
+        response = app.test_client().post('/policyInfo', data={'policy_number': self.policy_id,
+                                                                 'invoice_date': '2015-12-31'})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('No invoices found!' not in response.data)
+
+    def test_archived_policy_takes_no_writes(self):
+        self.close(date(2015, 6, 1))
+        archive_policies([self.policy_id], date(2017, 6, 1))
+        pa = PolicyAccounting(self.policy_id)
+        balance = pa.return_account_balance(date(2017, 7, 1))
+
+        self.assertEquals(pa.make_payment(contact_id=self.insured_id, date_cursor=date(2017, 7, 1), amount=100),
+                          False)
+        self.assertEquals(pa.change_billing_schedule('Monthly', date(2015, 7, 1)), None)
+        self.assertEquals(change_billing_schedule_bulk([self.policy_id], 'Monthly', date(2015, 7, 1)), 0)
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy_id).count(), 0)
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id).count(), 0)
+        self.assertEquals(pa.return_account_balance(date(2017, 7, 1)), balance)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'payments.csv')
+            with open(path, 'wb') as payment_file:
+                payment_file.write('policy_id,contact_id,amount,transaction_date\n%d,%d,100,2017-07-01\n'
+                                   % (self.policy_id, self.insured_id))
+            report = import_payments(path, path + '.rejects.csv')
+            self.assertEquals((report['accepted'], report['rejected']), (0, 1))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy_id).count(), 0)
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestColumnarAnalytics(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        export_book(cls.directory, chunk_size=3)
+        cls.book = Book(cls.directory)
+        cls.dates = month_ends(date(2015, 1, 1), date(2016, 6, 30))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_month_ends(self):
+        self.assertEquals(month_ends(date(2015, 11, 15), date(2016, 2, 1)),
+                          [date(2015, 11, 30), date(2015, 12, 31), date(2016, 1, 31), date(2016, 2, 29)])
+
+    def test_export_matches_database(self):
+        self.assertEquals(list(self.book.policy_ids), [row.id for row in db.session.query(Policy.id).order_by(Policy.id)])
+        self.assertEquals(self.book.meta['counts']['invoices'], Invoice.query.filter_by(deleted=False).count())
+        self.assertEquals(int(self.book.payments['amount'].sum()),
+                          db.session.query(func.sum(Payment.amount_paid)).scalar() or 0)
+
+    def test_balances_match_return_account_balance(self):
+        self.assertEquals(check_sample(self.book, self.dates, sample_size=len(self.book.policy_ids)), [])
+
+    def test_portfolio_adds_up(self):
+        all_balances = balances(self.book, self.dates)
+        for index, row in enumerate(portfolio(self.book, self.dates, block_size=2)):
+            self.assertEquals(row['billed'] - row['collected'], all_balances[:, index].sum())
+            self.assertTrue(0 <= row['delinquent'] <= row['in_force'] <= len(self.book.policy_ids))
@@ -1,10 +1,19 @@
 #!/user/bin/env python2.7
 
+import time
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import func, select
 
 from accounting import db
-from models import Contact, Invoice, Payment, Policy, CanceledPolicy
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+from models import ArchivedInvoice, ArchivedPayment, Contact, Invoice, Payment, Policy, CanceledPolicy
+import allocation
+import archive
+import batch
+import events
+import ledger
+from snapshot import AccountSnapshot
 
 
 
@@ -18,14 +27,24 @@ If you have any questions, please contact Amanda at:
 """
 
 
+# number of invoices per year for each billing schedule
+BILLING_SCHEDULES = {'Annual': 1, 'Two-Pay': 2, 'Semi-Annual': 3,
+                     'Quarterly': 4, 'Monthly': 12}  # added Two-Pay
+
+
 class PolicyAccounting(object):
     """
-     Each policy has its own instance of accounting.
+     Each policy has its own instance of accounting. Every write commits on its own unless it
+     is made inside accounting.batch.accounting_batch.
     """
     def __init__(self, policy_id):
         self.policy = Policy.query.filter_by(id=policy_id).one()
+        self._snapshot = None
 
-        if not self.policy.invoices:
+        # only checks that an invoice exists instead of loading them all, an archived policy
+        # has none left in the invoices table
+        if not self.policy.archived_on and \
+                not db.session.query(Invoice.id).filter_by(policy_id=policy_id).first():
             self.make_invoices()
 
     """
@@ -37,25 +56,64 @@ class PolicyAccounting(object):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
+        invoice_model = archive.invoice_model(self.policy)
+        payment_model = archive.payment_model(self.policy)
+
         # invoices and payments from the same day as date_cursor should be included
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.bill_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
+        invoices = invoice_model.query.filter_by(policy_id=self.policy.id)\
+                                      .filter(invoice_model.bill_date <= date_cursor)\
+                                      .order_by(invoice_model.bill_date)\
+                                      .all()
         due_now = 0
 
         for invoice in invoices:
             if not invoice.deleted:
                 due_now += invoice.amount_due
             
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .all()
+        payments = payment_model.query.filter_by(policy_id=self.policy.id)\
+                                      .filter(payment_model.transaction_date <= date_cursor)\
+                                      .all()
         for payment in payments:
             due_now -= payment.amount_paid
 
         return due_now
 
+    """
+     Same result as return_account_balance, read from the policy ledger with one indexed
+     lookup. Policies without any ledger entries yet (written before the ledger existed)
+     fall back to return_account_balance until rebuild_ledger is run for them.
+    """
+    def return_ledger_balance(self, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        balance = ledger.balance_as_of(self.policy.id, date_cursor)
+        if balance is None:
+            return self.return_account_balance(date_cursor)
+        return balance
+
+    """
+     Returns an AccountSnapshot of the policy for answering repeated questions about it without
+     going back to the database. It is loaded the first time it's asked for and dropped whenever
+     this object takes a payment or re-invoices, so writes made elsewhere are not seen.
+    """
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = AccountSnapshot.load(self.policy)
+        return self._snapshot
+
+    """
+     Yields (date, event, delta, balance) for every bill and payment of the policy dated from
+     start to end (inclusive, either may be None for no limit) in date order, where balance is
+     the account balance after the event. The invoices and payments are merged by date in one
+     streaming query, see accounting.statements.
+    """
+    def balance_timeline(self, start=None, end=None):
+        # statements brings the CSV writers with it, which nothing else in the engine needs
+        import statements
+        for _, event_date, event, delta, balance in statements.statement_rows([self.policy.id], start, end):
+            yield event_date, event, delta, balance
+
     """
      Creates a payment for the policy represented by the object and adds it to the database.
 
@@ -66,6 +124,12 @@ class PolicyAccounting(object):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
+        # an archived policy's account is only read from the archive tables, a payment written
+        # to the payments table would never count towards it
+        if self.policy.archived_on:
+            print "POLICY HISTORY IS ARCHIVED, CANNOT PROCESS PAYMENT"
+            return False
+
         """
          Added for problem 7. If the policy is in cancellation_due_to_non_pay status
          and the contact_id does not match an agent in the database then the payment
@@ -89,7 +153,11 @@ class PolicyAccounting(object):
                           amount,
                           date_cursor)
         db.session.add(payment)
-        db.session.commit()
+        ledger.post_entry(self.policy.id, date_cursor, u'Payment', -amount)
+        allocation.reallocate([self.policy.id])
+        events.refresh([self.policy.id])
+        batch.commit()
+        self._snapshot = None
 
         return payment
 
@@ -103,39 +171,33 @@ class PolicyAccounting(object):
         # problem 7
         if not date_cursor:
             date_cursor = datetime.now().date()
-            
-        # not concerned with whether or not the cancel_date has passed
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(date_cursor >= Invoice.due_date )\
-                                .order_by(Invoice.bill_date)\
-                                .all()
 
-        for invoice in invoices:
-            if invoice.amount_due:
-                return True
-        else:
-            return False
+        # not concerned with whether or not the cancel_date has passed; payments are already
+        # allocated to the invoices, so this is one indexed lookup for an open past-due invoice
+        return db.session.query(Invoice.id)\
+                         .filter(Invoice.policy_id == self.policy.id)\
+                         .filter(Invoice.deleted == False)\
+                         .filter(Invoice.due_date <= date_cursor)\
+                         .filter(allocation.open_on(date_cursor))\
+                         .first() is not None
 
     """
      Evaluates whether a policy should be canceled by determining if there are any
-     invoices with an outstanding balance past their cancel_date.
+     invoices that were still unpaid on their cancel_date.
     """
     def evaluate_cancel(self, date_cursor=None):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.cancel_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
-                continue
-            else:
-                self.cancel("Past due")
-                print "THIS POLICY SHOULD HAVE CANCELED"
-                break
+        overdue = db.session.query(Invoice.id)\
+                            .filter(Invoice.policy_id == self.policy.id)\
+                            .filter(Invoice.deleted == False)\
+                            .filter(Invoice.cancel_date <= date_cursor)\
+                            .filter(allocation.open_on(Invoice.cancel_date))\
+                            .first()
+        if overdue:
+            self.cancel("Past due")
+            print "THIS POLICY SHOULD HAVE CANCELED"
         else:
             print "THIS POLICY SHOULD NOT CANCEL"
 
@@ -148,7 +210,9 @@ class PolicyAccounting(object):
         self.policy.status = "Canceled"
         cancellation = CanceledPolicy(self.policy.id, datetime.now().date(), details)
         db.session.add(cancellation)
-        db.session.commit()
+        ledger.post_entry(self.policy.id, cancellation.cancellation_date, u'Cancel', 0)
+        events.refresh([self.policy.id])
+        batch.commit()
 
     """
      Deletes any invoices for the policy and re-creates them. Invoices are made based on the
@@ -159,14 +223,20 @@ class PolicyAccounting(object):
     def make_invoices(self):
          # Assuming that we don't care about change since database amount_due column is INTEGER type
 
-        billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Semi-Annual': 3,
-                             'Quarterly': 4, 'Monthly': 12}  # added Two-Pay
+        billing_schedules = BILLING_SCHEDULES
 
         if self.policy.billing_schedule not in billing_schedules.keys():
             print "You have chosen a bad billing schedule."
             return
+        if self.policy.archived_on:
+            print "POLICY HISTORY IS ARCHIVED, CANNOT MAKE INVOICES"
+            return
 
-        for invoice in self.policy.invoices:
+        # queried rather than read from self.policy.invoices, which nothing expires between the
+        # writes of an accounting_batch, so invoices made earlier in the batch would be missed
+        for invoice in Invoice.query.filter_by(policy_id=self.policy.id):
+            if not invoice.deleted:
+                ledger.post_entry(self.policy.id, invoice.bill_date, u'Void', -invoice.amount_due)
             invoice.deleted = True  # seems best to simply mark them deleted, we can manually delete if need be
 
         invoices = []
@@ -194,7 +264,410 @@ class PolicyAccounting(object):
         """
         for invoice in invoices:
             db.session.add(invoice)
+            ledger.post_entry(self.policy.id, invoice.bill_date, u'Invoice', invoice.amount_due)
+        allocation.reallocate([self.policy.id])
+        events.refresh([self.policy.id])
+        batch.commit()
+        self._snapshot = None
+
+    """
+     Switches the policy to new_schedule from effective_on without touching what was billed
+     before then. Invoices billed before effective_on are kept, later ones are marked deleted,
+     and whatever part of the annual_premium hasn't been billed yet is spread over the new
+     schedule's installments from effective_on on (billed on effective_on itself if the new
+     schedule has none left). Everything is written in one transaction. Returns the new invoices.
+    """
+    def change_billing_schedule(self, new_schedule, effective_on):
+        if new_schedule not in BILLING_SCHEDULES:
+            print "You have chosen a bad billing schedule."
+            return
+        if self.policy.archived_on:
+            print "POLICY HISTORY IS ARCHIVED, CANNOT CHANGE BILLING SCHEDULE"
+            return
+
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .filter(Invoice.deleted == False)\
+                                .all()
+        entries = []
+        billed = 0
+        for invoice in invoices:
+            if invoice.bill_date < effective_on:
+                billed += invoice.amount_due
+            else:
+                invoice.deleted = True
+                entries.append((self.policy.id, invoice.bill_date, u'Void', -invoice.amount_due))
+
+        new_invoices = []
+        for bill_date, due_date, cancel_date, amount_due in rescheduled_installments(
+                self.policy.effective_date, self.policy.annual_premium - billed,
+                BILLING_SCHEDULES[new_schedule], effective_on):
+            invoice = Invoice(self.policy.id, bill_date, due_date, cancel_date, amount_due)
+            new_invoices.append(invoice)
+            db.session.add(invoice)
+            entries.append((self.policy.id, bill_date, u'Invoice', amount_due))
+
+        try:
+            self.policy.billing_schedule = new_schedule
+            ledger.post_entries(entries)
+            allocation.reallocate([self.policy.id])
+            events.refresh([self.policy.id])
+            batch.commit()
+        except:
+            batch.rollback()
+            raise
+        self._snapshot = None
+        return new_invoices
+
+def _add_totals(balances, invoice_model, payment_model, policy_ids, date_cursor):
+    invoice_totals = db.session.query(invoice_model.policy_id, func.sum(invoice_model.amount_due))\
+                               .filter(invoice_model.policy_id.in_(policy_ids))\
+                               .filter(invoice_model.bill_date <= date_cursor)\
+                               .filter(invoice_model.deleted == False)\
+                               .group_by(invoice_model.policy_id)
+    for policy_id, total in invoice_totals:
+        balances[policy_id] += total
+
+    payment_totals = db.session.query(payment_model.policy_id, func.sum(payment_model.amount_paid))\
+                               .filter(payment_model.policy_id.in_(policy_ids))\
+                               .filter(payment_model.transaction_date <= date_cursor)\
+                               .group_by(payment_model.policy_id)
+    for policy_id, total in payment_totals:
+        balances[policy_id] -= total
+
+
+"""
+ Returns a {policy_id: balance} mapping for every policy (or only those in policy_ids) as of
+ date_cursor. Uses the same rules as PolicyAccounting.return_account_balance: invoices billed
+ and payments made on date_cursor are included and deleted invoices are ignored, but the
+ totals come from two GROUP BY queries instead of loading every row for every policy.
+"""
+def balances_as_of(date_cursor=None, policy_ids=None):
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    if policy_ids is None:
+        policy_ids = [row.id for row in db.session.query(Policy.id)]
+
+    balances = dict((policy_id, 0) for policy_id in policy_ids)
+
+    for chunk in chunks(balances.keys(), IN_CLAUSE_CHUNK_SIZE):
+        _add_totals(balances, Invoice, Payment, chunk, date_cursor)
+        # the archive tables are only read for the policies that have been archived
+        archived = archive.archived_ids(chunk)
+        if archived:
+            _add_totals(balances, ArchivedInvoice, ArchivedPayment, archived, date_cursor)
+
+    return balances
+
+
+"""
+ Returns the ids of the Active policies (of those in policy_ids, or of the whole book) with an
+ invoice that was still open on its cancel_date, for cancel dates up to date_cursor. This is
+ the rule of PolicyAccounting.evaluate_cancel, answered from the stored allocations.
+"""
+def overdue_policy_ids(date_cursor, policy_ids=None):
+    query = db.session.query(Invoice.policy_id).distinct()\
+                      .join(Policy, Policy.id == Invoice.policy_id)\
+                      .filter(Policy.status == u'Active')\
+                      .filter(Invoice.deleted == False)\
+                      .filter(Invoice.cancel_date <= date_cursor)\
+                      .filter(allocation.open_on(Invoice.cancel_date))
+    if policy_ids is None:
+        return sorted(row.policy_id for row in query)
+
+    overdue = []
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        overdue.extend(row.policy_id for row in query.filter(Invoice.policy_id.in_(chunk)))
+    return sorted(overdue)
+
+
+"""
+ Cancels every Active policy with an invoice still unpaid on its cancel date, as of
+ date_cursor. This is the book-wide equivalent of calling evaluate_cancel on each policy, but
+ the policies are found with one query over the invoices' stored allocations (see
+ accounting.allocation) and cancelled with one bulk status update and one bulk CanceledPolicy
+ insert in a single transaction.
+
+ With dry_run nothing is written. Returns a report of what was (or would have been) done.
+"""
+def sweep_cancellations(date_cursor=None, dry_run=False, policy_ids=None, details="Past due"):
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    started = time.time()
+
+    active = db.session.query(func.count(Policy.id)).filter(Policy.status == u'Active')
+    if policy_ids is None:
+        evaluated = active.scalar()
+    else:
+        evaluated = sum(active.filter(Policy.id.in_(chunk)).scalar()
+                        for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE))
+    to_cancel = overdue_policy_ids(date_cursor, policy_ids)
+
+    if to_cancel and not dry_run:
+        cancel_policies(to_cancel, date_cursor, details)
+
+    return {'date': date_cursor,
+            'dry_run': dry_run,
+            'evaluated': evaluated,
+            'canceled': len(to_cancel),
+            'policy_ids': to_cancel,
+            'elapsed': time.time() - started}
+
+
+"""
+ Cancels every policy in policy_ids as of cancellation_date in one transaction, the way
+ PolicyAccounting.cancel does it for a single policy.
+"""
+def cancel_policies(policy_ids, cancellation_date, details="Past due"):
+    if not policy_ids:
+        return
+    try:
+        _cancel_policies(policy_ids, cancellation_date, details)
         db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+
+def _cancel_policies(policy_ids, cancellation_date, details):
+    # the writes of cancel_policies, left for the caller to commit
+    if not policy_ids:
+        return
+    for chunk in chunks(policy_ids, IN_CLAUSE_CHUNK_SIZE):
+        db.session.execute(Policy.__table__.update()
+                                           .where(Policy.id.in_(chunk))
+                                           .values(status=u'Canceled'))
+    db.session.execute(CanceledPolicy.__table__.insert(),
+                       [{'policy_id': policy_id,
+                         'cancellation_date': cancellation_date,
+                         'details': details} for policy_id in policy_ids])
+    ledger.recompute_entries(policy_ids)
+    events.refresh(policy_ids)
+
+# policies handled per transaction by run_daily
+DAILY_CHUNK_SIZE = 500
+
+
+"""
+ The daily job. Looks up the policies whose next event (see accounting.events) falls on or
+ before date_cursor, cancels those that owed money on a cancel date, the same rule as
+ PolicyAccounting.evaluate_cancel, and moves the rest on to their next event. Only the policies
+ with an event are read, so the work grows with the day's events and not with the book.
+ Returns a report of how many events of each type were handled.
+"""
+def run_daily(date_cursor=None, details="Past due", chunk_size=DAILY_CHUNK_SIZE):
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    started = time.time()
+
+    due = events.due_events(date_cursor)
+    counts = dict((event_type, 0) for event_type in events.EVENT_TYPES)
+    to_cancel = []
+    for chunk in chunks(due, chunk_size):
+        policy_ids = [policy_id for policy_id, _ in chunk]
+        for _, event_type in chunk:
+            counts[event_type] += 1
+        canceled = overdue_policy_ids(date_cursor, policy_ids)
+
+        # the events are only marked processed along with the cancellations they lead to, so a
+        # failed chunk leaves its events due for the next run
+        try:
+            _cancel_policies(canceled, date_cursor, details)
+            # also takes the canceled policies off the calendar
+            events.mark_processed(policy_ids, date_cursor)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        to_cancel.extend(canceled)
+
+    return {'date': date_cursor,
+            'policies': len(due),
+            'events': counts,
+            'canceled': len(to_cancel),
+            'policy_ids': to_cancel,
+            'elapsed': time.time() - started}
+
+# number of policies whose invoices are replaced per transaction by make_invoices_bulk
+INVOICE_CHUNK_SIZE = 1000
+
+
+"""
+ Returns the (bill_date, due_date, cancel_date) of every installment for a policy with the
+ given effective_date and number of installments, worked out exactly the way
+ PolicyAccounting.make_invoices does it.
+"""
+def installment_dates(effective_date, installments):
+    dates = []
+    for i in range(installments):
+        bill_date = effective_date + relativedelta(months=i * (12 / installments))
+        dates.append((bill_date,
+                      bill_date + relativedelta(months=1),
+                      bill_date + relativedelta(months=1, days=14)))
+    return dates
+
+
+"""
+ Returns the (bill_date, due_date, cancel_date, amount_due) invoices that spread unbilled (the
+ premium not billed before effective_on) over the installments, of a policy that took effect
+ on effective_date, billed on or after effective_on. If there are none left the whole amount
+ is billed on effective_on. The amount is split evenly, the first invoice also taking whatever
+ doesn't divide, so the invoices add up to exactly unbilled.
+"""
+def rescheduled_installments(effective_date, unbilled, installments, effective_on):
+    if unbilled <= 0:
+        return []
+
+    dates = [installment for installment in installment_dates(effective_date, installments)
+             if installment[0] >= effective_on]
+    if not dates:
+        dates = [(effective_on,
+                  effective_on + relativedelta(months=1),
+                  effective_on + relativedelta(months=1, days=14))]
+
+    amount_due = unbilled / len(dates)
+    remainder = unbilled - amount_due * len(dates)
+    return [(bill_date, due_date, cancel_date, amount_due + (remainder if number == 0 else 0))
+            for number, (bill_date, due_date, cancel_date) in enumerate(dates)]
+
+
+"""
+ Bulk version of PolicyAccounting.make_invoices for large imports, producing exactly the same
+ invoices. Policies are handled chunk_size at a time, each chunk in one transaction: their old
+ invoices are marked deleted with one UPDATE, the new invoices are written with a single
+ executemany INSERT and the ledger is refreshed. Installment dates are only worked out once for
+ each (effective_date, billing_schedule) pair. Policies with an unknown billing_schedule are
+ skipped and returned.
+"""
+def make_invoices_bulk(policy_ids, chunk_size=INVOICE_CHUNK_SIZE):
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    dates_cache = {}
+    skipped = []
+
+    for chunk in chunks(policy_ids, chunk_size):
+        rows = []
+        try:
+            for id_chunk in chunks(chunk, IN_CLAUSE_CHUNK_SIZE):
+                chunk_policies = select([policies.c.id, policies.c.effective_date,
+                                         policies.c.billing_schedule, policies.c.annual_premium])\
+                    .where(policies.c.id.in_(id_chunk))
+                reinvoiced = []
+                for policy in db.session.execute(chunk_policies).fetchall():
+                    installments = BILLING_SCHEDULES.get(policy.billing_schedule)
+                    if not installments:
+                        skipped.append(policy.id)
+                        continue
+                    reinvoiced.append(policy.id)
+
+                    key = (policy.effective_date, policy.billing_schedule)
+                    if key not in dates_cache:
+                        dates_cache[key] = installment_dates(policy.effective_date, installments)
+                    amount_due = policy.annual_premium / installments
+                    for bill_date, due_date, cancel_date in dates_cache[key]:
+                        rows.append({'policy_id': policy.id,
+                                     'bill_date': bill_date,
+                                     'due_date': due_date,
+                                     'cancel_date': cancel_date,
+                                     'amount_due': amount_due,
+                                     'deleted': False})
+
+                if reinvoiced:
+                    db.session.execute(invoices.update()
+                                               .where(invoices.c.policy_id.in_(reinvoiced))
+                                               .values(deleted=True))
+
+            if rows:
+                db.session.execute(invoices.insert(), rows)
+            ledger.recompute_entries(chunk)
+            allocation.reallocate(chunk)
+            events.refresh(chunk)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    if skipped:
+        print "Skipped %d policies with a bad billing schedule." % len(skipped)
+    return skipped
+
+
+"""
+ Bulk version of PolicyAccounting.change_billing_schedule that switches every policy in
+ policy_ids to new_schedule from effective_on, giving the same invoices. Policies are handled
+ chunk_size at a time, each chunk in one transaction with a handful of set-based statements.
+ Policies that have never been invoiced are invoiced first, as PolicyAccounting would, and
+ archived policies are left alone. Returns the number of policies changed.
+"""
+def change_billing_schedule_bulk(policy_ids, new_schedule, effective_on, chunk_size=INVOICE_CHUNK_SIZE):
+    if new_schedule not in BILLING_SCHEDULES:
+        print "You have chosen a bad billing schedule."
+        return 0
+
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    installments = BILLING_SCHEDULES[new_schedule]
+    changed = 0
+
+    for chunk in chunks(policy_ids, chunk_size):
+        # the invoices of archived policies are no longer in the invoices table to reschedule
+        archived = archive.archived_ids(chunk)
+        chunk = [policy_id for policy_id in chunk if policy_id not in archived]
+        if not chunk:
+            continue
+        invoiced = set()
+        for id_chunk in chunks(chunk, IN_CLAUSE_CHUNK_SIZE):
+            invoiced.update(row.policy_id for row in db.session.execute(
+                select([invoices.c.policy_id]).where(invoices.c.policy_id.in_(id_chunk)).distinct()))
+        uninvoiced = [policy_id for policy_id in chunk if policy_id not in invoiced]
+        if uninvoiced:
+            make_invoices_bulk(uninvoiced)
+
+        rows = []
+        try:
+            for id_chunk in chunks(chunk, IN_CLAUSE_CHUNK_SIZE):
+                billed = dict(db.session.execute(
+                    select([invoices.c.policy_id, func.sum(invoices.c.amount_due)])
+                    .where(invoices.c.policy_id.in_(id_chunk))
+                    .where(invoices.c.deleted == False)
+                    .where(invoices.c.bill_date < effective_on)
+                    .group_by(invoices.c.policy_id)).fetchall())
+                chunk_policies = db.session.execute(
+                    select([policies.c.id, policies.c.effective_date, policies.c.annual_premium])
+                    .where(policies.c.id.in_(id_chunk))).fetchall()
+
+                for policy in chunk_policies:
+                    for bill_date, due_date, cancel_date, amount_due in rescheduled_installments(
+                            policy.effective_date, policy.annual_premium - billed.get(policy.id, 0),
+                            installments, effective_on):
+                        rows.append({'policy_id': policy.id,
+                                     'bill_date': bill_date,
+                                     'due_date': due_date,
+                                     'cancel_date': cancel_date,
+                                     'amount_due': amount_due,
+                                     'deleted': False})
+                changed += len(chunk_policies)
+
+                db.session.execute(invoices.update()
+                                           .where(invoices.c.policy_id.in_(id_chunk))
+                                           .where(invoices.c.deleted == False)
+                                           .where(invoices.c.bill_date >= effective_on)
+                                           .values(deleted=True))
+                db.session.execute(policies.update()
+                                           .where(policies.c.id.in_(id_chunk))
+                                           .values(billing_schedule=new_schedule))
+
+            if rows:
+                db.session.execute(invoices.insert(), rows)
+            ledger.recompute_entries(chunk)
+            allocation.reallocate(chunk)
+            events.refresh(chunk)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    return changed
 
 ################################
 # The functions below are for the db and 
@@ -204,8 +677,54 @@ def build_or_refresh_db():
     db.drop_all()
     db.create_all()
     insert_data()
+    # insert_data adds a payment directly, bring the ledger, allocations and event calendar in line with it
+    ledger.rebuild_ledger()
+    allocation.reallocate_all()
+    events.rebuild_events()
     print "DB Ready!"
 
+"""
+ Brings an existing database up to date with the models without dropping any data. Tables
+ that don't exist yet are created, and columns and indexes declared on the models that are
+ missing from existing tables are added. Safe to run more than once.
+"""
+def upgrade_db():
+    from sqlalchemy.engine.reflection import Inspector
+    from sqlalchemy.schema import CreateTable
+
+    new_ledger = not db.engine.has_table(ledger.ledger.name)
+    new_events = not db.engine.has_table(events.events.name)
+    new_allocations = False
+    db.create_all()
+
+    inspector = Inspector.from_engine(db.engine)
+    dialect = db.engine.dialect
+    for table in db.metadata.sorted_tables:
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing_columns:
+                # new columns need a server_default if they are NOT NULL
+                ddl = dialect.ddl_compiler(dialect, CreateTable(table))
+                db.engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    table.name, ddl.get_column_specification(column)))
+                if column is allocation.invoices.c.paid:
+                    new_allocations = True
+
+        existing_indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
+
+    # a ledger that only held entries written from now on would give wrong balances
+    if new_ledger:
+        ledger.rebuild_ledger()
+    # every invoice starts out unpaid, and the event calendar is worked out from the allocations
+    if new_allocations:
+        allocation.reallocate_all()
+    if new_events or new_allocations:
+        events.rebuild_events()
+    print "DB Upgraded!"
+
 def insert_data():
     #Contacts
     contacts = []
@@ -256,8 +775,7 @@ def insert_data():
         db.session.add(policy)
     db.session.commit()
 
-    for policy in policies:
-        PolicyAccounting(policy.id)
+    make_invoices_bulk([policy.id for policy in policies])
 
     payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
     db.session.add(payment_for_p2)
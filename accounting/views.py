@@ -1,10 +1,32 @@
-from flask import render_template, request, redirect, flash
+from flask import render_template, request, redirect, flash, jsonify, Response, stream_with_context
+import json
 from datetime import date, datetime
-from accounting import app, db
+from accounting import db
+from web import app
 
 # Import our models
-from models import Contact, Invoice, Policy, Payment
-from tools import PolicyAccounting
+from models import ArchivedInvoice, Contact, Invoice, Policy, Payment
+from tools import PolicyAccounting, balances_as_of
+from aging import aging_csv
+from statements import statement_csv
+from snapshot import AccountSnapshot
+from cache import LRUCache
+import allocation
+import archive
+import metrics
+import ledger
+from database import IN_CLAUSE_CHUNK_SIZE, chunks
+
+# rendered policy pages and API responses, keyed by policy version
+policy_cache = LRUCache(app.config['POLICY_CACHE_SIZE'], app.config['POLICY_CACHE_TTL'])
+
+
+metrics.install(app, PolicyAccounting)
+
+
+def _policy_version(policy_id):
+    return db.session.query(Policy.version).filter_by(id=policy_id).scalar()
+
 
 # Routing for the server.
 @app.route("/", methods=['POST','GET'])
@@ -27,6 +49,12 @@ def gather_policy_info():
         flash('There was a problem processing the input')
         return render_template('index.html')
 
+    # a write to the policy bumps its version, so a cached page is never out of date
+    cache_key = ('policyInfo', policy_number, invoice_date, _policy_version(policy_number))
+    page = policy_cache.get(cache_key)
+    if page is not None:
+        return page
+
     try:
         # Invoices will be created when PolicyAccounting object is instantiated
         pa = PolicyAccounting(policy_number)
@@ -34,27 +62,246 @@ def gather_policy_info():
         flash('No policy matching that number found.')
         return render_template('index.html')
 
-    # filters out all invoices with bill_dates past the entered date
-    invoices_to_invoice_date = filter(lambda x: x.bill_date <= invoice_date,
-                       pa.policy.invoices)
+    # an archived policy's invoices and payments are in the archive tables, and so are the
+    # deleted invoices of a live one once they have been archived
+    payment_model = archive.payment_model(pa.policy)
+
+    # only the invoices billed by the entered date are loaded
+    invoices_to_invoice_date = archive.billed_invoices(pa.policy, invoice_date)
 
     if len(invoices_to_invoice_date) == 0:
             flash('No invoices found!')
             return render_template('index.html')
 
-    payments = pa.policy.payments  # db.relation
-
-    payments_contacts_dict = None  # pass None unless we have payments to match
+    # the payments and who made them, in one query
+    payments_contacts = db.session.query(payment_model, Contact)\
+                                  .outerjoin(Contact, Contact.id == payment_model.contact_id)\
+                                  .filter(payment_model.policy_id == pa.policy.id)\
+                                  .order_by(payment_model.transaction_date, payment_model.id)\
+                                  .all()
 
-    if len(payments) != 0:
-        payments_contacts_dict = {}
-        for payment in payments:
-            print "payment"
-            payments_contacts_dict[payment] = Contact.query.filter_by(id=payment.contact_id).first()
+    # everything billed or due by the entered date is in the invoices above, so the balance
+    # and status as of that date take no more queries
+    snapshot = AccountSnapshot(invoices_to_invoice_date,
+                               [payment for payment, _ in payments_contacts])
 
-    return render_template('/invoices.html',
+    page = render_template('/invoices.html',
                            policy_number=policy_number,
                            invoice_date=invoice_date,
                            invoices=invoices_to_invoice_date,
                            policy_account=pa,
-                           payments_contacts_dict=payments_contacts_dict)
+                           snapshot=snapshot,
+                           statement=snapshot.timeline(end=invoice_date),
+                           payments_contacts=payments_contacts)
+    policy_cache.set(cache_key, page)
+    return page
+
+
+def _json_error(message, status_code):
+    response = jsonify(error=message)
+    response.status_code = status_code
+    return response
+
+
+def _page(rows, limit, row_id):
+    # one row more than the limit is asked for to tell whether there is a next page
+    return {'items': rows[:limit],
+            'next_cursor': row_id(rows[limit - 1]) if len(rows) > limit else None}
+
+
+def _invoice_json(invoice):
+    return {'id': invoice.id,
+            'bill_date': invoice.bill_date.isoformat(),
+            'due_date': invoice.due_date.isoformat(),
+            'cancel_date': invoice.cancel_date.isoformat(),
+            'amount_due': invoice.amount_due,
+            'deleted': invoice.deleted}
+
+
+def _payment_json(payment, contact):
+    return {'id': payment.id,
+            'transaction_date': payment.transaction_date.isoformat(),
+            'amount_paid': payment.amount_paid,
+            'contact': {'id': contact.id, 'name': contact.name, 'role': contact.role} if contact else None}
+
+'''
+ JSON version of the policy page for the portal. Returns the policy, its balance and status as
+ of ?date= (YYYY-MM-DD, today if left out) and a page of up to ?limit= invoices and payments
+ dated on or before it. Each list has a next_cursor, pass it back as ?invoices_after= or
+ ?payments_after= for the next page of that list. ?archived=1 lists the policy's archived
+ invoices instead, such as the deleted ones (an archived policy only has archived ones).
+'''
+@app.route("/api/policy/<int:policy_id>", methods=['GET'])
+def policy_api(policy_id):
+    try:
+        as_of = request.args.get('date')
+        as_of = datetime.strptime(as_of, '%Y-%m-%d').date() if as_of else datetime.now().date()
+        limit = min(int(request.args.get('limit', app.config['API_PAGE_SIZE'])),
+                    app.config['API_MAX_PAGE_SIZE'])
+        invoices_after = int(request.args.get('invoices_after', 0))
+        payments_after = int(request.args.get('payments_after', 0))
+        archived = request.args.get('archived', '0') == '1'
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError:
+        return _json_error('There was a problem processing the input', 400)
+
+    cache_key = ('api', policy_id, as_of, limit, invoices_after, payments_after, archived,
+                 _policy_version(policy_id))
+    body = policy_cache.get(cache_key)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+
+    policy = Policy.query.get(policy_id)
+    if not policy:
+        return _json_error('No policy matching that number found.', 404)
+
+    balance = ledger.balance_as_of(policy.id, as_of)
+    if balance is None:
+        balance = balances_as_of(as_of, [policy.id])[policy.id]
+
+    # same rule as PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay
+    cancellation_pending = db.session.query(Invoice.id)\
+                                     .filter(Invoice.policy_id == policy.id)\
+                                     .filter(Invoice.deleted == False)\
+                                     .filter(Invoice.due_date <= as_of)\
+                                     .filter(allocation.open_on(as_of))\
+                                     .first() is not None
+
+    invoice_model = ArchivedInvoice if archived else archive.invoice_model(policy)
+    payment_model = archive.payment_model(policy)
+    invoices = invoice_model.query.filter(invoice_model.policy_id == policy.id)\
+                                  .filter(invoice_model.bill_date <= as_of)\
+                                  .filter(invoice_model.id > invoices_after)\
+                                  .order_by(invoice_model.id)\
+                                  .limit(limit + 1)\
+                                  .all()
+    payments = db.session.query(payment_model, Contact)\
+                         .outerjoin(Contact, Contact.id == payment_model.contact_id)\
+                         .filter(payment_model.policy_id == policy.id)\
+                         .filter(payment_model.transaction_date <= as_of)\
+                         .filter(payment_model.id > payments_after)\
+                         .order_by(payment_model.id)\
+                         .limit(limit + 1)\
+                         .all()
+
+    invoices = _page(invoices, limit, lambda invoice: invoice.id)
+    invoices['items'] = [_invoice_json(invoice) for invoice in invoices['items']]
+    payments = _page(payments, limit, lambda row: row[0].id)
+    payments['items'] = [_payment_json(payment, contact) for payment, contact in payments['items']]
+
+    response = jsonify(policy={'id': policy.id,
+                               'policy_number': policy.policy_number,
+                               'status': policy.status,
+                               'billing_schedule': policy.billing_schedule,
+                               'effective_date': policy.effective_date.isoformat(),
+                               'annual_premium': policy.annual_premium,
+                               'archived_on': policy.archived_on.isoformat() if policy.archived_on else None},
+                       date=as_of.isoformat(),
+                       balance=balance,
+                       cancellation_pending=cancellation_pending,
+                       invoices=invoices,
+                       payments=payments)
+    policy_cache.set(cache_key, response.data)
+    return response
+
+def _balance_items(items):
+    # one item chunk at a time: the policies, invoices and payments of the chunk in three
+    # queries, then every item is answered from the snapshots
+    for chunk in chunks(items, IN_CLAUSE_CHUNK_SIZE):
+        policy_ids = set(policy_id for policy_id, _ in chunk)
+        statuses = dict(db.session.query(Policy.id, Policy.status).filter(Policy.id.in_(policy_ids)))
+        snapshots = AccountSnapshot.load_many(statuses.keys())
+        for policy_id, as_of in chunk:
+            if policy_id not in statuses:
+                yield {'policy_id': policy_id,
+                       'date': as_of.isoformat(),
+                       'error': 'No policy matching that number found.'}
+                continue
+            snapshot = snapshots[policy_id]
+            yield {'policy_id': policy_id,
+                   'date': as_of.isoformat(),
+                   'balance': snapshot.balance(as_of),
+                   'status': statuses[policy_id],
+                   'cancellation_pending': snapshot.cancellation_pending(as_of)}
+
+
+def _balances_json(items):
+    yield '{"balances": ['
+    for number, item in enumerate(_balance_items(items)):
+        yield (',' if number else '') + json.dumps(item)
+    yield ']}'
+
+'''
+ Balances for many policies at once. Takes a JSON list of {"policy_id": 1, "date": "YYYY-MM-DD"}
+ objects and returns {"balances": [...]} with the balance, status and cancellation pending flag
+ of each, in the order asked. A policy that doesn't exist gets an error instead. At most
+ API_MAX_BATCH_SIZE pairs are taken per call, the answer is sent as it is worked out.
+'''
+@app.route("/api/balances", methods=['POST'])
+def balances_api():
+    pairs = request.json
+    if not isinstance(pairs, list):
+        return _json_error('Expected a JSON list of {"policy_id", "date"} objects', 400)
+    if len(pairs) > app.config['API_MAX_BATCH_SIZE']:
+        return _json_error('At most %d policies per request' % app.config['API_MAX_BATCH_SIZE'], 413)
+
+    try:
+        items = [(int(pair['policy_id']), datetime.strptime(pair['date'], '%Y-%m-%d').date())
+                 for pair in pairs]
+    except (KeyError, TypeError, ValueError):
+        return _json_error('There was a problem processing the input', 400)
+
+    return Response(stream_with_context(_balances_json(items)), mimetype='application/json')
+
+'''
+ Hit and miss counts of the policy page cache, for sizing it.
+'''
+@app.route("/api/cache", methods=['GET'])
+def cache_stats():
+    return jsonify(policy_cache.stats())
+
+'''
+ The receivables aging report as of ?date= (YYYY-MM-DD, today if left out), as a CSV download
+ that is sent while it is being worked out.
+'''
+@app.route("/reports/aging.csv", methods=['GET'])
+def aging_report():
+    try:
+        as_of = request.args.get('date')
+        as_of = datetime.strptime(as_of, '%Y-%m-%d').date() if as_of else datetime.now().date()
+    except ValueError:
+        return _json_error('There was a problem processing the input', 400)
+
+    # keeps the request, and with it the session, open until the last row has been sent
+    response = Response(stream_with_context(aging_csv(as_of)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=aging_%s.csv' % as_of.isoformat()
+    return response
+
+'''
+ Account statements, the balance after every bill and payment, of the policies given as
+ ?policy_id= (any number of times, every policy if left out) from ?start= to ?end= (YYYY-MM-DD,
+ either may be left out), as a CSV download that is sent while it is being worked out.
+'''
+@app.route("/reports/statement.csv", methods=['GET'])
+def statement_report():
+    try:
+        policy_ids = [int(policy_id) for policy_id in request.args.getlist('policy_id')] or None
+        start, end = [datetime.strptime(request.args[name], '%Y-%m-%d').date() if request.args.get(name) else None
+                      for name in ('start', 'end')]
+    except ValueError:
+        return _json_error('There was a problem processing the input', 400)
+
+    response = Response(stream_with_context(statement_csv(policy_ids, start, end)), mimetype='text/csv')
+    name = 'statement_%d' % policy_ids[0] if policy_ids and len(policy_ids) == 1 else 'statements'
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.csv' % name
+    return response
+
+'''
+ Request, SQL and PolicyAccounting counters and latency histograms in the Prometheus text format.
+'''
+@app.route("/metrics", methods=['GET'])
+def metrics_report():
+    if not app.config['METRICS_ENABLED']:
+        return _json_error('Metrics are turned off', 404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
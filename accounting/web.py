@@ -0,0 +1,34 @@
+from flask import Flask
+
+from accounting import db, settings
+
+
+"""
+#######################################################
+The Flask app serving the accounting engine.
+
+Its config is the settings dict of the accounting
+package, so the engine and the app see the same values,
+and it ends every app context by removing the database
+session of that thread. Use create_app to get it with
+its views registered.
+#######################################################
+"""
+
+
+class AccountingFlask(Flask):
+    """
+     Flask with the accounting settings as its config, Flask's defaults filled in.
+    """
+    def make_config(self, instance_relative=False):
+        for key, value in self.default_config.items():
+            settings.setdefault(key, value)
+        return settings
+
+
+app = AccountingFlask('accounting')
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    db.session.remove()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 from accounting import *
+from accounting.web import app
 from accounting.models import *
 from accounting.tools import *
 from flask import *